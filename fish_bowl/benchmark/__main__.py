@@ -0,0 +1,63 @@
+import argparse
+import logging
+import sys
+
+from fish_bowl.benchmark.turn_benchmark import benchmark_cases, case_key, run_benchmark, save_report, load_report, \
+    compare_reports, compare_engines
+
+_logger = logging.getLogger(__name__)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(filename)s:%(lineno)d:%(message)s")
+    cmd_parser = argparse.ArgumentParser(description='Turn throughput of the simulation engines')
+    commands = cmd_parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help='Run the benchmark matrix and save a JSON report')
+    run_parser.add_argument('--output', default='benchmark.json', help='Path of the JSON report')
+    run_parser.add_argument('--grid_sizes', default=[10, 50, 100], type=int, nargs='+',
+                            help='Grid sizes (large grids with the db engine take minutes per turn)')
+    run_parser.add_argument('--densities', default=[0.1, 0.3], type=float, nargs='+',
+                            help='Share of cells occupied at start')
+    run_parser.add_argument('--shark_ratios', default=[0.05, 0.2], type=float, nargs='+',
+                            help='Share of animals being sharks at start')
+    run_parser.add_argument('--databases', default=['memory', 'file'], nargs='+', help='SQLite in memory or file')
+    run_parser.add_argument('--engines', default=['db'], nargs='+', help='db (SimulationGrid), array and/or striped')
+    run_parser.add_argument('--turns', default=5, type=int, help='Number of turns played per case')
+    run_parser.add_argument('--seed', default=0, type=int, help='Random seed')
+    compare_parser = commands.add_parser('compare', help='Compare a JSON report to a baseline')
+    compare_parser.add_argument('baseline', help='Path of the baseline JSON report')
+    compare_parser.add_argument('current', help='Path of the JSON report to check')
+    compare_parser.add_argument('--threshold', default=0.2, type=float,
+                                help='Relative slow down flagged as a regression')
+    engines_parser = commands.add_parser('engines', help='Compare two engines over the cases of a JSON report')
+    engines_parser.add_argument('report', help='Path of a JSON report run with both engines')
+    engines_parser.add_argument('--engine', default='striped', help='Engine to check')
+    engines_parser.add_argument('--baseline_engine', default='array', help='Engine it is compared to')
+    engines_parser.add_argument('--threshold', default=0.2, type=float,
+                                help='Relative slow down flagged as a regression')
+    args = cmd_parser.parse_args()
+
+    if args.command == 'run':
+        cases = benchmark_cases(grid_sizes=args.grid_sizes, densities=args.densities, shark_ratios=args.shark_ratios,
+                                databases=args.databases, engines=args.engines)
+        report = run_benchmark(cases, nb_turns=args.turns, seed=args.seed)
+        save_report(report, args.output)
+        print('{:<32}{:>8}{:>12}{:>12}{:>10}{:>10}'.format('case', 'animals', 'init (s)', 'turn (s)', 'SQL/turn',
+                                                         'peak MB'))
+        for r in report['results']:
+            print('{:<32}{:>8}{:>12.4f}{:>12.4f}{:>10.0f}{:>10.0f}'.format(
+                case_key(r), r['nb_animals'], r['init_s'],
+                r['turn_median_s'] or 0., r['sql_statements_per_turn'] or 0., r['peak_rss_mb'] or 0.))
+        _logger.info('Report saved to {}'.format(args.output))
+    else:
+        if args.command == 'engines':
+            comparison = compare_engines(load_report(args.report), engine=args.engine,
+                                         baseline_engine=args.baseline_engine, threshold=args.threshold)
+        else:
+            comparison = compare_reports(load_report(args.baseline), load_report(args.current),
+                                         threshold=args.threshold)
+        print('{:<32}{:>12}{:>12}'.format('case', 'turn ratio', 'init ratio'))
+        for line in comparison:
+            print('{:<32}{:>12.2f}{:>12.2f}{}'.format(line['case'], line['turn_median_s'] or float('nan'),
+                                                       line['init_s'] or float('nan'),
+                                                       '  REGRESSION' if line['regression'] else ''))
+        sys.exit(1 if any(line['regression'] for line in comparison) else 0)
@@ -0,0 +1,220 @@
+import datetime as dt
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from fish_bowl.dataio.persistence import SimulationClient
+from fish_bowl.dataio.turn_stats import PHASES
+from fish_bowl.process.array_engine import ArraySimulationGrid
+from fish_bowl.process.base import SimulationGrid
+from fish_bowl.process.striped_engine import StripedSimulationGrid
+from fish_bowl.process.utils import EndOfSimulatioError
+
+try:
+    import resource
+except ImportError:  # not available on windows, peak memory is then not reported
+    resource = None
+
+_logger = logging.getLogger(__name__)
+
+ENGINES = {'db': SimulationGrid, 'array': ArraySimulationGrid, 'striped': StripedSimulationGrid}
+DATABASES = ['memory', 'file']
+
+# animal parameters of the benchmark grids, sizes and populations come from the case
+base_config = {
+    'fish_breed_maturity': 3,
+    'fish_breed_probability': 80,
+    'fish_speed': 2,
+    'shark_breed_maturity': 10,
+    'shark_breed_probability': 100,
+    'shark_speed': 4,
+    'shark_starving': 3
+}
+
+
+def benchmark_cases(grid_sizes: List[int], densities: List[float], shark_ratios: List[float],
+                    databases: List[str], engines: List[str]) -> List[Dict]:
+    """
+    Matrix of benchmark cases
+    :param grid_sizes:
+    :param densities: share of the cells occupied at start
+    :param shark_ratios: share of the animals being sharks at start
+    :param databases: 'memory' or 'file' SQLite
+    :param engines: 'db' (SimulationGrid), 'array' (ArraySimulationGrid) or 'striped' (StripedSimulationGrid, one
+    worker per core)
+    :return:
+    """
+    for database in databases:
+        if database not in DATABASES:
+            raise ValueError('Unknown database {}, must be one of {}'.format(database, DATABASES))
+    for engine in engines:
+        if engine not in ENGINES:
+            raise ValueError('Unknown engine {}, must be one of {}'.format(engine, list(ENGINES)))
+    return [{'engine': engine, 'database': database, 'grid_size': grid_size, 'density': density,
+             'shark_ratio': shark_ratio}
+            for engine, database, grid_size, density, shark_ratio
+            in itertools.product(engines, databases, grid_sizes, densities, shark_ratios)]
+
+
+def case_key(case: Dict) -> str:
+    """
+    Identifier of a case, used to match results of two benchmark runs
+    """
+    return '{engine}-{database}-{grid_size}-d{density}-s{shark_ratio}'.format(**case)
+
+
+def case_config(case: Dict) -> Dict:
+    """
+    Simulation parameters of a benchmark case
+    """
+    nb_animals = int(case['density'] * case['grid_size'] ** 2)
+    nb_shark = max(1, int(nb_animals * case['shark_ratio']))
+    return dict(base_config, grid_size=case['grid_size'], init_nb_fish=nb_animals - nb_shark, init_nb_shark=nb_shark)
+
+
+def _peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on linux, bytes on macOS
+    scale = 1 if platform.system() == 'Darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2 ** 20
+
+
+def run_case(case: Dict, nb_turns: int, seed: int = 0) -> Dict:
+    """
+    Play nb_turns of a simulation and time them
+    :param case: see benchmark_cases
+    :param nb_turns:
+    :param seed:
+    :return: the case with its timings (seconds), SQL statement counts and peak memory
+    """
+    base_rss = _peak_rss_mb()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if case['database'] == 'file':
+            client = SimulationClient('sqlite:///{}'.format(os.path.join(tmp_dir, 'benchmark.db')))
+        else:
+            client = SimulationClient('sqlite:///:memory:')
+        timer = time.perf_counter()
+        if case['engine'] == 'db':
+            grid = SimulationGrid(persistence=client, simulation_parameters=case_config(case), seed=seed)
+        else:
+            grid = ENGINES[case['engine']](simulation_parameters=case_config(case), persistence=client, seed=seed)
+        init_time = time.perf_counter() - timer
+        init_statements = client.query_stats.statements
+        for _ in range(nb_turns):
+            try:
+                grid.play_turn()
+            except EndOfSimulatioError:
+                break
+        population = grid.population
+        if case['engine'] != 'db':
+            # stops the worker processes of the striped engine
+            grid.close()
+        client._engine.dispose()
+    records = grid.turn_stats
+
+    def median(field):
+        return float(np.median([r[field] for r in records])) if records else None
+
+    return dict(case,
+                nb_animals=int(population.sum()),
+                turns_played=len(records),
+                init_s=init_time,
+                init_sql_statements=init_statements,
+                turn_s=[r['turn_time'] for r in records],
+                turn_median_s=median('turn_time'),
+                phase_median_s={phase: median('{}_time'.format(phase.lstrip('_'))) for phase in PHASES},
+                sql_statements_per_turn=float(np.mean([r['sql_statements'] for r in records])) if records else None,
+                sql_rows_per_turn=float(np.mean([r['sql_rows_read'] + r['sql_rows_written'] for r in records]))
+                if records else None,
+                sql_driver_median_s=median('sql_driver_time'),
+                base_rss_mb=base_rss,
+                peak_rss_mb=_peak_rss_mb())
+
+
+def _run_isolated(args):
+    return run_case(*args)
+
+
+def run_benchmark(cases: List[Dict], nb_turns: int, seed: int = 0, isolate: bool = True) -> Dict:
+    """
+    Run the benchmark cases
+    :param cases: see benchmark_cases
+    :param nb_turns: number of turns played per case
+    :param seed:
+    :param isolate: run each case in a fresh process, so that peak memory is the one of the case
+    :return: benchmark report
+    """
+    results = []
+    for case in cases:
+        _logger.info('Running {}'.format(case_key(case)))
+        if isolate:
+            with multiprocessing.get_context('spawn').Pool(1) as pool:
+                result = pool.apply(_run_isolated, ((case, nb_turns, seed),))
+        else:
+            result = run_case(case, nb_turns=nb_turns, seed=seed)
+        _logger.info('{}: {} turns, median turn {:.4f}s'.format(case_key(case), result['turns_played'],
+                                                                 result['turn_median_s'] or 0.))
+        results.append(result)
+    return {'created': dt.datetime.now().isoformat(), 'python': platform.python_version(),
+            'platform': platform.platform(), 'nb_turns': nb_turns, 'seed': seed, 'results': results}
+
+
+def save_report(report: Dict, path: str):
+    with open(path, 'w') as fp:
+        json.dump(report, fp, indent=2)
+
+
+def load_report(path: str) -> Dict:
+    with open(path, 'r') as fp:
+        return json.load(fp)
+
+
+def compare_reports(baseline: Dict, current: Dict, threshold: float = 0.2) -> List[Dict]:
+    """
+    Compare the median turn and init times of the cases found in both reports
+    :param baseline:
+    :param current:
+    :param threshold: relative slow down above which a case is flagged as a regression
+    :return: one line per case, with the time ratios current / baseline
+    """
+    baseline_results = {case_key(r): r for r in baseline['results']}
+    comparison = []
+    for result in current['results']:
+        key = case_key(result)
+        reference = baseline_results.get(key)
+        if reference is None:
+            continue
+        line = {'case': key}
+        for metric in ['turn_median_s', 'init_s']:
+            if reference[metric] and result[metric] is not None:
+                line[metric] = result[metric] / reference[metric]
+            else:
+                line[metric] = None
+        line['regression'] = any(ratio is not None and ratio > 1 + threshold
+                                 for ratio in (line['turn_median_s'], line['init_s']))
+        comparison.append(line)
+    return comparison
+
+
+def compare_engines(report: Dict, engine: str, baseline_engine: str = 'array', threshold: float = 0.2) -> List[Dict]:
+    """
+    Compare the median turn and init times of two engines over the cases of a report run with both
+    (e.g. the striped engine against the array one)
+    :param report:
+    :param engine:
+    :param baseline_engine:
+    :param threshold: relative slow down above which a case is flagged as a regression
+    :return: one line per case, with the time ratios engine / baseline_engine
+    """
+    baseline = {'results': [dict(r, engine=engine) for r in report['results'] if r['engine'] == baseline_engine]}
+    current = {'results': [r for r in report['results'] if r['engine'] == engine]}
+    return compare_reports(baseline, current, threshold=threshold)
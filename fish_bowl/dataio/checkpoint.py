@@ -0,0 +1,83 @@
+"""
+Compact checkpoints of a simulation: live animals as numpy arrays in a .npz file, with the simulation parameters,
+the turn and the random generator state
+"""
+import json
+import logging
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from fish_bowl.process.utils import Animal
+
+_logger = logging.getLogger(__name__)
+
+CHECKPOINT_VERSION = 1
+CHECKPOINT_COLUMNS = {
+    'animal_type': np.int8,
+    'spawn_turn': np.int32,
+    'breed_count': np.int32,
+    'last_breed': np.int32,
+    'last_fed': np.int32,
+    'coord_x': np.int32,
+    'coord_y': np.int32,
+}
+
+
+def save_checkpoint(path: str, simulation_parameters: Dict, turn: int, rng_state: Dict, animals: pd.DataFrame,
+                    sim_id: Optional[int] = None):
+    """
+    Write a checkpoint, atomically (a crash while writing leaves the previous checkpoint untouched)
+    :param path: .npz file
+    :param simulation_parameters:
+    :param turn: next turn to play
+    :param rng_state: state of the random generator (numpy bit_generator.state)
+    :param animals: live animals, as returned by SimulationClient.get_animals_df (in oid order)
+    :param sim_id: simulation saved, with the oids of its animals so the event log can be replayed on top
+    :return:
+    """
+    columns = {name: animals[name].to_numpy(dtype=dtype) for name, dtype in CHECKPOINT_COLUMNS.items()
+               if name != 'animal_type'}
+    columns['animal_type'] = animals.animal_type.map({a: a.value for a in Animal}).to_numpy(dtype=np.int8)
+    tmp_path = '{}.tmp.npz'.format(os.path.splitext(path)[0])
+    np.savez_compressed(tmp_path, version=CHECKPOINT_VERSION, turn=turn, sim_id=-1 if sim_id is None else sim_id,
+                        oid=animals.oid.to_numpy(dtype=np.int64),
+                        simulation_parameters=json.dumps(dict(simulation_parameters)),
+                        rng_state=json.dumps(rng_state), **columns)
+    os.replace(tmp_path, path)
+    _logger.info('Checkpoint of turn {} ({} animals) saved to {}'.format(turn, len(animals), path))
+
+
+def load_checkpoint(path: str) -> Dict:
+    """
+    Read a checkpoint
+    :param path: .npz file
+    :return: dictionary with simulation_parameters, turn, rng_state, sim_id (None if unknown), oids and animals
+    (column name -> array)
+    """
+    with np.load(path) as data:
+        version = int(data['version'])
+        if version != CHECKPOINT_VERSION:
+            raise ValueError('Unsupported checkpoint version {} in {}'.format(version, path))
+        return {'simulation_parameters': json.loads(str(data['simulation_parameters'])),
+                'turn': int(data['turn']),
+                'rng_state': json.loads(str(data['rng_state'])),
+                # not in the first checkpoints
+                'sim_id': int(data['sim_id']) if 'sim_id' in data.files and int(data['sim_id']) >= 0 else None,
+                'oids': data['oid'] if 'oid' in data.files else None,
+                'animals': {name: data[name] for name in CHECKPOINT_COLUMNS}}
+
+
+def checkpoint_records(animals: Dict[str, np.ndarray]) -> List[Dict]:
+    """
+    Animals of a checkpoint as rows to insert (see SimulationClient.write_animals)
+    :param animals: column name -> array, as in load_checkpoint
+    :return:
+    """
+    types = [Animal(t) for t in animals['animal_type'].tolist()]
+    columns = [animals[name].tolist() for name in CHECKPOINT_COLUMNS if name != 'animal_type']
+    names = [name for name in CHECKPOINT_COLUMNS if name != 'animal_type']
+    return [dict(zip(names, values), animal_type=animal_type, alive=True)
+            for animal_type, values in zip(types, zip(*columns))]
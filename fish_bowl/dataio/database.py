@@ -1,19 +1,30 @@
 import logging
-from contextlib import contextmanager
+from contextlib import contextmanager, nullcontext
 
 import re
 import os
+import threading
+import time
+from typing import Dict
 
-from sqlalchemy import event, exc
-from sqlalchemy.engine import Engine, create_engine
+from sqlalchemy import event, exc, inspect
+from sqlalchemy.engine import Engine, create_engine, make_url
 from sqlite3 import Connection as SQLite3Connection
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.pool import Pool
+from sqlalchemy.pool import Pool, QueuePool, StaticPool
+from sqlalchemy.schema import CreateSchema
 
 _logger = logging.getLogger(__name__)
 
 POOL_RECYCLE = 100
-POOL_SIZE = 1  # 1 for monothreaded, otherwise should be number of threads
+POOL_SIZE = 5  # connections kept open per database, shared by all the clients of the process
+MAX_OVERFLOW = 10  # connections opened on top of the pool under load, closed when returned
+
+# engines shared by the clients of the process, with the pool_size and max_overflow they were created with, by url
+_engines = dict()
+_engines_lock = threading.Lock()
+# create_all checks then creates, clients starting together must not interleave their DDL
+_ddl_lock = threading.Lock()
 
 
 @event.listens_for(Engine, "connect")
@@ -74,20 +85,239 @@ def session_scope(session_builder):
         session.close()
 
 
+@contextmanager
+def joined_session_scope(session):
+    """
+    Scope inside a transaction that is already open: pending changes are flushed so they can be read,
+    commit or rollback is left to the owner of the transaction
+    :param session:
+    :return:
+    """
+    session.flush()
+    yield session
+
+
+class QueryStats:
+    """
+    Running totals of the statements executed on an engine, collected by cursor execution events
+    (driver_time is the time spent in the DBAPI execute calls, in seconds)
+    """
+
+    def __init__(self):
+        self.statements = 0
+        self.rows_read = 0
+        self.rows_written = 0
+        self.driver_time = 0.
+
+    def totals(self) -> Dict:
+        return {'statements': self.statements, 'rows_read': self.rows_read, 'rows_written': self.rows_written,
+                'driver_time': self.driver_time}
+
+
+class _RowCountingCursor:
+    """
+    DBAPI cursor proxy counting the fetched rows (drivers such as sqlite3 do not report it for SELECT)
+    """
+
+    def __init__(self, cursor, stats: QueryStats):
+        self._cursor = cursor
+        self._stats = stats
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._stats.rows_read += 1
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = self._cursor.fetchmany(*args, **kwargs)
+        self._stats.rows_read += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._stats.rows_read += len(rows)
+        return rows
+
+    def __getattr__(self, item):
+        return getattr(self._cursor, item)
+
+
+def instrument_engine(engine: Engine):
+    """
+    Collect the statements, rows and driver time of an engine into the QueryStats passed in the 'query_stats'
+    execution option, so that clients sharing the engine keep their own totals
+    (see SQLAlchemyQueries: sessions are bound to engine.execution_options(query_stats=...))
+    :param engine:
+    :return:
+    """
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info['query_start'] = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info.pop('query_start')
+        stats = None if context is None else context.execution_options.get('query_stats')
+        if stats is None:
+            return
+        stats.driver_time += time.perf_counter() - start
+        stats.statements += 1
+        if context.isinsert or context.isupdate or context.isdelete:
+            if cursor.rowcount > 0:
+                stats.rows_written += cursor.rowcount
+        elif cursor.description is not None:
+            # the result is built from context.cursor after this event
+            context.cursor = _RowCountingCursor(cursor, stats)
+
+
+def is_private_database(database_url) -> bool:
+    """
+    In-memory sqlite databases only live in their engine, they cannot be shared between clients
+    :param database_url:
+    :return:
+    """
+    url = make_url(database_url)
+    return url.get_backend_name() == 'sqlite' and (url.database in (None, '', ':memory:') or
+                                                   url.query.get('mode') == 'memory')
+
+
+def _create_engine(database_url, pool_size: int, max_overflow: int) -> Engine:
+    url = make_url(database_url)
+    if is_private_database(database_url):
+        # the database lives in its connection: a single one, shared by all the threads of the client (e.g. its
+        # write-behind writer), which serialises its sessions (see SQLAlchemyQueries)
+        engine = create_engine(url, poolclass=StaticPool, connect_args={'check_same_thread': False},
+                               echo=False)  # no echo-ing; let's try to optimize all we can
+    elif url.get_backend_name() == 'sqlite':
+        # sqlalchemy opens a new sqlite connection per session by default, keep them in a pool instead
+        engine = create_engine(url, poolclass=QueuePool, pool_size=pool_size, max_overflow=max_overflow,
+                               connect_args={'check_same_thread': False}, echo=False)
+    else:
+        engine = create_engine(url, pool_recycle=POOL_RECYCLE, pool_size=pool_size, max_overflow=max_overflow,
+                               pool_pre_ping=True, echo=False)
+    instrument_engine(engine)
+    return engine
+
+
+def get_engine(database_url, pool_size: int = POOL_SIZE, max_overflow: int = MAX_OVERFLOW) -> Engine:
+    """
+    Engine of a database, shared by all the clients of the process (in-memory sqlite databases excepted, each call
+    creates a new one)
+    :param database_url:
+    :param pool_size: connections kept open, only used by the first call for a database
+    :param max_overflow: connections opened on top of pool_size under load, only used by the first call for a database
+    :return:
+    """
+    if is_private_database(database_url):
+        return _create_engine(database_url, pool_size=pool_size, max_overflow=max_overflow)
+    key = str(make_url(database_url))
+    with _engines_lock:
+        if key not in _engines:
+            _engines[key] = (_create_engine(database_url, pool_size=pool_size, max_overflow=max_overflow), pool_size,
+                             max_overflow)
+        engine, engine_pool_size, engine_max_overflow = _engines[key]
+        if (engine_pool_size, engine_max_overflow) != (pool_size, max_overflow):
+            _logger.warning('Engine of <{}> already created with pool size {} and overflow {}, ignoring {} and {}'
+                            .format(blank_password(key), engine_pool_size, engine_max_overflow, pool_size,
+                                    max_overflow))
+    return engine
+
+
+def dispose_engines():
+    """
+    Close the pooled connections of all shared engines and forget them
+    :return:
+    """
+    with _engines_lock:
+        for engine, _, _ in _engines.values():
+            engine.dispose()
+        _engines.clear()
+
+
+def create_schemas(engine: Engine, metadata):
+    """
+    Create the schemas of the tables of metadata that do not exist yet (sqlite databases always have 'main')
+    :param engine:
+    :param metadata:
+    :return:
+    """
+    if engine.dialect.name == 'sqlite':
+        return
+    schemas = {table.schema for table in metadata.tables.values() if table.schema is not None}
+    existing = set(inspect(engine).get_schema_names())
+    with engine.begin() as conn:
+        for name in sorted(schemas - existing):
+            conn.execute(CreateSchema(name))
+
+
 class SQLAlchemyQueries:
-    def __init__(self, database_url, declarative_base=None, expire_on_commit=True):
+    def __init__(self, database_url, declarative_base=None, expire_on_commit=True, pool_size: int = POOL_SIZE,
+                 max_overflow: int = MAX_OVERFLOW):
+        """
+        :param database_url:
+        :param declarative_base: tables (and their schemas) are created if missing
+        :param expire_on_commit:
+        :param pool_size: see get_engine
+        :param max_overflow: see get_engine
+        """
         _logger.info('Using <{}>'.format(blank_password(database_url)))
-        if 'sqlite' in database_url:
-            # no pool recycling for in-memory sqlite, disable it
-            self._engine = create_engine(database_url, pool_recycle=-1, echo=False) # no echo-ing; let's try to optimize all we can
-        else:
-            kwargs = {'pool_recycle': POOL_RECYCLE, 'pool_size': POOL_SIZE}
-            self.engine = create_engine(database_url, echo=False, **kwargs)
-        self._session_maker = sessionmaker(bind=self._engine,
+        # open transaction of each thread, so that a background thread never joins the transaction of another one
+        self._local = threading.local()
+        # private databases have a single connection, sqlite connections must not be used by two threads at once:
+        # sessions of the threads of the client take turns (reentrant, for the nested scopes of a thread)
+        self._session_lock = threading.RLock() if is_private_database(database_url) else nullcontext()
+        self._engine = get_engine(database_url, pool_size=pool_size, max_overflow=max_overflow)
+        self.query_stats = QueryStats()
+        self._session_maker = sessionmaker(bind=self._engine.execution_options(query_stats=self.query_stats),
                                            # autoflush=False, # AM: uncomment, if want to speed up a little bit more
                                            expire_on_commit=expire_on_commit)
         if declarative_base:
-            declarative_base.metadata.create_all(bind=self._engine, checkfirst=True)
+            with _ddl_lock:
+                create_schemas(self._engine, declarative_base.metadata)
+                declarative_base.metadata.create_all(bind=self._engine, checkfirst=True)
+
+    def create_indexes(self, indexes):
+        """
+        Create the indexes that do not exist yet (create_all skips the indexes of tables that already exist)
+        :param indexes:
+        :return:
+        """
+        with _ddl_lock:
+            for index in indexes:
+                index.create(bind=self._engine, checkfirst=True)
 
+    @property
+    def _transaction_session(self):
+        return getattr(self._local, 'session', None)
+
+    @_transaction_session.setter
+    def _transaction_session(self, session):
+        self._local.session = session
+
+    @contextmanager
     def session_scope(self):
-        return session_scope(self._session_maker)
+        with self._session_lock:
+            if self._transaction_session is not None:
+                with joined_session_scope(self._transaction_session) as s:
+                    yield s
+            else:
+                with session_scope(self._session_maker) as s:
+                    yield s
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run all the queries issued inside the context in a single transaction, committed when leaving it
+        (rolled back on error). Nested calls of the same thread join the open transaction.
+        :return: the session of the transaction
+        """
+        if self._transaction_session is not None:
+            yield self._transaction_session
+            return
+        with self._session_lock, session_scope(self._session_maker) as s:
+            self._transaction_session = s
+            try:
+                yield s
+            finally:
+                self._transaction_session = None
@@ -0,0 +1,128 @@
+"""
+Encodings of a grid frame (the live animals of a simulation at a turn) for clients:
+- json: list of (type, x, y) tuples
+- packed: one 2 bits code per cell (0: empty, 1: Fish, 2: Shark), 4 cells per byte, row major
+- varint: for fish then sharks, the number of animals and the gaps between their sorted cell indexes (x * grid_size + y),
+  as LEB128 varints
+"""
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from fish_bowl.process.simple_display import animal_type_codes, display_simple_grid
+from fish_bowl.process.utils import Animal
+
+FRAME_FORMATS = {'json': 'application/json', 'packed': 'application/octet-stream',
+                 'varint': 'application/octet-stream'}
+
+FRAME_META = {str(a.value): a.name for a in Animal}
+
+
+def frame_json(animal_df: pd.DataFrame, sim_id: int, turn) -> Dict:
+    """
+    :param animal_df: live animals
+    :param sim_id:
+    :param turn: turn the frame is the start of (None if unknown)
+    :return: dictionary to serialize as json
+    """
+    return {'simulation': {'sim_id': sim_id, 'sim_turn': turn},
+            'meta': dict(FRAME_META, data=('type', 'x', 'y')),
+            'grid': list(zip(animal_type_codes(animal_df).tolist(), animal_df.coord_x.tolist(),
+                             animal_df.coord_y.tolist()))}
+
+
+def pack_grid(grid: np.ndarray) -> bytes:
+    """
+    :param grid: grid of cell codes, see display_simple_grid
+    :return: 2 bits per cell, first cell in the low bits
+    """
+    cells = grid.astype(np.uint8).ravel()
+    cells = np.concatenate([cells, np.zeros(-len(cells) % 4, dtype=np.uint8)]).reshape(-1, 4)
+    return (cells[:, 0] | cells[:, 1] << 2 | cells[:, 2] << 4 | cells[:, 3] << 6).astype(np.uint8).tobytes()
+
+
+def unpack_grid(data: bytes, grid_size: int) -> np.ndarray:
+    packed = np.frombuffer(data, dtype=np.uint8)
+    cells = np.stack([(packed >> shift) & 3 for shift in (0, 2, 4, 6)], axis=1).ravel()
+    return cells[:grid_size * grid_size].reshape(grid_size, grid_size).astype(int)
+
+
+def encode_varints(values: np.ndarray) -> bytes:
+    """
+    LEB128 encoding of non-negative integers (7 bits per byte, high bit set on all bytes but the last)
+    :param values:
+    :return:
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    if len(values) == 0:
+        return b''
+    nb_bytes = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        nb_bytes += rest > 0
+        rest >>= np.uint64(7)
+    shifts = np.arange(nb_bytes.max(), dtype=np.uint64) * np.uint64(7)
+    groups = ((values[:, None] >> shifts) & np.uint64(0x7f)).astype(np.uint8)
+    position = np.arange(len(shifts))
+    groups[position < (nb_bytes - 1)[:, None]] |= 0x80
+    return groups[position < nb_bytes[:, None]].tobytes()
+
+
+def decode_varints(data: bytes, offset: int = 0, count: int = -1) -> Tuple[List[int], int]:
+    """
+    :param data:
+    :param offset: position of the first varint
+    :param count: number of varints to read (all remaining if -1)
+    :return: values and position after the last one read
+    """
+    values = []
+    while offset < len(data) and count != len(values):
+        value, shift = 0, 0
+        while True:
+            byte = data[offset]
+            offset += 1
+            value |= (byte & 0x7f) << shift
+            shift += 7
+            if byte < 0x80:
+                break
+        values.append(value)
+    return values, offset
+
+
+def encode_cell_lists(animal_df: pd.DataFrame, grid_size: int) -> bytes:
+    codes = animal_type_codes(animal_df)
+    cells = animal_df.coord_x.to_numpy(dtype=np.int64) * grid_size + animal_df.coord_y.to_numpy(dtype=np.int64)
+    parts = []
+    for animal in Animal:
+        indexes = np.sort(cells[codes == animal.value])
+        parts.append(encode_varints([len(indexes)]))
+        parts.append(encode_varints(np.diff(indexes, prepend=0)))
+    return b''.join(parts)
+
+
+def decode_cell_lists(data: bytes, grid_size: int) -> Dict[Animal, List[Tuple[int, int]]]:
+    """
+    :return: animal type -> (x, y) of its cells
+    """
+    cells, offset = dict(), 0
+    for animal in Animal:
+        (nb,), offset = decode_varints(data, offset, count=1)
+        gaps, offset = decode_varints(data, offset, count=nb)
+        cells[animal] = [divmod(int(c), grid_size) for c in np.cumsum(gaps, dtype=np.int64)]
+    return cells
+
+
+def encode_frame(animal_df: pd.DataFrame, grid_size: int, fmt: str) -> bytes:
+    """
+    Binary encodings of a frame
+    :param animal_df: live animals
+    :param grid_size:
+    :param fmt: 'packed' or 'varint'
+    :return:
+    """
+    if fmt == 'packed':
+        return pack_grid(display_simple_grid(animal_df, grid_size))
+    if fmt == 'varint':
+        return encode_cell_lists(animal_df, grid_size)
+    raise ValueError('Unknown frame format {}, must be one of {}'.format(fmt, list(FRAME_FORMATS)))
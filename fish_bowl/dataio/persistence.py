@@ -1,18 +1,22 @@
 import datetime as dt
 import logging
 import os
-from typing import List, Dict, Optional
+from contextlib import contextmanager
+from typing import List, Dict, Optional, Sequence, Tuple, Union
 
+import numpy as np
 import pandas as pd
 
-from fish_bowl.dataio.database import SQLAlchemyQueries
-from sqlalchemy import Column, DateTime, Float, ForeignKey, Enum, Boolean, Integer
+from fish_bowl.dataio.checkpoint import load_checkpoint
+from fish_bowl.dataio.database import SQLAlchemyQueries, POOL_SIZE, MAX_OVERFLOW
+from sqlalchemy import Column, DateTime, Float, ForeignKey, Enum, Boolean, Integer, Index, String, bindparam, case, \
+    select, text, type_coerce
 from sqlalchemy.orm import validates
 from sqlalchemy.sql import func
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm.exc import NoResultFound
 
-from fish_bowl.process.utils import ImpossibleAction, Animal
+from fish_bowl.process.utils import ImpossibleAction, Animal, AnimalEvent
 from fish_bowl.process.topology import SquareGridCoordinate, square_grid_valid, NonEmptyCoordinate
 
 _logger = logging.getLogger(__name__)
@@ -21,6 +25,13 @@ DB_LOC = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..', 'simul
 
 Base = declarative_base()
 schema = 'main'  # in sqlite, schema is always main, in other db, look for the owner schema name
+MAX_IN_PARAMS = 500  # keep 'IN' lists below the bound parameter limit of the database
+SETUP_TURN = -1  # turn of the events happening outside of a turn (initial spawn)
+
+
+def _chunks(values: List, size: int):
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
 
 
 def get_database_string(ref: Optional[str] = '', memory: Optional[bool] = False):
@@ -68,7 +79,14 @@ class Animals(Base):
     coord_x = Column(Integer)
     coord_y = Column(Integer)
 
-    __table_args__ = ({'schema': schema})
+    __table_args__ = (
+        # live animals by type: dead rows are never deleted, keep them out of the index where the dialect allows it
+        Index('ix_animals_sim_alive_type', 'sim_id', 'alive', 'animal_type',
+              sqlite_where=text('alive = 1'), postgresql_where=text('alive')),
+        # animals in a cell, also used to look for dead ones
+        Index('ix_animals_sim_coord', 'sim_id', 'coord_x', 'coord_y', 'alive'),
+        {'schema': schema}
+    )
 
     def __repr__(self):
         if self.alive:
@@ -79,9 +97,514 @@ class Animals(Base):
                                                                y=self.coord_y)
 
 
+class AnimalEvents(Base):
+    """
+    Append-only log of what happened to the animals: births (with type), moves, deaths and feedings,
+    with the position of the animal after the event (none for feedings)
+    """
+    __tablename__ = 'ANIMAL_EVENTS'
+    eid = Column(Integer, primary_key=True, autoincrement=True)
+    sim_id = Column(ForeignKey("{}.{}.sid".format(schema, Simulation.__tablename__)))
+    turn = Column(Integer)
+    oid = Column(Integer)
+    event = Column(Enum(AnimalEvent))
+    animal_type = Column(Enum(Animal), nullable=True)
+    coord_x = Column(Integer, nullable=True)
+    coord_y = Column(Integer, nullable=True)
+
+    __table_args__ = (
+        Index('ix_animal_events_sim_turn', 'sim_id', 'turn'),
+        {'schema': schema}
+    )
+
+
+def _event(oid: int, event: AnimalEvent, coord_x: Optional[int] = None, coord_y: Optional[int] = None,
+           animal_type: Optional[Animal] = None) -> Dict:
+    return {'oid': int(oid), 'event': event, 'animal_type': animal_type,
+            'coord_x': None if coord_x is None else int(coord_x), 'coord_y': None if coord_y is None else int(coord_y)}
+
+
+ANIMAL_COLUMNS = [column.name for column in Animals.__table__.columns]
+
+
+# columns changed by the mutations of a turn (see _TurnUnitOfWork)
+_TURN_COLUMNS = ['breed_count', 'last_breed', 'last_fed', 'alive', 'coord_x', 'coord_y']
+
+
+def _animal_record(animal: Animals) -> Dict:
+    return {column: getattr(animal, column) for column in ANIMAL_COLUMNS}
+
+
+# columnar reads (see SimulationClient.read_animals): one field per column, animal_type as its Animal value
+ANIMAL_DTYPE = np.dtype([(column, np.int8 if column == 'animal_type' else np.bool_ if column == 'alive' else np.int64)
+                         for column in ANIMAL_COLUMNS])
+_ANIMAL_TYPES = np.array([None] + [a for a in Animal], dtype=object)  # Animal by value
+
+
+def _read_animals_statement(live_only: bool, by_type: bool):
+    """
+    Core select of the animals of a simulation (sim_id and animal_type bound at execution), the Animal enum is turned
+    into its value by the database
+    """
+    table = Animals.__table__
+    code = case({a.name: a.value for a in Animal}, value=type_coerce(table.c.animal_type, String))
+    columns = [code.label(column.name) if column.name == 'animal_type' else column for column in table.columns]
+    stmt = select(*columns).where(table.c.sim_id == bindparam('sim_id'))
+    if live_only:
+        stmt = stmt.where(table.c.alive)
+    if by_type:
+        stmt = stmt.where(table.c.animal_type == bindparam('animal_type'))
+    return stmt.order_by(table.c.oid)
+
+
+# built once and reused by every read, their compiled form comes from the compiled cache of the engine
+_READ_ANIMALS = {(live_only, by_type): _read_animals_statement(live_only, by_type)
+                 for live_only in (True, False) for by_type in (True, False)}
+
+
+def animals_frame(animals: np.ndarray, enum: bool = True) -> pd.DataFrame:
+    """
+    DataFrame of animals read by SimulationClient.read_animals, laid out as get_animals_df
+    :param animals: ANIMAL_DTYPE array
+    :param enum: animal_type as Animal, as in get_animals_df (kept as integer codes otherwise)
+    :return:
+    """
+    frame = pd.DataFrame({column: animals[column] for column in ANIMAL_COLUMNS})
+    if enum:
+        frame['animal_type'] = _ANIMAL_TYPES[animals['animal_type']]
+    return frame
+
+
+class AnimalSnapshot:
+    """
+    In-memory copy of the live animals of a simulation, patched by the mutations of SimulationClient so that reads
+    do not go back to the database
+    """
+
+    def __init__(self, animals_df: pd.DataFrame):
+        self.records = {record['oid']: record for record in animals_df.to_dict('records')}
+        self._frame = None
+
+    def add(self, record: Dict):
+        self.records[record['oid']] = record
+        self._frame = None
+
+    def update(self, oid: int, values: Dict):
+        record = self.records.get(oid)
+        if record is not None:
+            record.update(values)
+            self._frame = None
+
+    def remove(self, oid: int):
+        if self.records.pop(oid, None) is not None:
+            self._frame = None
+
+    def frame(self) -> pd.DataFrame:
+        """
+        Live animals in a DataFrame (built once per change), must not be modified
+        :return:
+        """
+        if self._frame is None:
+            self._frame = pd.DataFrame.from_records(list(self.records.values()), columns=ANIMAL_COLUMNS)
+        return self._frame
+
+
+class PopulationCounters:
+    """
+    Live fish and sharks of a simulation, with the births, deaths and meals (fish eaten) counted since the client
+    opened it, kept up to date by the mutations of SimulationClient
+    """
+    __slots__ = ('fish', 'shark', 'births', 'deaths', 'meals')
+
+    def __init__(self, fish: int = 0, shark: int = 0, births: int = 0, deaths: int = 0, meals: int = 0):
+        self.fish = fish
+        self.shark = shark
+        self.births = births
+        self.deaths = deaths
+        self.meals = meals
+
+    def born(self, animal_type: Animal, nb: int = 1):
+        if animal_type == Animal.Fish:
+            self.fish += nb
+        else:
+            self.shark += nb
+        self.births += nb
+
+    def died(self, animal_type: Animal, nb: int = 1):
+        if animal_type == Animal.Fish:
+            self.fish -= nb
+        else:
+            self.shark -= nb
+        self.deaths += nb
+
+    def copy(self) -> 'PopulationCounters':
+        return PopulationCounters(**self.to_dict())
+
+    def to_dict(self) -> Dict:
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+class _TurnUnitOfWork:
+    """
+    View of the live animals of a simulation during a turn transaction, built on the in-memory snapshot of the client.
+    Mutations patch the snapshot and are written when the turn commits: changed animals with one executemany, new
+    animals with another. New animals get provisional (negative) oids until then, other simulations may be adding
+    animals to the same table.
+    """
+
+    def __init__(self, session, sim_id: int, snapshot: AnimalSnapshot, turn: int = SETUP_TURN):
+        self.session = session
+        self.sim_id = sim_id
+        self.turn = turn
+        self.snapshot = snapshot
+        # events of the turn, written in bulk with the turn
+        self.events = []
+        self.grid_size = session.query(Simulation.grid_size).filter(Simulation.sid == sim_id).scalar()
+        if self.grid_size is None:
+            raise ValueError("Simulation {} doesn't exist!".format(sim_id))
+        self.occupied = {(a['coord_x'], a['coord_y']): a for a in self.animals.values()}
+        # provisional oid to record of the new animals, and oid to record of the changed ones (dead ones included)
+        self.births = dict()
+        self.changed = dict()
+
+    @property
+    def animals(self) -> Dict[int, Dict]:
+        """
+        Records of the live animals by oid
+        """
+        return self.snapshot.records
+
+    def get(self, oid: int) -> Dict:
+        """
+        Record of an animal, read from the database if it is not alive
+        """
+        animal = self.animals.get(oid)
+        if animal is None:
+            animal = _animal_record(self.session.query(Animals).filter(Animals.sim_id == self.sim_id,
+                                                                       Animals.oid == oid).one())
+        return animal
+
+    def add(self, animal_type: Animal, x: int, y: int, spawn_turn: int, last_fed: int, last_breed: int) -> int:
+        oid = -len(self.births) - 1
+        animal = {'oid': oid, 'sim_id': self.sim_id, 'animal_type': animal_type, 'spawn_turn': spawn_turn,
+                  'breed_count': 0, 'last_breed': last_breed, 'alive': True, 'last_fed': last_fed,
+                  'coord_x': x, 'coord_y': y}
+        self.births[oid] = animal
+        self.snapshot.add(animal)
+        self.occupied[(x, y)] = animal
+        return oid
+
+    def kill(self, animal: Dict):
+        if self.occupied.get((animal['coord_x'], animal['coord_y'])) is animal:
+            del self.occupied[(animal['coord_x'], animal['coord_y'])]
+        self.snapshot.remove(animal['oid'])
+        self.update(animal, {'alive': False})
+
+    def move(self, animal: Dict, x: int, y: int):
+        if self.occupied.get((animal['coord_x'], animal['coord_y'])) is animal:
+            del self.occupied[(animal['coord_x'], animal['coord_y'])]
+        self.update(animal, {'coord_x': x, 'coord_y': y})
+        self.occupied[(x, y)] = animal
+
+    def update(self, animal: Dict, values: Dict):
+        if animal['oid'] in self.animals:
+            self.snapshot.update(animal['oid'], values)
+        else:
+            animal.update(values)
+        if animal['oid'] > 0:
+            self.changed[animal['oid']] = animal
+
+    def write(self):
+        """
+        Write the changes of the turn: new animals get their oids, in the snapshot and in the buffered events
+        :return:
+        """
+        table = Animals.__table__
+        if len(self.changed) > 0:
+            stmt = table.update().where(table.c.oid == bindparam('b_oid')).where(table.c.sim_id == self.sim_id)
+            self.session.execute(stmt, [{'b_oid': oid, **{column: animal[column] for column in _TURN_COLUMNS}}
+                                        for oid, animal in self.changed.items()])
+        if len(self.births) == 0:
+            return
+        births = list(self.births.values())
+        rows = [{column: animal[column] for column in ANIMAL_COLUMNS if column not in ('oid', 'sim_id')}
+                for animal in births]
+        oids = SimulationClient._insert_animals(self.session, sim_id=self.sim_id, rows=rows)
+        provisional = dict()
+        for animal, oid in zip(births, oids):
+            provisional[animal['oid']] = oid
+            if animal['alive']:
+                self.snapshot.remove(animal['oid'])
+                animal['oid'] = oid
+                self.snapshot.add(animal)
+            else:
+                animal['oid'] = oid
+        for event in self.events:
+            event['oid'] = provisional.get(event['oid'], event['oid'])
+
+
 class SimulationClient(SQLAlchemyQueries):
-    def __init__(self, database_url):
-        super().__init__(database_url=database_url, declarative_base=Base, expire_on_commit=False)
+    def __init__(self, database_url, record_events: bool = False, pool_size: int = POOL_SIZE,
+                 max_overflow: int = MAX_OVERFLOW):
+        """
+        :param database_url:
+        :param record_events: log births, moves, deaths and feedings in the ANIMAL_EVENTS table
+        :param pool_size: connections kept open to the database, shared by the clients of the process (see get_engine)
+        :param max_overflow: see get_engine
+        """
+        super().__init__(database_url=database_url, declarative_base=Base, expire_on_commit=False,
+                         pool_size=pool_size, max_overflow=max_overflow)
+        self.record_events = record_events
+        # tables created before the indexes were declared do not get them from create_all
+        self.create_indexes(list(Animals.__table__.indexes) + list(AnimalEvents.__table__.indexes))
+        self._uow = None
+        # live animals of each simulation, kept in memory and patched by every mutation below: this assumes the
+        # client is the only writer of its simulations (call invalidate_snapshot otherwise)
+        self._snapshots = dict()
+        self._versions = dict()
+        self._counters = dict()
+
+    def animals_version(self, sim_id: int) -> int:
+        """
+        Counter increased by every change of the animals of a simulation made through this client
+        :param sim_id:
+        :return:
+        """
+        return self._versions.get(sim_id, 0)
+
+    def invalidate_snapshot(self, sim_id: Optional[int] = None):
+        """
+        Drop the in-memory snapshot and population counters of a simulation (all of them if sim_id is None),
+        e.g. after the database has been changed by another client
+        :param sim_id:
+        :return:
+        """
+        if sim_id is None:
+            self._snapshots.clear()
+            self._counters.clear()
+        else:
+            self._snapshots.pop(sim_id, None)
+            self._counters.pop(sim_id, None)
+
+    def _snapshot(self, sim_id: int) -> AnimalSnapshot:
+        """
+        Snapshot of the live animals of a simulation, loaded with one read the first time
+        """
+        if sim_id not in self._snapshots:
+            self._snapshots[sim_id] = AnimalSnapshot(animals_frame(self.read_animals(sim_id)))
+        return self._snapshots[sim_id]
+
+    def read_animals(self, sim_id: int, animal_type: Optional[Animal] = None, live_only: bool = True) -> np.ndarray:
+        """
+        Animals of a simulation straight from the database (the snapshot is neither used nor updated), in oid order:
+        rows are fetched from the DBAPI cursor into a numpy structured array, without ORM objects or pandas
+        :param sim_id:
+        :param animal_type: all types if None
+        :param live_only:
+        :return: ANIMAL_DTYPE array, animal_type as its Animal value (see animals_frame for a DataFrame)
+        """
+        params = {'sim_id': sim_id}
+        if animal_type is not None:
+            params['animal_type'] = animal_type
+        with self.session_scope() as s:
+            result = s.connection().execute(_READ_ANIMALS[(live_only, animal_type is not None)], params)
+            try:
+                rows = result.cursor.fetchall()
+            finally:
+                result.close()
+        return np.fromiter(rows, dtype=ANIMAL_DTYPE, count=len(rows))
+
+    def read_animal_columns(self, sim_id: int, animal_type: Optional[Animal] = None,
+                            live_only: bool = True) -> Dict[str, np.ndarray]:
+        """
+        read_animals as one typed array per column
+        :return: column name to array
+        """
+        animals = self.read_animals(sim_id=sim_id, animal_type=animal_type, live_only=live_only)
+        return {column: animals[column] for column in ANIMAL_COLUMNS}
+
+    def population_counters(self, sim_id: int) -> PopulationCounters:
+        """
+        Population counters of a simulation, counted in the database the first time only
+        (mutations get them before changing anything, so that the change is not counted twice)
+        :param sim_id:
+        :return:
+        """
+        if sim_id not in self._counters:
+            counters = PopulationCounters()
+            with self.session_scope() as s:
+                for animal_type, nb in s.query(Animals.animal_type, func.count(Animals.oid))\
+                        .filter(Animals.sim_id == sim_id, Animals.alive).group_by(Animals.animal_type):
+                    setattr(counters, 'fish' if animal_type == Animal.Fish else 'shark', nb)
+            self._counters[sim_id] = counters
+        return self._counters[sim_id]
+
+    def _changed(self, sim_id: int) -> Optional[AnimalSnapshot]:
+        """
+        Record a change of the animals of a simulation
+        :return: the snapshot to patch, if loaded
+        """
+        self._versions[sim_id] = self.animals_version(sim_id) + 1
+        return self._snapshots.get(sim_id)
+
+    @contextmanager
+    def turn_transaction(self, sim_id: int, turn: int = SETUP_TURN):
+        """
+        Unit of work for a simulation turn: mutations of this simulation are buffered in memory and written with
+        a handful of bulk statements and a single commit when leaving the context. Any error rolls the whole turn back.
+        :param sim_id:
+        :param turn: turn of the events logged during the transaction
+        :return:
+        """
+        if self._uow is not None:
+            raise ImpossibleAction('A turn transaction is already open for simulation {}'.format(self._uow.sim_id))
+        counters = self.population_counters(sim_id).copy()
+        try:
+            with self.transaction() as s:
+                self._uow = _TurnUnitOfWork(session=s, sim_id=sim_id, snapshot=self._snapshot(sim_id), turn=turn)
+                try:
+                    yield self._uow
+                    self._uow.write()
+                    self._write_events(s, sim_id=sim_id, turn=turn, events=self._uow.events)
+                finally:
+                    self._uow = None
+        except Exception:
+            # changes were rolled back, snapshot cannot be trusted anymore
+            self._changed(sim_id)
+            self.invalidate_snapshot(sim_id)
+            self._counters[sim_id] = counters
+            raise
+
+    def _turn_uow(self, sim_id: int) -> Optional[_TurnUnitOfWork]:
+        """
+        Open unit of work of this simulation, if any
+        """
+        if self._uow is not None and self._uow.sim_id == sim_id:
+            return self._uow
+        return None
+
+    @staticmethod
+    def _write_events(session, sim_id: int, turn: int, events: List[Dict]):
+        if len(events) > 0:
+            session.execute(AnimalEvents.__table__.insert(), [dict(e, sim_id=sim_id, turn=turn) for e in events])
+
+    def _log_events(self, sim_id: int, events: List[Dict], turn: Optional[int] = None):
+        """
+        Log animal events (see _event): buffered until the end of the turn transaction if one is open,
+        written right away otherwise
+        :param sim_id:
+        :param events:
+        :param turn: turn of the events, SETUP_TURN if None and no turn transaction is open
+        :return:
+        """
+        if not self.record_events or len(events) == 0:
+            return
+        uow = self._turn_uow(sim_id)
+        if uow is not None and turn is None:
+            uow.events.extend(events)
+            return
+        with self.session_scope() as s:
+            self._write_events(s, sim_id=sim_id, turn=SETUP_TURN if turn is None else turn, events=events)
+
+    def get_events(self, sim_id: int, from_turn: Optional[int] = None, to_turn: Optional[int] = None) -> pd.DataFrame:
+        """
+        Logged events of a simulation, in the order they happened
+        :param sim_id:
+        :param from_turn: first turn included (all if None)
+        :param to_turn: last turn excluded (all if None)
+        :return:
+        """
+        with self.session_scope() as s:
+            q = s.query(AnimalEvents).filter(AnimalEvents.sim_id == sim_id)
+            if from_turn is not None:
+                q = q.filter(AnimalEvents.turn >= from_turn)
+            if to_turn is not None:
+                q = q.filter(AnimalEvents.turn < to_turn)
+            return pd.read_sql(q.order_by(AnimalEvents.eid).statement, s.connection())
+
+    def last_turn(self, sim_id: int) -> Optional[int]:
+        """
+        Last turn with logged events (None if the simulation has no event log): the live animals are the ones of the
+        start of the next turn
+        :param sim_id:
+        :return:
+        """
+        with self.session_scope() as s:
+            return s.query(func.max(AnimalEvents.turn)).filter(AnimalEvents.sim_id == sim_id).scalar()
+
+    def read_turn_animals(self, sim_id: int) -> Tuple[Optional[int], np.ndarray]:
+        """
+        Live animals straight from the database (see read_animals) with the last turn they follow (see last_turn),
+        read in one transaction. The last turn is read again after the animals, and both are read again if a turn was
+        committed in between (databases not isolating the reads of a transaction)
+        :param sim_id:
+        :return: last turn, ANIMAL_DTYPE array
+        """
+        with self.transaction():
+            last_turn = self.last_turn(sim_id)
+            while True:
+                animals = self.read_animals(sim_id)
+                turn = self.last_turn(sim_id)
+                if turn == last_turn:
+                    return last_turn, animals
+                last_turn = turn
+
+    def population_history(self, sim_id: int) -> pd.DataFrame:
+        """
+        Number of fish and sharks at the start of every turn, from the event log
+        :param sim_id:
+        :return: turn, fish, shark (no rows if the simulation has no event log)
+        """
+        with self.session_scope() as s:
+            q = s.query(AnimalEvents.turn, AnimalEvents.oid, AnimalEvents.event, AnimalEvents.animal_type)\
+                .filter(AnimalEvents.sim_id == sim_id, AnimalEvents.event.in_([AnimalEvent.Birth, AnimalEvent.Death]))
+            events = pd.read_sql(q.statement, s.connection())
+        if len(events) == 0:
+            return pd.DataFrame({'turn': [], 'fish': [], 'shark': []}, dtype=np.int64)
+        births = events[events.event == AnimalEvent.Birth]
+        events['animal_type'] = events.oid.map(births.set_index('oid').animal_type.map({Animal.Fish: 'fish',
+                                                                                          Animal.Shark: 'shark'}))
+        events['delta'] = np.where(events.event == AnimalEvent.Birth, 1, -1)
+        # births and deaths of a turn count from the start of the next one
+        events['turn'] = events.turn + 1
+        deltas = events.groupby(['turn', 'animal_type'])['delta'].sum().unstack(fill_value=0)
+        turns = np.arange(events.turn.min(), events.turn.max() + 1)
+        population = deltas.reindex(columns=['fish', 'shark'], fill_value=0).cumsum()\
+            .reindex(turns, method='ffill').astype(np.int64)
+        return population.rename_axis(columns=None).reset_index()
+
+    def rebuild_animals(self, sim_id: int, turn: int, checkpoints: Sequence[str] = ()) -> pd.DataFrame:
+        """
+        Live animals at the start of a turn (before it is played), from the nearest checkpoint (of this simulation,
+        saved at or before turn) plus the logged events since then (from the setup if there is no such checkpoint)
+        :param sim_id:
+        :param turn:
+        :param checkpoints: paths of .npz checkpoints (see fish_bowl.dataio.checkpoint)
+        :return: oid, animal_type, coord_x, coord_y of each live animal, in oid order
+        """
+        start = None
+        for path in checkpoints:
+            checkpoint = load_checkpoint(path)
+            if checkpoint.get('sim_id') == sim_id and checkpoint['turn'] <= turn and \
+                    (start is None or checkpoint['turn'] > start['turn']):
+                start = checkpoint
+        if start is None:
+            animals = pd.DataFrame({'oid': [], 'animal_type': [], 'coord_x': [], 'coord_y': []})
+            events = self.get_events(sim_id=sim_id, to_turn=turn)
+        else:
+            columns = start['animals']
+            animals = pd.DataFrame({'oid': start['oids'], 'animal_type': [Animal(t) for t in columns['animal_type']],
+                                    'coord_x': columns['coord_x'], 'coord_y': columns['coord_y']})
+            events = self.get_events(sim_id=sim_id, from_turn=start['turn'], to_turn=turn)
+        animals = animals.set_index('oid')
+        births = events[events.event == AnimalEvent.Birth].set_index('oid')
+        animals = pd.concat([animals, births[['animal_type', 'coord_x', 'coord_y']]])
+        # position after the last birth or move of each animal
+        positions = events[events.event.isin([AnimalEvent.Birth, AnimalEvent.Move])].groupby('oid').last()
+        animals.loc[positions.index, ['coord_x', 'coord_y']] = positions[['coord_x', 'coord_y']].values
+        dead = events.loc[events.event == AnimalEvent.Death, 'oid']
+        animals = animals.drop(index=dead[dead.isin(animals.index)]).sort_index()
+        return animals.astype({'coord_x': np.int64, 'coord_y': np.int64}).reset_index()
 
     def init_simulation(self, grid_size, init_nb_fish, init_nb_shark, fish_breed_maturity, fish_breed_probability,
                         fish_speed, shark_breed_maturity, shark_breed_probability, shark_speed,
@@ -134,9 +657,10 @@ class SimulationClient(SQLAlchemyQueries):
         Retrieve all simulations in a panda DataFrame
         :return: DataFrame
         """
+        table = Simulation.__table__
         with self.session_scope() as s:
-            query = s.query(Simulation)
-            return pd.read_sql(query.statement, query.session.bind)
+            rows = s.connection().execute(select(table)).fetchall()
+        return pd.DataFrame.from_records(rows, columns=[column.name for column in table.columns])
 
     def init_animal(self, sim_id: int, current_turn: int, animal_type: Animal, coordinate: SquareGridCoordinate,
                     last_fed: Optional[int] = 0, last_breed: Optional[int] = 0):
@@ -144,6 +668,18 @@ class SimulationClient(SQLAlchemyQueries):
         use for single animal init
         :return:
         """
+        counters = self.population_counters(sim_id)
+        uow = self._turn_uow(sim_id)
+        if uow is not None:
+            square_grid_valid(grid_size=uow.grid_size, coordinates=coordinate)
+            if (coordinate.x, coordinate.y) in uow.occupied:
+                raise NonEmptyCoordinate('Coordinate {} is occupied'.format(coordinate))
+            oid = uow.add(animal_type, int(coordinate.x), int(coordinate.y), spawn_turn=current_turn,
+                          last_fed=last_fed, last_breed=last_breed)
+            self._changed(sim_id)
+            self._log_events(sim_id, [_event(oid, AnimalEvent.Birth, coordinate.x, coordinate.y, animal_type)])
+            counters.born(animal_type)
+            return oid
 
         with self.session_scope() as s:
             try:
@@ -161,8 +697,104 @@ class SimulationClient(SQLAlchemyQueries):
                                  breed_count=0, last_breed=last_breed, alive=True, last_fed=last_fed,
                                  coord_x=coordinate.x, coord_y=coordinate.y)
             s.add(new_animal)
+        snapshot = self._changed(sim_id)
+        if snapshot is not None:
+            snapshot.add(_animal_record(new_animal))
+        self._log_events(sim_id, [_event(new_animal.oid, AnimalEvent.Birth, coordinate.x, coordinate.y, animal_type)])
+        counters.born(animal_type)
         return new_animal.oid
 
+    def init_animals(self, sim_id: int, animal_types: Union[Animal, Sequence[Animal]],
+                     coord_x: Sequence[int], coord_y: Sequence[int], spawn_turn: Union[int, Sequence[int]],
+                     last_fed: Union[int, Sequence[int]] = 0, last_breed: Union[int, Sequence[int]] = 0) -> List[int]:
+        """
+        use for bulk animal init: coordinates are checked in one pass and all animals are inserted in one transaction.
+        Scalar arguments apply to all animals.
+        :param sim_id:
+        :param animal_types:
+        :param coord_x:
+        :param coord_y:
+        :param spawn_turn:
+        :param last_fed:
+        :param last_breed:
+        :return: oids of the new animals, in input order
+        """
+        counters = self.population_counters(sim_id)
+        coord_x = np.asarray(coord_x, dtype=np.int64)
+        coord_y = np.asarray(coord_y, dtype=np.int64)
+        nb = len(coord_x)
+        if nb == 0:
+            return []
+        columns = {name: np.broadcast_to(np.asarray(values), (nb,)).tolist()
+                   for name, values in [('spawn_turn', spawn_turn), ('last_fed', last_fed), ('last_breed', last_breed)]}
+        if isinstance(animal_types, Animal):
+            animal_types = [animal_types] * nb
+        with self.session_scope() as s:
+            try:
+                simulation = s.query(Simulation).filter(Simulation.sid == sim_id).one()
+            except NoResultFound:
+                _logger.debug("Simulation {} doesn't exist!".format(sim_id))
+                raise ValueError("Simulation {} doesn't exist!".format(sim_id))
+            grid_size = simulation.grid_size
+            # Check coordinates match with the grid
+            outside = (coord_x < 0) | (coord_y < 0) | (coord_x >= grid_size) | (coord_y >= grid_size)
+            if outside.any():
+                idx = int(np.argmax(outside))
+                square_grid_valid(grid_size=grid_size, coordinates=SquareGridCoordinate(int(coord_x[idx]),
+                                                                                        int(coord_y[idx])))
+            # check coordinates are free, both within the batch and on the grid
+            cells = coord_x * grid_size + coord_y
+            unique_cells, counts = np.unique(cells, return_counts=True)
+            if (counts > 1).any():
+                x, y = divmod(int(unique_cells[np.argmax(counts > 1)]), grid_size)
+                raise NonEmptyCoordinate('Coordinate {} is used twice'.format(SquareGridCoordinate(x, y)))
+            uow = self._turn_uow(sim_id)
+            if uow is not None:
+                occupied = np.array([x * grid_size + y for x, y in uow.occupied], dtype=np.int64)
+            else:
+                occupied = np.array(s.query(Animals.coord_x * grid_size + Animals.coord_y)
+                                    .filter(Animals.sim_id == sim_id, Animals.alive).all(), dtype=np.int64).ravel()
+            taken = np.isin(cells, occupied)
+            if taken.any():
+                idx = int(np.argmax(taken))
+                raise NonEmptyCoordinate('Coordinate {} is occupied'.format(SquareGridCoordinate(int(coord_x[idx]),
+                                                                                                 int(coord_y[idx]))))
+            rows = [{'animal_type': animal_type, 'spawn_turn': spawn, 'breed_count': 0, 'last_breed': breed,
+                     'alive': True, 'last_fed': fed, 'coord_x': x, 'coord_y': y}
+                    for animal_type, spawn, breed, fed, x, y in zip(animal_types, columns['spawn_turn'],
+                                                                     columns['last_breed'], columns['last_fed'],
+                                                                     coord_x.tolist(), coord_y.tolist())]
+            if uow is not None:
+                oids = [uow.add(row['animal_type'], row['coord_x'], row['coord_y'], spawn_turn=row['spawn_turn'],
+                                last_fed=row['last_fed'], last_breed=row['last_breed']) for row in rows]
+            else:
+                oids = self._insert_animals(s, sim_id=sim_id, rows=rows)
+        snapshot = self._changed(sim_id)
+        if snapshot is not None and uow is None:
+            for oid, row in zip(oids, rows):
+                snapshot.add(dict(row, oid=oid, sim_id=sim_id))
+        self._log_events(sim_id, [_event(oid, AnimalEvent.Birth, row['coord_x'], row['coord_y'], row['animal_type'])
+                                  for oid, row in zip(oids, rows)])
+        nb_fish = sum(1 for animal_type in animal_types if animal_type == Animal.Fish)
+        counters.born(Animal.Fish, nb_fish)
+        counters.born(Animal.Shark, nb - nb_fish)
+        return oids
+
+    @staticmethod
+    def _insert_animals(session, sim_id: int, rows: List[Dict]) -> List[int]:
+        """
+        Insert animal rows with a single executemany
+        :param session:
+        :param sim_id:
+        :param rows:
+        :return: oids of the new animals, in the order of rows
+        """
+        max_oid = session.query(func.max(Animals.oid)).scalar() or 0
+        session.execute(Animals.__table__.insert(), [dict(row, sim_id=sim_id) for row in rows])
+        # oids are allocated in insertion order
+        return [oid for oid, in session.query(Animals.oid).filter(Animals.sim_id == sim_id,
+                                                                  Animals.oid > max_oid).order_by(Animals.oid)]
+
     def coordinate_is_occupied(self, sim_id: int, coordinate: SquareGridCoordinate) -> bool:
         """
         Check if coordinate is free for this epoch
@@ -170,6 +802,9 @@ class SimulationClient(SQLAlchemyQueries):
         :param coordinate:
         :return:
         """
+        uow = self._turn_uow(sim_id)
+        if uow is not None:
+            return (coordinate.x, coordinate.y) in uow.occupied
         with self.session_scope() as s:
             query = s.query(Animals).filter(Animals.sim_id == sim_id, Animals.coord_x == coordinate.x,
                                             Animals.coord_y == coordinate.y, Animals.alive)
@@ -208,19 +843,25 @@ class SimulationClient(SQLAlchemyQueries):
         :param animal_type:
         :return:
         """
-        with self.session_scope() as s:
-            q = s.query(Animals).filter(Animals.sim_id == sim_id, Animals.alive, Animals.animal_type == animal_type)
-            return pd.read_sql(q.statement, q.session.bind)
+        animals = self._snapshot(sim_id).frame()
+        return animals[animals.animal_type == animal_type].reset_index(drop=True)
 
     def get_animals_df(self, sim_id: int):
         """
-        Load all live animals from grid into a dataframe
+        Load all live animals from grid into a dataframe (served from the in-memory snapshot)
         :param sim_id:
         :return:
         """
-        with self.session_scope() as s:
-            q = s.query(Animals).filter(Animals.sim_id == sim_id, Animals.alive)
-            return pd.read_sql(q.statement, q.session.bind)
+        return self._snapshot(sim_id).frame().copy()
+
+    def get_fish_positions(self, sim_id: int) -> set:
+        """
+        Set of (x, y) tuples of the cells holding a live fish, in one read
+        :param sim_id:
+        :return:
+        """
+        fish_df = self.get_animals_by_type(sim_id=sim_id, animal_type=Animal.Fish)
+        return set(zip(fish_df.coord_x.tolist(), fish_df.coord_y.tolist()))
 
     def has_fish_in_square(self, sim_id: int, coordinates: List[SquareGridCoordinate]) -> List[SquareGridCoordinate]:
         """
@@ -229,13 +870,21 @@ class SimulationClient(SQLAlchemyQueries):
         :param coordinates:
         :return:
         """
-        fish_df = self.get_animals_by_type(sim_id=sim_id, animal_type=Animal.Fish)
-        has_fish = []
-        for coord in coordinates:
-            fta = fish_df[(fish_df.coord_x == coord.x) & (fish_df.coord_y == coord.y)]
-            if len(fta) > 0:
-                has_fish.append(SquareGridCoordinate(int(fta.iloc[0].coord_x), int(fta.iloc[0].coord_y)))
-        return has_fish
+        return self.has_fish_in_squares(sim_id=sim_id, coordinates=[coordinates])[0]
+
+    def has_fish_in_squares(self, sim_id: int, coordinates: List[List[SquareGridCoordinate]],
+                            fish_positions: Optional[set] = None) -> List[List[SquareGridCoordinate]]:
+        """
+        Batched version of has_fish_in_square: for each list of coordinates, return those where fish are present
+        :param sim_id:
+        :param coordinates:
+        :param fish_positions: fish position index (see get_fish_positions), read from the database if not provided
+        :return:
+        """
+        if fish_positions is None:
+            fish_positions = self.get_fish_positions(sim_id=sim_id)
+        return [[SquareGridCoordinate(int(c.x), int(c.y)) for c in coords if (c.x, c.y) in fish_positions]
+                for coords in coordinates]
 
     def update_animals(self, sim_id: int, update_dict: Dict):
         """
@@ -250,16 +899,44 @@ class SimulationClient(SQLAlchemyQueries):
         scope = list(update_dict.keys())
         if len(scope) == 0: # AM speed-up: do nothing if nothing to update
             return
-        with self.session_scope() as s:
-            animal_list = s.query(Animals).filter(Animals.sim_id == sim_id, Animals.alive).all()
-            for animal in animal_list:
-                if animal.oid in scope:
-                    for k, v in update_dict[animal.oid].items():
-                        if k in ['breed_count', 'last_breed', 'last_fed']:
-                            setattr(animal, k, v)
-                        else:
-                            _logger.error('Cannot update {} property with this method'.format(k))
-            s.flush()
+        updates = dict()
+        for oid, values in update_dict.items():
+            params = dict()
+            for k, v in values.items():
+                if k in ['breed_count', 'last_breed', 'last_fed']:
+                    params[k] = int(v)
+                else:
+                    _logger.error('Cannot update {} property with this method'.format(k))
+            if len(params) > 0:
+                updates[oid] = params
+        uow = self._turn_uow(sim_id)
+        if uow is not None:
+            for oid, params in list(updates.items()):
+                animal = uow.animals.get(oid)
+                if animal is None:
+                    del updates[oid]
+                    continue
+                uow.update(animal, params)
+        else:
+            # dead or unknown animals are left out, as in a turn transaction
+            live = self._snapshot(sim_id).records
+            updates = {oid: params for oid, params in updates.items() if oid in live}
+            # one executemany per set of updated columns, keyed by oid
+            batches = dict()
+            for oid, params in updates.items():
+                batches.setdefault(tuple(sorted(params)), []).append({'b_oid': int(oid), **params})
+            table = Animals.__table__
+            stmt = table.update().where(table.c.oid == bindparam('b_oid')).where(table.c.sim_id == sim_id)\
+                .where(table.c.alive)
+            with self.session_scope() as s:
+                for params in batches.values():
+                    s.execute(stmt, params)
+        snapshot = self._changed(sim_id)
+        if snapshot is not None and uow is None:
+            for oid, params in updates.items():
+                snapshot.update(oid, params)
+        self._log_events(sim_id, [_event(oid, AnimalEvent.Feed) for oid, params in updates.items()
+                                  if 'last_fed' in params])
         return
 
     def kill_animal(self, sim_id: int, animal_ids: List[int]) -> set:
@@ -269,15 +946,35 @@ class SimulationClient(SQLAlchemyQueries):
         :param animal_ids:
         :return: set with coord tuples to remove (will need to update list of occupied coordinates)
         """
-        with self.session_scope() as s:
-            animal_list = s.query(Animals).filter(Animals.sim_id == sim_id, Animals.alive).all()
-            coord_set = set()
-            for animal in animal_list:
-                if animal.oid in animal_ids:
-                    animal.alive = False
-                    coord_set.add((animal.coord_x, animal.coord_y))
-            s.flush()
-        return coord_set
+        counters = self.population_counters(sim_id)
+        uow = self._turn_uow(sim_id)
+        killed = []  # (oid, x, y, animal_type)
+        if uow is not None:
+            for oid in animal_ids:
+                animal = uow.animals.get(oid)
+                if animal is not None:
+                    uow.kill(animal)
+                    killed.append((oid, animal['coord_x'], animal['coord_y'], animal['animal_type']))
+        else:
+            table = Animals.__table__
+            columns = [table.c.oid, table.c.coord_x, table.c.coord_y, table.c.animal_type]
+            with self.session_scope() as s:
+                for oids in _chunks([int(oid) for oid in animal_ids], MAX_IN_PARAMS):
+                    where = (table.c.sim_id == sim_id) & table.c.alive & table.c.oid.in_(oids)
+                    stmt = table.update().where(where).values(alive=False)
+                    if s.bind.dialect.full_returning:
+                        killed.extend(tuple(r) for r in s.execute(stmt.returning(*columns)))
+                    else:
+                        killed.extend(tuple(r) for r in s.execute(select(*columns).where(where)))
+                        s.execute(stmt)
+        snapshot = self._changed(sim_id)
+        if snapshot is not None and uow is None:
+            for oid in animal_ids:
+                snapshot.remove(oid)
+        self._log_events(sim_id, [_event(oid, AnimalEvent.Death, x, y) for oid, x, y, _ in killed])
+        for _, _, _, animal_type in killed:
+            counters.died(animal_type)
+        return {(x, y) for oid, x, y, _ in killed}
 
     def eat_animal_in_square(self, sim_id: int, coordinate: SquareGridCoordinate):
         """
@@ -286,17 +983,34 @@ class SimulationClient(SQLAlchemyQueries):
         :param coordinate:
         :return:
         """
-        with self.session_scope() as s:
-            try:
-                eaten_animal = s.query(Animals).filter(Animals.sim_id == sim_id, Animals.alive,
-                                                       Animals.animal_type == Animal.Fish,
-                                                       Animals.coord_x == coordinate.x,
-                                                       Animals.coord_y == coordinate.y).one()
-                eaten_animal.alive = False
-                return True
-            except NoResultFound:
+        counters = self.population_counters(sim_id)
+        uow = self._turn_uow(sim_id)
+        if uow is not None:
+            eaten_animal = uow.occupied.get((coordinate.x, coordinate.y))
+            if eaten_animal is None or eaten_animal['animal_type'] != Animal.Fish:
                 _logger.warning('No Fish to eat in {}'.format(coordinate))
                 return False
+            uow.kill(eaten_animal)
+            eaten_oid = eaten_animal['oid']
+        else:
+            with self.session_scope() as s:
+                try:
+                    eaten_animal = s.query(Animals).filter(Animals.sim_id == sim_id, Animals.alive,
+                                                           Animals.animal_type == Animal.Fish,
+                                                           Animals.coord_x == coordinate.x,
+                                                           Animals.coord_y == coordinate.y).one()
+                    eaten_animal.alive = False
+                except NoResultFound:
+                    _logger.warning('No Fish to eat in {}'.format(coordinate))
+                    return False
+                eaten_oid = eaten_animal.oid
+        snapshot = self._changed(sim_id)
+        if snapshot is not None and uow is None:
+            snapshot.remove(eaten_oid)
+        self._log_events(sim_id, [_event(eaten_oid, AnimalEvent.Death, coordinate.x, coordinate.y)])
+        counters.died(Animal.Fish)
+        counters.meals += 1
+        return True
 
     def move_animal(self, sim_id: int, animal_id: int,
                     new_position: SquareGridCoordinate, occupied: bool=None):
@@ -315,16 +1029,98 @@ class SimulationClient(SQLAlchemyQueries):
 
         if occupied:
             raise NonEmptyCoordinate('Cannot move, coordinate {} is occupied'.format(new_position))
+        uow = self._turn_uow(sim_id)
+        if uow is not None:
+            square_grid_valid(grid_size=uow.grid_size, coordinates=new_position)
+            a_ = uow.get(animal_id)
+            if not a_['alive']:
+                raise ImpossibleAction('Attempting to move a dead animal: {}'.format(a_))
+            out = (a_['coord_x'], a_['coord_y'])
+            uow.move(a_, int(new_position.x), int(new_position.y))
         else:
             with self.session_scope() as s:
                 simulation = s.query(Simulation).filter(Simulation.sid == sim_id).one()
                 # Check coordinate match with the grid
                 square_grid_valid(grid_size=simulation.grid_size, coordinates=new_position)
                 a_ = s.query(Animals).filter(Animals.sim_id == sim_id, Animals.oid == animal_id).one()
-                if a_.alive:
-                    out = (a_.coord_x, a_.coord_y)
-                    a_.coord_x = new_position.x
-                    a_.coord_y = new_position.y
-                    return out
-                else:
+                if not a_.alive:
                     raise ImpossibleAction('Attempting to move a dead animal: {}'.format(a_))
+                out = (a_.coord_x, a_.coord_y)
+                a_.coord_x = new_position.x
+                a_.coord_y = new_position.y
+        snapshot = self._changed(sim_id)
+        if snapshot is not None and uow is None:
+            snapshot.update(animal_id, {'coord_x': int(new_position.x), 'coord_y': int(new_position.y)})
+        self._log_events(sim_id, [_event(animal_id, AnimalEvent.Move, new_position.x, new_position.y)])
+        return out
+
+    def _count_written_animals(self, counters: PopulationCounters, sim_id: int, new_animals: List[Dict],
+                               updated_animals: List[Dict], turn: Optional[int]):
+        """
+        Update the population counters after write_animals (recounted in the database if the type of an animal that
+        died is not given)
+        """
+        if any(not animal.get('alive', True) and 'animal_type' not in animal for animal in updated_animals):
+            self._counters.pop(sim_id, None)
+            return
+        for animal in new_animals:
+            counters.born(animal['animal_type'])
+            if not animal['alive']:
+                counters.died(animal['animal_type'])
+        for animal in updated_animals:
+            if not animal.get('alive', True):
+                counters.died(animal['animal_type'])
+            elif turn is not None and animal.get('last_fed') == turn and animal.get('animal_type') == Animal.Shark:
+                counters.meals += 1
+
+    def write_animals(self, sim_id: int, new_animals: List[Dict], updated_animals: List[Dict],
+                      turn: Optional[int] = None) -> List[int]:
+        """
+        Bulk write of animals kept outside of the database (see fish_bowl.process.array_engine), in one transaction
+        :param sim_id:
+        :param new_animals: column values of animals to insert
+        :param updated_animals: column values of animals to update, keyed by their 'oid'
+        :param turn: turn of the changes, for the event log (new animals are births, updated ones deaths or, if their
+        coordinates changed, moves, and feedings if last_fed is turn), written in the same transaction
+        :return: oids of the inserted animals, in the order of new_animals
+        """
+        counters = self.population_counters(sim_id)
+        table = Animals.__table__
+        new_oids = []
+        with self.session_scope() as s:
+            # coordinates before the update, to log moves of the animals that did move only
+            previous = dict()
+            if self.record_events and len(updated_animals) > 0:
+                columns = [table.c.oid, table.c.coord_x, table.c.coord_y]
+                for oids in _chunks([int(animal['oid']) for animal in updated_animals], MAX_IN_PARAMS):
+                    previous.update((oid, (x, y)) for oid, x, y in s.execute(
+                        select(*columns).where((table.c.sim_id == sim_id) & table.c.oid.in_(oids))))
+            if len(new_animals) > 0:
+                new_oids = self._insert_animals(s, sim_id=sim_id, rows=new_animals)
+            if len(updated_animals) > 0:
+                stmt = table.update().where(table.c.oid == bindparam('b_oid'))
+                s.execute(stmt, [{'b_oid': animal['oid'], **{k: v for k, v in animal.items() if k != 'oid'}}
+                                 for animal in updated_animals])
+            if self.record_events:
+                events = []
+                for oid, animal in zip(new_oids, new_animals):
+                    events.append(_event(oid, AnimalEvent.Birth, animal['coord_x'], animal['coord_y'],
+                                         animal['animal_type']))
+                    if not animal['alive']:
+                        events.append(_event(oid, AnimalEvent.Death, animal['coord_x'], animal['coord_y']))
+                for animal in updated_animals:
+                    old_x, old_y = previous.get(int(animal['oid']), (None, None))
+                    x, y = animal.get('coord_x', old_x), animal.get('coord_y', old_y)
+                    if turn is not None and animal.get('last_fed') == turn:
+                        events.append(_event(animal['oid'], AnimalEvent.Feed))
+                    if not animal.get('alive', True):
+                        events.append(_event(animal['oid'], AnimalEvent.Death, x, y))
+                    elif (x, y) != (old_x, old_y):
+                        events.append(_event(animal['oid'], AnimalEvent.Move, x, y))
+                # in the session of the animals: both are committed, or neither
+                self._write_events(s, sim_id=sim_id, turn=SETUP_TURN if turn is None else turn, events=events)
+        self._changed(sim_id)
+        self._snapshots.pop(sim_id, None)
+        self._count_written_animals(counters, sim_id=sim_id, new_animals=new_animals,
+                                    updated_animals=updated_animals, turn=turn)
+        return new_oids
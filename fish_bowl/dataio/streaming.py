@@ -0,0 +1,208 @@
+"""
+Push the turns of a simulation to viewers: one keyframe (all live animals), then one delta per turn with the cells
+that changed, taken from the event log written by the simulation (see SimulationClient.record_events).
+A delta is applied in order: clear the died cells and the cells moved from, then fill the cells moved to and the
+born cells.
+"""
+import json
+import logging
+import queue
+import threading
+import time
+from typing import Dict, Iterator, List, Optional
+
+from fish_bowl.dataio.persistence import SimulationClient
+from fish_bowl.process.utils import AnimalEvent
+
+_logger = logging.getLogger(__name__)
+
+KEEPALIVE = ': keepalive\n\n'
+
+
+def sse_message(event: str, data: Dict, event_id: Optional[int] = None) -> str:
+    """
+    Server-Sent Events message
+    """
+    lines = ['event: {}'.format(event)]
+    if event_id is not None:
+        lines.append('id: {}'.format(event_id))
+    lines.append('data: {}'.format(json.dumps(data, separators=(',', ':'))))
+    return '\n'.join(lines) + '\n\n'
+
+
+class Subscriber:
+    """
+    Messages waiting to be sent to one viewer. When the viewer falls behind (max_pending messages waiting),
+    the pending deltas are dropped and replaced by a keyframe
+    """
+
+    def __init__(self, max_pending: int):
+        self.messages = queue.Queue(maxsize=max_pending)
+        self.skipped = 0
+
+    def get(self, timeout: float) -> Optional[str]:
+        try:
+            return self.messages.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class SimulationStream:
+    """
+    Turns of a simulation fanned out to its subscribers: the event log is read once per new turn whatever the number
+    of viewers. There is no background thread, polling is done by the subscribers' loops (at most once per
+    poll_interval), so the stream works with any client, including in-memory SQLite ones
+    """
+
+    def __init__(self, persistence: SimulationClient, sim_id: int, poll_interval: float = 0.5,
+                 max_pending: int = 16):
+        """
+        :param persistence: client of the database the simulation writes to
+        :param sim_id:
+        :param poll_interval: seconds between two looks for new turns
+        :param max_pending: messages buffered per subscriber before it gets a keyframe instead
+        """
+        self._persistence = persistence
+        self.sim_id = sim_id
+        self.poll_interval = poll_interval
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._subscribers = []
+        self._cells = None  # oid -> (animal type code, x, y) at the start of self.turn
+        self.turn = None
+        self._last_poll = 0.
+
+    def _load(self):
+        # the database is written by the simulation process: read it rather than the snapshot of this client, the
+        # animals and the turn together so that the deltas of the next turns are applied once
+        last_turn, animals = self._persistence.read_turn_animals(sim_id=self.sim_id)
+        if last_turn is None:
+            raise ValueError('Simulation {} has no event log to stream'.format(self.sim_id))
+        self._cells = {oid: (t, x, y) for oid, t, x, y in zip(animals['oid'].tolist(), animals['animal_type'].tolist(),
+                                                              animals['coord_x'].tolist(), animals['coord_y'].tolist())}
+        self.turn = last_turn + 1
+        self._last_poll = time.monotonic()
+
+    def keyframe(self) -> str:
+        return sse_message('keyframe', {'turn': self.turn, 'grid': list(self._cells.values())}, event_id=self.turn)
+
+    def subscribe(self) -> Subscriber:
+        """
+        New subscriber, its first message is a keyframe of the current turn
+        """
+        with self._lock:
+            if self._cells is None:
+                self._load()
+            subscriber = Subscriber(self.max_pending)
+            subscriber.messages.put_nowait(self.keyframe())
+            self._subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        with self._lock:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+            if len(self._subscribers) == 0:
+                # nobody to keep up to date, reload on the next subscription
+                self._cells = None
+
+    def _apply(self, turn: int, events: List[Dict]) -> Dict:
+        """
+        Apply the events of a turn to the cells
+        :return: the delta of the turn
+        """
+        before = dict()
+        for event in events:
+            oid = event['oid']
+            if oid not in before:
+                before[oid] = self._cells.get(oid)
+            if event['event'] == AnimalEvent.Birth:
+                self._cells[oid] = (event['animal_type'].value, int(event['coord_x']), int(event['coord_y']))
+            elif event['event'] == AnimalEvent.Move:
+                self._cells[oid] = (self._cells[oid][0], int(event['coord_x']), int(event['coord_y']))
+            elif event['event'] == AnimalEvent.Death:
+                self._cells.pop(oid, None)
+        delta = {'turn': turn + 1, 'died': [], 'moved': [], 'born': []}
+        for oid, old in before.items():
+            new = self._cells.get(oid)
+            if old is None and new is not None:
+                delta['born'].append(new)
+            elif old is not None and new is None:
+                delta['died'].append(old[1:])
+            elif old is not None and old[1:] != new[1:]:
+                delta['moved'].append(old[1:] + new[1:])
+        return delta
+
+    def poll(self, force: bool = False):
+        """
+        Look for turns played since the last poll and queue their deltas to the subscribers
+        :param force: do not wait for poll_interval
+        :return:
+        """
+        with self._lock:
+            if self._cells is None or (not force and time.monotonic() - self._last_poll < self.poll_interval):
+                return
+            self._last_poll = time.monotonic()
+            last_turn = self._persistence.last_turn(sim_id=self.sim_id)
+            if last_turn is None or last_turn < self.turn:
+                return
+            events = self._persistence.get_events(sim_id=self.sim_id, from_turn=self.turn, to_turn=last_turn + 1)
+            events['animal_type'] = events.animal_type.where(events.animal_type.notnull(), None)
+            by_turn = {turn: group.to_dict('records') for turn, group in events.groupby('turn')}
+            for turn in range(self.turn, last_turn + 1):
+                delta = self._apply(turn, by_turn.get(turn, []))
+                self.turn = turn + 1
+                self._publish(sse_message('delta', delta, event_id=self.turn))
+
+    def _publish(self, message: str):
+        for subscriber in self._subscribers:
+            try:
+                subscriber.messages.put_nowait(message)
+            except queue.Full:
+                # slow viewer: skip what it has not read yet and let it start again from the current turn
+                while True:
+                    try:
+                        subscriber.messages.get_nowait()
+                        subscriber.skipped += 1
+                    except queue.Empty:
+                        break
+                subscriber.messages.put_nowait(self.keyframe())
+
+    def messages(self, subscriber: Subscriber, keepalive: float = 15.) -> Iterator[str]:
+        """
+        Endless Server-Sent Events of a subscriber (unsubscribed when the iteration is closed)
+        :param subscriber:
+        :param keepalive: seconds without new turn after which a comment is sent, to detect closed connections
+        :return:
+        """
+        try:
+            idle = 0.
+            while True:
+                self.poll()
+                message = subscriber.get(timeout=self.poll_interval)
+                if message is not None:
+                    idle = 0.
+                    yield message
+                else:
+                    idle += self.poll_interval
+                    if idle >= keepalive:
+                        idle = 0.
+                        yield KEEPALIVE
+        finally:
+            self.unsubscribe(subscriber)
+
+
+def apply_delta(cells: Dict, delta: Dict) -> Dict:
+    """
+    Viewer side: apply a delta to the cells of the previous turn
+    :param cells: (x, y) -> animal type code
+    :param delta: data of a delta message
+    :return: the updated cells
+    """
+    for x, y in delta['died']:
+        cells.pop((x, y), None)
+    moving = [(cells.pop((x0, y0)), x1, y1) for x0, y0, x1, y1 in delta['moved']]
+    for animal_type, x, y in moving + [tuple(b) for b in delta['born']]:
+        cells[(x, y)] = animal_type
+    return cells
+
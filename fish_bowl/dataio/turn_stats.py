@@ -0,0 +1,252 @@
+import atexit
+import csv
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from fish_bowl.dataio.database import QueryStats
+
+_logger = logging.getLogger(__name__)
+
+PHASES = ['_check_deads', '_eat', '_breed_and_move', '_move']
+
+POPULATION_FIELDS = ['fish', 'shark', 'births', 'deaths', 'meals']
+
+TURN_STATS_FIELDS = ['sim_id', 'turn', 'turn_time'] + ['{}_time'.format(phase.lstrip('_')) for phase in PHASES] + \
+                    ['sql_statements', 'sql_rows_read', 'sql_rows_written', 'sql_driver_time'] + POPULATION_FIELDS
+
+
+class TurnStatsRecorder:
+    """
+    Build the stats record of a turn: wall time of the turn and of each phase (seconds),
+    statements, rows and driver time of the SQL issued during the turn, population at the end of the turn
+    """
+
+    def __init__(self, query_stats: Optional[QueryStats] = None):
+        """
+        :param query_stats: totals of the engine used by the simulation (no SQL figures if None)
+        """
+        self._query_stats = query_stats
+        self._record = None
+        self._start = None
+        self._sql_start = None
+
+    def start(self, sim_id: int, turn: int):
+        self._record = dict.fromkeys(TURN_STATS_FIELDS, 0)
+        self._record.update(sim_id=sim_id, turn=turn)
+        if self._query_stats is not None:
+            self._sql_start = self._query_stats.totals()
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name: str):
+        """
+        Add the time spent in the context to the phase
+        :param name: one of PHASES
+        :return:
+        """
+        timer = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._record['{}_time'.format(name.lstrip('_'))] += time.perf_counter() - timer
+
+    def stop(self, counters: Optional[Dict] = None) -> Dict:
+        """
+        :param counters: population counters of the simulation (see PopulationCounters.to_dict)
+        :return: the record of the turn
+        """
+        record = self._record
+        record['turn_time'] = time.perf_counter() - self._start
+        if counters is not None:
+            record.update((k, counters[k]) for k in POPULATION_FIELDS)
+        if self._query_stats is not None:
+            for k, v in self._query_stats.totals().items():
+                record['sql_{}'.format(k)] = v - self._sql_start[k]
+        self._record = None
+        return record
+
+
+class MemoryStatsSink:
+    """
+    Keep the turn stats records in a list
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def write(self, record: Dict):
+        self.records.append(record)
+
+    def close(self):
+        return
+
+
+class CsvStatsSink:
+    """
+    Append the turn stats records to a CSV file (header written if the file is new)
+    """
+
+    def __init__(self, path: str):
+        new_file = not os.path.isfile(path) or os.path.getsize(path) == 0
+        self._fp = open(path, 'a', newline='')
+        self._writer = csv.DictWriter(self._fp, fieldnames=TURN_STATS_FIELDS)
+        if new_file:
+            self._writer.writeheader()
+
+    def write(self, record: Dict):
+        self._writer.writerow(record)
+        self._fp.flush()
+
+    def close(self):
+        self._fp.close()
+
+
+class JsonlStatsSink:
+    """
+    Append the turn stats records to a JSON lines file
+    """
+
+    def __init__(self, path: str):
+        self._fp = open(path, 'a')
+
+    def write(self, record: Dict):
+        self._fp.write(json.dumps(record) + '\n')
+        self._fp.flush()
+
+    def close(self):
+        self._fp.close()
+
+
+class BufferedStatsWriter:
+    """
+    Keep records in memory and append them to a CSV or Parquet file every flush_every records and on close
+    (closed at interpreter exit if not done before). Parquet needs pyarrow and writes one row group per flush
+    """
+
+    def __init__(self, path: str, fields: List[str] = TURN_STATS_FIELDS, flush_every: int = 10,
+                 header: Optional[List[str]] = None):
+        """
+        :param path: .csv or .parquet file, csv files are appended to, parquet files overwritten
+        :param fields: record keys written, in order
+        :param flush_every: number of records buffered before they are written
+        :param header: csv column names (fields if None)
+        """
+        if flush_every < 1:
+            raise ValueError('flush_every must be at least 1, got {}'.format(flush_every))
+        self.path = path
+        self.fields = list(fields)
+        self.flush_every = flush_every
+        self._header = self.fields if header is None else list(header)
+        self._parquet = os.path.splitext(path)[1].lower() == '.parquet'
+        self._buffer = []
+        self._writer = None
+        self._closed = False
+        if self._parquet:
+            try:
+                import pyarrow  # noqa: F401
+            except ImportError:
+                raise ImportError('Writing parquet stats files needs pyarrow')
+            if os.path.isfile(path):
+                os.remove(path)
+        atexit.register(self.close)
+
+    def write(self, record: Dict):
+        if self._closed:
+            raise ValueError('Stats writer of {} is closed'.format(self.path))
+        self._buffer.append(record)
+        if len(self._buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if len(self._buffer) == 0:
+            return
+        rows, self._buffer = self._buffer, []
+        if self._parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pydict({f: [r.get(f) for r in rows] for f in self.fields})
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(self.path, table.schema)
+            self._writer.write_table(table)
+            return
+        new_file = not os.path.isfile(self.path) or os.path.getsize(self.path) == 0
+        with open(self.path, 'a', newline='') as fp:
+            writer = csv.writer(fp)
+            if new_file:
+                writer.writerow(self._header)
+            writer.writerows([r.get(f) for f in self.fields] for r in rows)
+
+    def close(self):
+        if self._closed:
+            return
+        self.flush()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._closed = True
+        atexit.unregister(self.close)
+
+
+def stats_sink(path: str):
+    """
+    File sink matching the extension of path (.csv, .jsonl or .parquet, the latter buffered)
+    :param path:
+    :return:
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        return CsvStatsSink(path)
+    if extension in ['.jsonl', '.json']:
+        return JsonlStatsSink(path)
+    if extension == '.parquet':
+        return BufferedStatsWriter(path)
+    raise ValueError('Unsupported stats file {}, use .csv, .jsonl or .parquet'.format(path))
+
+
+_population_writers = {}
+
+
+def persist_population(filename: str, turn: int, counters):
+    """
+    Append the population of a turn to a csv file, through a buffered writer kept per file
+    :param filename:
+    :param turn:
+    :param counters: PopulationCounters of the simulation
+    :return:
+    """
+    writer = _population_writers.get(filename)
+    if writer is None or writer._closed:
+        writer = BufferedStatsWriter(filename, fields=['turn', 'fish', 'shark'], header=['Turn', 'Fish', 'Sharks'])
+        _population_writers[filename] = writer
+    writer.write({'turn': turn, 'fish': counters.fish, 'shark': counters.shark})
+
+
+def _csv_value(field: str, value: str):
+    """
+    Typed value of a CSV stats field, None for an empty one (e.g. sim_id of runs without persistence)
+    :param field:
+    :param value:
+    :return:
+    """
+    if value == '':
+        return None
+    return float(value) if field.endswith('_time') else int(value)
+
+
+def read_stats(path: str) -> List[Dict]:
+    """
+    Read back the records of a CSV, JSONL or Parquet stats file
+    :param path:
+    :return:
+    """
+    if os.path.splitext(path)[1].lower() == '.parquet':
+        import pyarrow.parquet as pq
+        return pq.read_table(path).to_pylist()
+    with open(path, 'r') as fp:
+        if os.path.splitext(path)[1].lower() == '.csv':
+            return [{k: _csv_value(k, v) for k, v in row.items()} for row in csv.DictReader(fp)]
+        return [json.loads(line) for line in fp if line.strip()]
@@ -0,0 +1,119 @@
+"""
+Write-behind persistence: a simulation kept in memory hands the changes of each turn to a background thread which
+writes them to the database, so that the next turn is computed while the previous one is written.
+
+The queue between them is bounded: when the writer falls behind, the simulation blocks on submit until a slot frees
+(backpressure) instead of piling up changes in memory. The writer drains the changes waiting in the queue and writes
+them in a single transaction. flush blocks until everything submitted is in the database, close flushes and stops
+the thread (done at interpreter exit if not before). A write error stops the writing: it is raised by the next submit,
+flush or close, and the changes of the failed transaction are rolled back.
+"""
+import atexit
+import logging
+import queue
+import threading
+from contextlib import nullcontext
+from typing import Callable, Optional
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_PENDING = 8
+DEFAULT_MAX_BATCH = 16
+
+_STOP = object()
+
+
+class WriteBehindWriter:
+    """
+    Background thread applying write(job) to the jobs submitted, in order
+    """
+
+    def __init__(self, write: Callable, transaction: Optional[Callable] = None, max_pending: int = DEFAULT_MAX_PENDING,
+                 max_batch: int = DEFAULT_MAX_BATCH, name: str = 'write-behind'):
+        """
+        :param write: called with each job, from the writer thread only
+        :param transaction: context manager factory wrapping each batch of writes (e.g. SimulationClient.transaction)
+        :param max_pending: number of jobs waiting before submit blocks
+        :param max_batch: largest number of jobs written in one transaction
+        :param name: name of the thread
+        """
+        if max_pending < 1 or max_batch < 1:
+            raise ValueError('max_pending and max_batch must be at least 1, got {} and {}'.format(max_pending,
+                                                                                                 max_batch))
+        self._write = write
+        self._transaction = transaction or nullcontext
+        self.max_batch = max_batch
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._closed = False
+        self.batches = 0  # transactions committed
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.max_batch and batch[-1] is not _STOP:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            jobs = [job for job in batch if job is not _STOP]
+            try:
+                if self._error is None and len(jobs) > 0:
+                    with self._transaction():
+                        for job in jobs:
+                            self._write(job)
+                    self.batches += 1
+            except Exception as e:
+                _logger.exception('Write-behind writer failed, dropping the changes submitted from now on')
+                self._error = e
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            if batch[-1] is _STOP:
+                return
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError('Write-behind writer failed: {}'.format(self._error)) from self._error
+
+    def submit(self, job):
+        """
+        Queue a job, blocking while max_pending jobs are waiting
+        :param job:
+        :return:
+        """
+        if self._closed:
+            raise ValueError('Write-behind writer is closed')
+        self._raise_error()
+        self._queue.put(job)
+
+    @property
+    def pending(self) -> int:
+        """
+        Number of jobs waiting for the writer
+        """
+        return self._queue.qsize()
+
+    def flush(self):
+        """
+        Block until all the jobs submitted are written
+        :return:
+        """
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        """
+        Write the jobs submitted and stop the thread
+        :return:
+        """
+        if self._closed:
+            return
+        self._closed = True
+        atexit.unregister(self.close)
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._raise_error()
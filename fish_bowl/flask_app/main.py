@@ -1,39 +1,174 @@
 import logging
-from flask import Flask, jsonify
+import os
+import threading
+from collections import OrderedDict
 
+from flask import Flask, Response, abort, jsonify, request
+from sqlalchemy.orm.exc import NoResultFound
+
+from fish_bowl.dataio.frames import FRAME_FORMATS, encode_frame, frame_json
+from fish_bowl.dataio.persistence import SimulationClient, animals_frame, get_database_string
+from fish_bowl.dataio.streaming import SimulationStream
 
 _logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
+SIMULATION_FIELDS = ['sid', 'grid_size', 'init_nb_fish', 'fish_breed_maturity', 'fish_breed_probability',
+                     'fish_speed', 'init_nb_shark', 'shark_breed_maturity', 'shark_breed_probability', 'shark_speed',
+                     'shark_starving']
+FRAME_CACHE_SIZE = 64  # encoded frames kept in memory, keyed by simulation, turn and format
+
+
+def _simulation_dict(simulation) -> dict:
+    values = {f: getattr(simulation, f) for f in SIMULATION_FIELDS}
+    values['timestamp'] = None if simulation.timestamp is None else simulation.timestamp.isoformat()
+    return values
+
+
+def create_app(persistence: SimulationClient, poll_interval: float = 0.5) -> Flask:
+    """
+    REST service reading the simulations of a database, written by another process (simulations must log their
+    events, see SimulationClient.record_events, to be served at past turns and to get an ETag per turn):
+    - GET /simulations: simulations with their last turn
+    - GET /simulations/<sid>: parameters, last turn and current population
+    - GET /simulations/<sid>/grid?turn=&format=json|packed|varint: live animals at the start of a turn
+      (current grid if no turn), see fish_bowl.dataio.frames for the encodings
+    - GET /simulations/<sid>/population: number of fish and sharks at the start of every turn
+    - GET /simulations/<sid>/stream: Server-Sent Events, a keyframe then the delta of every new turn
+      (see fish_bowl.dataio.streaming)
+    Grid and population responses carry an ETag of the turn, a poll with a matching If-None-Match gets a 304
+    after a single query
+    :param persistence: client of the database
+    :param poll_interval: seconds between two looks for new turns of the streams
+    :return:
+    """
+    app = Flask(__name__)
+    frames = OrderedDict()
+    frames_lock = threading.Lock()  # requests are served by concurrent threads
+    streams = dict()
+    streams_lock = threading.Lock()
+
+    def get_simulation(sim_id: int):
+        try:
+            return persistence.get_simulation(sim_id=sim_id)
+        except NoResultFound:
+            abort(404, 'Unknown simulation {}'.format(sim_id))
+
+    def not_modified(etag: str):
+        if etag is not None and request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+        return None
+
+    def load_frame(simulation, turn, last_turn, fmt: str) -> bytes:
+        key = (simulation.sid, turn, fmt)
+        if turn is not None:
+            with frames_lock:
+                if key in frames:
+                    frames.move_to_end(key)
+                    return frames[key]
+        animals = None
+        if turn is None or turn == last_turn + 1:
+            # the database is written by the simulation process: never trust the snapshot of this client
+            read_turn, current = persistence.read_turn_animals(sim_id=simulation.sid)
+            if turn is None or read_turn == last_turn:
+                animals = animals_frame(current, enum=False)
+        if animals is None:
+            # a past turn, or turns were played since last_turn was read
+            animals = persistence.rebuild_animals(sim_id=simulation.sid, turn=turn)
+        if fmt == 'json':
+            data = app.json.dumps(frame_json(animals, sim_id=simulation.sid, turn=turn)).encode()
+        else:
+            data = encode_frame(animals, grid_size=simulation.grid_size, fmt=fmt)
+        if turn is not None:
+            with frames_lock:
+                frames[key] = data
+                frames.move_to_end(key)
+                while len(frames) > FRAME_CACHE_SIZE:
+                    frames.popitem(last=False)
+        return data
+
+    @app.route('/')
+    def welcome():
+        return 'Welcome to Simulation Rest Service'
+
+    @app.route('/simulations')
+    def list_simulations():
+        simulations = persistence.get_all_simulations()
+        simulations['timestamp'] = simulations.timestamp.map(lambda t: None if t is None else t.isoformat())
+        records = simulations[SIMULATION_FIELDS + ['timestamp']].to_dict('records')
+        for record in records:
+            record['last_turn'] = persistence.last_turn(sim_id=record['sid'])
+        return jsonify(records)
 
+    @app.route('/simulations/<int:sim_id>')
+    def simulation(sim_id: int):
+        values = _simulation_dict(get_simulation(sim_id))
+        persistence.invalidate_snapshot(sim_id=sim_id)
+        counters = persistence.population_counters(sim_id=sim_id)
+        values.update(last_turn=persistence.last_turn(sim_id=sim_id), fish=counters.fish, shark=counters.shark)
+        return jsonify(values)
 
-@app.route('/')
-def welcome():
-    return 'Welcome to Simulation Rest Service'
+    @app.route('/simulations/<int:sim_id>/grid')
+    def grid(sim_id: int):
+        fmt = request.args.get('format', 'json')
+        if fmt not in FRAME_FORMATS:
+            abort(400, 'Unknown format {}, must be one of {}'.format(fmt, list(FRAME_FORMATS)))
+        turn = request.args.get('turn', type=int)
+        simulation = get_simulation(sim_id)
+        last_turn = persistence.last_turn(sim_id=sim_id)
+        if last_turn is None:
+            if turn is not None:
+                abort(404, 'Simulation {} has no event log, only its current grid is available'.format(sim_id))
+        else:
+            if turn is None:
+                turn = last_turn + 1
+            elif turn > last_turn + 1:
+                abort(404, 'Turn {} of simulation {} is not played yet'.format(turn, sim_id))
+        etag = None if turn is None else '{}-{}-{}'.format(sim_id, turn, fmt)
+        response = not_modified(etag)
+        if response is not None:
+            return response
+        response = Response(load_frame(simulation, turn, last_turn, fmt), mimetype=FRAME_FORMATS[fmt])
+        response.headers['X-Grid-Size'] = str(simulation.grid_size)
+        if turn is not None:
+            response.headers['X-Turn'] = str(turn)
+            response.set_etag(etag)
+        else:
+            response.add_etag()
+        return response.make_conditional(request)
 
+    @app.route('/simulations/<int:sim_id>/population')
+    def population(sim_id: int):
+        get_simulation(sim_id)
+        last_turn = persistence.last_turn(sim_id=sim_id)
+        etag = None if last_turn is None else 'population-{}-{}'.format(sim_id, last_turn)
+        response = not_modified(etag)
+        if response is not None:
+            return response
+        response = jsonify(persistence.population_history(sim_id=sim_id).to_dict('records'))
+        if etag is not None:
+            response.set_etag(etag)
+        return response
 
-@app.route('/getData')
-def get_test_data():
-    test_dict = {
-        'simulation': {'sim_id': 12, 'sim_turn': 2},
-        'meta': {'1': 'Fish', '2': 'Shark', 'data': ('type', 'x', 'y')},
-        'grid': [
-            (1, 1, 1),
-            (1, 2, 1),
-            (1, 3, 1),
-            (1, 1, 3),
-            (1, 3, 2),
-            (2, 2, 2)
-        ]
-    }
-    return jsonify(test_dict)
+    @app.route('/simulations/<int:sim_id>/stream')
+    def stream(sim_id: int):
+        get_simulation(sim_id)
+        if persistence.last_turn(sim_id=sim_id) is None:
+            abort(404, 'Simulation {} has no event log to stream'.format(sim_id))
+        with streams_lock:
+            if sim_id not in streams:
+                streams[sim_id] = SimulationStream(persistence, sim_id=sim_id, poll_interval=poll_interval)
+        simulation_stream = streams[sim_id]
+        subscriber = simulation_stream.subscribe()
+        response = Response(simulation_stream.messages(subscriber), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'  # no proxy buffering
+        return response
 
-@app.route('/test')
-def test():
-    msg = {'blah': 1,
-           're-blah': {'blah': ('tuple', 4)}}
-    return jsonify(msg)
+    return app
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=9999)
+    app = create_app(SimulationClient(os.environ.get('FISH_BOWL_DATABASE', get_database_string())))
+    app.run(host='0.0.0.0', port=9999, threaded=True)
@@ -0,0 +1,651 @@
+"""
+In-memory turn engine backed by numpy arrays
+
+The grid is kept as two flat arrays of grid_size * grid_size cells (cell = x * grid_size + y):
+- grid: animal type in the cell (0 when empty, otherwise Animal value)
+- slot: row of the animal in the cell (-1 when empty)
+On very large grids, slot is a cell table holding the occupied cells only (see fish_bowl.process.tiles), indexed the
+same way, and grid reads the types through it.
+The sequential loops of a turn run as kernels over these arrays (see fish_bowl.process.kernels), compiled with numba
+when it is installed, otherwise as plain python loops on the engine methods.
+
+Animals are stored as a struct of arrays (one column per attribute), dead rows are compacted away from time to time.
+Rules are the same as in fish_bowl.process.base.SimulationGrid, persistence is an optional sink which receives the
+animals that changed at the end of each turn, either right away or through a write-behind thread
+(see fish_bowl.dataio.write_behind).
+"""
+import logging
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from fish_bowl.dataio.persistence import SimulationClient, PopulationCounters, SETUP_TURN
+from fish_bowl.dataio.turn_stats import TurnStatsRecorder, persist_population
+from fish_bowl.dataio.write_behind import WriteBehindWriter
+from fish_bowl.process.base import DictionaryWithAttributes
+from fish_bowl.process.kernels import NUMBA_AVAILABLE, eat_kernel, breed_and_move_kernel, move_kernel
+from fish_bowl.process.tiles import CellTable
+from fish_bowl.process.topology import SquareGridCoordinate, NonEmptyCoordinate, NEIGH_PERMUTATIONS, \
+    DENSE_TABLE_MAX_CELLS, square_grid_valid, square_grid_neighbour_rows
+from fish_bowl.process.utils import Animal, EndOfSimulatioError
+
+_logger = logging.getLogger(__name__)
+
+EMPTY = 0
+FISH = Animal.Fish.value
+SHARK = Animal.Shark.value
+
+# compaction of dead rows only happens above this number of rows
+MIN_COMPACT_SIZE = 1024
+# columns of the changed animals handed to the persistence
+SYNC_COLUMNS = ['oid', 'animal_type', 'spawn_turn', 'breed_count', 'last_breed', 'last_fed', 'alive', 'cell']
+
+
+class AnimalColumns:
+    """
+    Struct of arrays holding all animals of a simulation (dead ones included until compaction)
+    """
+    COLUMNS = {
+        'oid': np.int64,
+        'animal_type': np.int8,
+        'spawn_turn': np.int32,
+        'breed_count': np.int32,
+        'last_breed': np.int32,
+        'last_fed': np.int32,
+        'alive': np.bool_,
+        'cell': np.int64,
+        'dirty': np.bool_,
+        'synced_cell': np.int64,  # cell at the last sync, -1 for animals added since
+    }
+
+    def __init__(self, capacity: int = 64):
+        self.size = 0
+        self._capacity = max(int(capacity), 1)
+        for name, dtype in self.COLUMNS.items():
+            setattr(self, name, np.zeros(self._capacity, dtype=dtype))
+
+    def reserve(self, extra: int):
+        """
+        Make sure extra rows can be appended without re-allocating the columns
+        :param extra:
+        :return:
+        """
+        needed = self.size + int(extra)
+        if needed <= self._capacity:
+            return
+        capacity = max(needed, 2 * self._capacity)
+        for name, dtype in self.COLUMNS.items():
+            column = np.zeros(capacity, dtype=dtype)
+            column[:self.size] = getattr(self, name)[:self.size]
+            setattr(self, name, column)
+        self._capacity = capacity
+
+    def append(self, oid: int, animal_type: int, cell: int, spawn_turn: int, last_breed: int, last_fed: int) -> int:
+        """
+        Add a live animal, columns must have been reserved beforehand
+        :return: row of the new animal
+        """
+        row = self.size
+        self.oid[row] = oid
+        self.animal_type[row] = animal_type
+        self.spawn_turn[row] = spawn_turn
+        self.breed_count[row] = 0
+        self.last_breed[row] = last_breed
+        self.last_fed[row] = last_fed
+        self.alive[row] = True
+        self.cell[row] = cell
+        self.dirty[row] = True
+        self.synced_cell[row] = -1
+        self.size += 1
+        return row
+
+    def extend(self, first_oid: int, animal_type: int, cells: np.ndarray, spawn_turn: int, last_breed: int,
+               last_fed: int) -> np.ndarray:
+        """
+        Add live animals of a type with consecutive oids, columns must have been reserved beforehand
+        (spawn_turn, last_breed and last_fed: one value for all, or an array of one per animal)
+        :return: rows of the new animals
+        """
+        rows = np.arange(self.size, self.size + len(cells))
+        self.oid[rows] = np.arange(first_oid, first_oid + len(cells))
+        self.animal_type[rows] = animal_type
+        self.spawn_turn[rows] = spawn_turn
+        self.breed_count[rows] = 0
+        self.last_breed[rows] = last_breed
+        self.last_fed[rows] = last_fed
+        self.alive[rows] = True
+        self.cell[rows] = cells
+        self.dirty[rows] = True
+        self.synced_cell[rows] = -1
+        self.size += len(cells)
+        return rows
+
+    def live_rows(self, animal_type: Optional[int] = None) -> np.ndarray:
+        """
+        Rows of live animals, optionally filtered by type
+        :param animal_type:
+        :return:
+        """
+        mask = self.alive[:self.size]
+        if animal_type is not None:
+            mask = mask & (self.animal_type[:self.size] == animal_type)
+        return np.flatnonzero(mask)
+
+    def compact(self) -> np.ndarray:
+        """
+        Drop dead rows
+        :return: rows kept (in their previous numbering)
+        """
+        keep = self.live_rows()
+        for name in self.COLUMNS:
+            column = getattr(self, name)
+            column[:len(keep)] = column[keep]
+        self.size = len(keep)
+        return keep
+
+
+class SlotTypes:
+    """
+    Type grid of sparse engines, read through the slot grid and the animal columns: writes are ignored, as the type of
+    a cell follows its slot
+    """
+
+    def __init__(self, slot: CellTable, animals: AnimalColumns):
+        self.slot = slot
+        self.animals = animals
+
+    def __getitem__(self, cells):
+        rows = self.slot[cells]
+        if isinstance(cells, (int, np.integer)):
+            return EMPTY if rows < 0 else self.animals.animal_type[rows]
+        return np.where(rows >= 0, self.animals.animal_type[np.maximum(rows, 0)], EMPTY).astype(np.int8)
+
+    def __setitem__(self, cells, values):
+        return
+
+    def to_dense(self) -> np.ndarray:
+        """
+        Flat dense copy of the grid (small grids only)
+        """
+        dense = np.zeros(self.slot.grid_size * self.slot.grid_size, dtype=np.int8)
+        cells, rows = self.slot.items()
+        dense[cells] = self.animals.animal_type[rows]
+        return dense
+
+
+class ArraySimulationGrid:
+
+    def __init__(self, simulation_parameters: Dict, persistence: Optional[SimulationClient] = None,
+                 seed: Optional[int] = None, sparse: Optional[bool] = None, kernels: Optional[bool] = None,
+                 write_behind: int = 0):
+        """
+        Create an in-memory simulation, optionally mirrored to a persistence
+        :param simulation_parameters:
+        :param persistence: if provided, the simulation is created there and changes are written at the end of each turn
+        :param seed: seed of the random generator
+        :param sparse: keep the occupied cells only, in cell tables (default for grids of more than
+        DENSE_TABLE_MAX_CELLS cells), instead of dense arrays
+        :param kernels: play eating, breeding and moving with fish_bowl.process.kernels (default when numba is
+        installed), same simulation for a given seed either way
+        :param write_behind: number of turns of changes waiting for a background writer thread before play_turn blocks
+        (0: changes are written at the end of each turn). The persistence then belongs to the writer: call flush
+        before reading it, close when done
+        """
+        self.simulation_params = DictionaryWithAttributes(simulation_parameters)
+        grid_size = self.simulation_params.grid_size
+        if grid_size ** 2 < (self.simulation_params.init_nb_fish + self.simulation_params.init_nb_shark):
+            raise ValueError('initial number of animals bigger than grid size....')
+        self._rng = np.random.default_rng(seed)
+        self._persistence = persistence
+        self._sid = None
+        self._db_oids = dict()
+        self._writer = None
+        if persistence is not None:
+            self._sid = persistence.init_simulation(**simulation_parameters)
+            if write_behind > 0:
+                self._writer = WriteBehindWriter(self._write_changes, transaction=persistence.transaction,
+                                                 max_pending=write_behind, name='write-behind-{}'.format(self._sid))
+        self._sim_turn = 0
+        self._next_oid = 1
+        if sparse is None:
+            sparse = grid_size ** 2 > DENSE_TABLE_MAX_CELLS
+        if kernels is None:
+            kernels = NUMBA_AVAILABLE
+        self.kernels = kernels
+        nb_animals = self.simulation_params.init_nb_fish + self.simulation_params.init_nb_shark
+        self.animals = AnimalColumns(capacity=nb_animals)
+        if sparse:
+            self.slot = CellTable(grid_size, empty=-1, dtype=np.int64, capacity=nb_animals)
+            self.grid = SlotTypes(self.slot, self.animals)
+        else:
+            self.grid = np.zeros(grid_size * grid_size, dtype=np.int8)
+            self.slot = np.full(grid_size * grid_size, -1, dtype=np.int64)
+        self.counters = PopulationCounters()
+        self.turn_stats = []
+        self._stats_sinks = []
+        self._stats_recorder = TurnStatsRecorder(query_stats=None if persistence is None else persistence.query_stats)
+        self._spawn()
+        self._sync()
+
+    @property
+    def grid_size(self) -> int:
+        return self.simulation_params.grid_size
+
+    def add_stats_sink(self, sink):
+        """
+        Write the stats record of every turn to sink (see fish_bowl.dataio.turn_stats)
+        :param sink: object with a write(record) method
+        :return:
+        """
+        self._stats_sinks.append(sink)
+
+    def _record_turn_stats(self):
+        record = self._stats_recorder.stop(counters=self.counters.to_dict())
+        self.turn_stats.append(record)
+        for sink in self._stats_sinks:
+            sink.write(record)
+
+    def _spawn(self):
+        """
+        Spawn fishes and sharks on random free cells (at start only)
+        :return:
+        """
+        params = self.simulation_params
+        nb_fish, nb_shark = params.init_nb_fish, params.init_nb_shark
+        # distinct cells, drawn without a permutation of the whole grid on large sparse ones
+        cells = self._rng.choice(self.grid_size ** 2, size=nb_fish + nb_shark, replace=False)
+        # since animal at start can be able to breed, spawn turn (and last breed) can be negative
+        fish_spawn = -self._rng.integers(0, params.fish_breed_maturity, size=nb_fish, endpoint=True)
+        shark_spawn = -self._rng.integers(0, params.shark_breed_maturity, size=nb_shark, endpoint=True)
+        self.animals.reserve(nb_fish + nb_shark)
+        for animal_type, type_cells, spawn_turn in ((FISH, cells[:nb_fish], fish_spawn),
+                                                    (SHARK, cells[nb_fish:], shark_spawn)):
+            rows = self.animals.extend(self._next_oid, animal_type, type_cells, spawn_turn=spawn_turn,
+                                       last_breed=spawn_turn, last_fed=0)
+            self._next_oid += len(rows)
+            self.counters.born(Animal.Fish if animal_type == FISH else Animal.Shark, len(rows))
+            self.grid[type_cells] = animal_type
+            self.slot[type_cells] = rows
+
+    def _add(self, animal_type: int, cell: int, spawn_turn: int, last_breed: int = 0, last_fed: int = 0) -> int:
+        """
+        Put a new animal on a free cell, columns must have been reserved
+        :return: row of the animal
+        """
+        row = self.animals.append(self._next_oid, animal_type, cell, spawn_turn, last_breed, last_fed)
+        self._next_oid += 1
+        self.counters.born(Animal.Fish if animal_type == FISH else Animal.Shark)
+        self.grid[cell] = animal_type
+        self.slot[cell] = row
+        return row
+
+    def add_animal(self, animal_type: Animal, coordinate: SquareGridCoordinate, current_turn: int = 0,
+                   last_fed: int = 0, last_breed: int = 0) -> int:
+        """
+        use for single animal init (same checks as SimulationClient.init_animal)
+        :return: oid of the new animal
+        """
+        square_grid_valid(grid_size=self.grid_size, coordinates=coordinate)
+        cell = self.to_cell(coordinate)
+        if self.slot[cell] >= 0:
+            raise NonEmptyCoordinate('Coordinate {} is occupied'.format(coordinate))
+        self.animals.reserve(1)
+        row = self._add(animal_type.value, cell, spawn_turn=current_turn, last_breed=last_breed, last_fed=last_fed)
+        return int(self.animals.oid[row])
+
+    def to_cell(self, coordinate: SquareGridCoordinate) -> int:
+        return int(coordinate.x) * self.grid_size + int(coordinate.y)
+
+    def to_coordinate(self, cell: int) -> SquareGridCoordinate:
+        return SquareGridCoordinate(*divmod(int(cell), self.grid_size))
+
+    def check_if_occupied(self, coordinate: SquareGridCoordinate) -> bool:
+        return bool(self.slot[self.to_cell(coordinate)] >= 0)
+
+    def _kernel_grids(self, extra: int):
+        """
+        Type and slot grids as the kernels take them: the slot cell table for both on sparse grids, with room for extra
+        new cells
+        :param extra:
+        :return:
+        """
+        if isinstance(self.slot, CellTable):
+            self.slot.reserve(extra)
+            return self.slot.table, self.slot.table
+        return self.grid, self.slot
+
+    def _neighbour_candidates(self, rows: np.ndarray) -> np.ndarray:
+        """
+        Neighbour cells of each animal, in a random visiting order
+        :param rows:
+        :return: (len(rows), 8) array of cells
+        """
+        permutations = NEIGH_PERMUTATIONS[self._rng.integers(0, len(NEIGH_PERMUTATIONS), size=len(rows))]
+        neighbours = square_grid_neighbour_rows(self.grid_size, self.animals.cell[rows])
+        return np.take_along_axis(neighbours, permutations.astype(np.intp), axis=1)
+
+    def _can_breed(self, rows: np.ndarray, maturity: int, probability: int) -> np.ndarray:
+        """
+        Maturity check and breeding draw for rows, same draw as randint(0, 100) <= probability
+        :return: boolean mask aligned with rows
+        """
+        animals = self.animals
+        turn = self._sim_turn
+        mature = (((turn - animals.spawn_turn[rows]) >= maturity) & ((turn - animals.last_breed[rows]) >= maturity))
+        draw = self._rng.integers(0, 100, size=len(rows), endpoint=True) <= probability
+        return mature & draw
+
+    def _move_row(self, row: int, new_cell: int):
+        animals = self.animals
+        old_cell = animals.cell[row]
+        self.grid[old_cell] = EMPTY
+        self.slot[old_cell] = -1
+        self.grid[new_cell] = animals.animal_type[row]
+        self.slot[new_cell] = row
+        animals.cell[row] = new_cell
+        animals.dirty[row] = True
+
+    def _kill_row(self, row: int):
+        animals = self.animals
+        cell = animals.cell[row]
+        self.grid[cell] = EMPTY
+        self.slot[cell] = -1
+        animals.alive[row] = False
+        animals.dirty[row] = True
+        self.counters.died(Animal.Fish if animals.animal_type[row] == FISH else Animal.Shark)
+
+    def _check_deads(self):
+        """
+        sharks that did not eat since 'shark_starve' nb of turns, dies
+        :return:
+        """
+        sharks = self.animals.live_rows(SHARK)
+        if len(sharks) == 0:
+            raise EndOfSimulatioError('Simulation ends because no more Sharks')
+        starving = sharks[(self._sim_turn - self.animals.last_fed[sharks]) > self.simulation_params.shark_starving]
+        if len(starving) > 0:
+            _logger.info('Turn: {:<3} - Deads - Found {} shark starving'.format(self._sim_turn, len(starving)))
+        for row in starving:
+            self._kill_row(row)
+        return
+
+    def _eat(self) -> np.ndarray:
+        """
+        Sharks that are adjacent to a Fish square eat and move into fish square (and do not move after)
+        :return: cell of each shark before it ate (-1 for sharks that have not eaten), indexed by row
+        """
+        animals = self.animals
+        fed_from = np.full(animals.size, -1, dtype=np.int64)
+        sharks = self._rng.permutation(animals.live_rows(SHARK))
+        candidates = self._neighbour_candidates(sharks)
+        if self.kernels:
+            grid, slot = self._kernel_grids(extra=0)
+            meals = eat_kernel(sharks, candidates, grid, slot, animals.cell, animals.animal_type,
+                               animals.alive, animals.dirty, animals.last_fed, fed_from, self._sim_turn)
+            if meals > 0:
+                self.counters.died(Animal.Fish, meals)
+                self.counters.meals += meals
+        else:
+            grid = self.grid
+            for row, neighbours in zip(sharks.tolist(), candidates.tolist()):
+                shark_cell = animals.cell[row]
+                for neigh in neighbours:
+                    if grid[neigh] == FISH:
+                        self._kill_row(self.slot[neigh])
+                        self._move_row(row, neigh)
+                        animals.last_fed[row] = self._sim_turn
+                        self.counters.meals += 1
+                        fed_from[row] = shark_cell
+                        break
+        _logger.debug('Turn: {:<3} - Eat - {} sharks have eaten'.format(self._sim_turn, (fed_from >= 0).sum()))
+        return fed_from
+
+    def _breed(self, row: int, breed_cell: int):
+        animals = self.animals
+        animals.last_breed[row] = self._sim_turn
+        animals.breed_count[row] += 1
+        animals.dirty[row] = True
+        self._add(animals.animal_type[row], breed_cell, spawn_turn=self._sim_turn, last_fed=self._sim_turn)
+
+    def _breed_and_move(self, fed_from: np.ndarray) -> np.ndarray:
+        """
+        Sharks or Fish that can breed, do so in same square (and Move), others moves if free space
+        - Shark Breed first
+        - Then Fish
+        :param fed_from: cell of sharks before they ate, indexed by row (see _eat)
+        :return: boolean mask of the animals that bred and moved, indexed by row
+        """
+        animals = self.animals
+        params = self.simulation_params
+        moved = np.zeros(animals.size, dtype=np.bool_)
+        moved[:len(fed_from)] = fed_from >= 0
+        for animal_type, maturity, probability in ((SHARK, params.shark_breed_maturity,
+                                                    params.shark_breed_probability),
+                                                   (FISH, params.fish_breed_maturity, params.fish_breed_probability)):
+            rows = self._rng.permutation(animals.live_rows(animal_type))
+            rows = rows[self._can_breed(rows, maturity, probability)]
+            candidates = self._neighbour_candidates(rows)
+            # children are appended while looping, make sure columns are not re-allocated
+            animals.reserve(len(rows))
+            if self.kernels:
+                self._breed_and_move_kernel(animal_type, rows, candidates, fed_from, moved)
+                continue
+            for row, neighbours in zip(rows.tolist(), candidates.tolist()):
+                if animal_type == SHARK and fed_from[row] >= 0:
+                    # shark that ate breeds in its previous cell if nobody took it in the meantime
+                    if self.slot[fed_from[row]] < 0:
+                        self._breed(row, fed_from[row])
+                    continue
+                for neigh in neighbours:
+                    if self.slot[neigh] < 0:
+                        breed_cell = animals.cell[row]
+                        self._move_row(row, neigh)
+                        self._breed(row, breed_cell)
+                        moved[row] = True
+                        break
+        return moved
+
+    def _breed_and_move_kernel(self, animal_type: int, rows: np.ndarray, candidates: np.ndarray,
+                               fed_from: np.ndarray, moved: np.ndarray):
+        """
+        Breeding loop of _breed_and_move as a kernel, children are then appended in the order they were born
+        """
+        animals = self.animals
+        child_cells = np.zeros(len(rows), dtype=np.int64)
+        grid, slot = self._kernel_grids(extra=len(rows))
+        nb_children = breed_and_move_kernel(rows, candidates, fed_from, moved, grid, slot, animals.cell,
+                                            animals.animal_type, animals.dirty, animals.last_breed,
+                                            animals.breed_count, self._sim_turn, animals.size, child_cells)
+        if nb_children > 0:
+            animals.extend(self._next_oid, animal_type, child_cells[:nb_children], spawn_turn=self._sim_turn,
+                           last_breed=0, last_fed=self._sim_turn)
+            self._next_oid += nb_children
+            self.counters.born(Animal.Fish if animal_type == FISH else Animal.Shark, nb_children)
+
+    def _move(self, already_moved: np.ndarray):
+        """
+        Those who can move do so (Free space around), fishes first then sharks
+        :return:
+        """
+        self._move_animal_type(FISH, already_moved)
+        self._move_animal_type(SHARK, already_moved)
+        return
+
+    def _move_animal_type(self, animal_type: int, already_moved: np.ndarray):
+        """
+        Perform move action for a type of animal, animals that already moved or were just spawn do not move
+        :param animal_type:
+        :param already_moved:
+        :return:
+        """
+        animals = self.animals
+        rows = animals.live_rows(animal_type)
+        rows = rows[rows < len(already_moved)]
+        rows = rows[~already_moved[rows] & (animals.spawn_turn[rows] != self._sim_turn)]
+        rows = self._rng.permutation(rows)
+        candidates = self._neighbour_candidates(rows)
+        if self.kernels:
+            grid, slot = self._kernel_grids(extra=0)
+            move_kernel(rows, candidates, grid, slot, animals.cell, animals.animal_type, animals.dirty)
+            return
+        for row, neighbours in zip(rows.tolist(), candidates.tolist()):
+            for neigh in neighbours:
+                if self.slot[neigh] < 0:
+                    self._move_row(row, neigh)
+                    break
+        return
+
+    def check_simulation_ends(self):
+        """
+        Simulation ends if Sharks have disappeared
+        :return:
+        """
+        if len(self.animals.live_rows(SHARK)) == 0:
+            raise EndOfSimulatioError('Simulation ends because no more Sharks')
+
+    def play_turn(self):
+        """
+        Same turn as SimulationGrid.play_turn: deads, eat, breed and move, move.
+        Changes are written to the persistence (if any) at the end of the turn
+        :return:
+        """
+        _logger.debug('********************TURN: {:<3}********************'.format(self._sim_turn))
+        stats = self._stats_recorder
+        turn = self._sim_turn
+        stats.start(sim_id=self._sid, turn=turn)
+        try:
+            with stats.phase('_check_deads'):
+                self._check_deads()
+            with stats.phase('_eat'):
+                fed_from = self._eat()
+            with stats.phase('_breed_and_move'):
+                moved = self._breed_and_move(fed_from=fed_from)
+            with stats.phase('_move'):
+                self._move(already_moved=moved)
+            self._sim_turn += 1
+        finally:
+            self._sync(turn=turn)
+            self._compact()
+        self._record_turn_stats()
+        self.check_simulation_ends()
+        return
+
+    def _sync(self, turn: int = SETUP_TURN):
+        """
+        Hand the animals that changed to the persistence sink (or to the write-behind writer)
+        :param turn: turn of the changes (SETUP_TURN for the initial spawn)
+        :return:
+        """
+        animals = self.animals
+        dirty = np.flatnonzero(animals.dirty[:animals.size])
+        # cells left and taken by the animals that changed
+        synced_cells = animals.synced_cell[dirty]
+        self._changed_cells = np.union1d(animals.cell[dirty], synced_cells[synced_cells >= 0])
+        animals.synced_cell[dirty] = animals.cell[dirty]
+        if self._persistence is not None and len(dirty) > 0:
+            changes = {name: getattr(animals, name)[dirty] for name in SYNC_COLUMNS}
+            if self._writer is None:
+                self._write_changes((turn, changes))
+            else:
+                self._writer.submit((turn, changes))
+        animals.dirty[:animals.size] = False
+
+    def _write_changes(self, job):
+        """
+        Write the changed animals of a turn to the persistence (from the writer thread in write-behind mode)
+        :param job: turn and SYNC_COLUMNS of the changed animals
+        :return:
+        """
+        turn, changes = job
+        coord_x, coord_y = np.divmod(changes['cell'], self.grid_size)
+        new_animals, updated_animals, new_local = [], [], []
+        for local_oid, animal_type, spawn_turn, breed_count, last_breed, last_fed, alive, x, y in zip(
+                changes['oid'].tolist(), changes['animal_type'].tolist(), changes['spawn_turn'].tolist(),
+                changes['breed_count'].tolist(), changes['last_breed'].tolist(), changes['last_fed'].tolist(),
+                changes['alive'].tolist(), coord_x.tolist(), coord_y.tolist()):
+            record = {'spawn_turn': spawn_turn, 'breed_count': breed_count, 'last_breed': last_breed,
+                      'last_fed': last_fed, 'alive': alive, 'coord_x': x, 'coord_y': y}
+            record['animal_type'] = Animal(animal_type)
+            if local_oid in self._db_oids:
+                record['oid'] = self._db_oids[local_oid] if alive else self._db_oids.pop(local_oid)
+                updated_animals.append(record)
+            else:
+                new_animals.append(record)
+                new_local.append(local_oid)
+        db_oids = self._persistence.write_animals(sim_id=self._sid, new_animals=new_animals,
+                                                  updated_animals=updated_animals, turn=turn)
+        self._db_oids.update((local_oid, db_oid) for local_oid, db_oid, record in zip(new_local, db_oids, new_animals)
+                             if record['alive'])
+
+    def flush(self):
+        """
+        Wait until the changes of the turns played are written to the persistence (write-behind mode)
+        :return:
+        """
+        if self._writer is not None:
+            self._writer.flush()
+
+    def close(self):
+        """
+        Write the pending changes and stop the write-behind writer
+        :return:
+        """
+        if self._writer is not None:
+            self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _compact(self):
+        """
+        Drop dead rows once they outnumber live ones
+        :return:
+        """
+        animals = self.animals
+        nb_alive = int(animals.alive[:animals.size].sum())
+        if animals.size < MIN_COMPACT_SIZE or nb_alive * 2 > animals.size:
+            return
+        animals.compact()
+        self.slot[animals.cell[:animals.size]] = np.arange(animals.size)
+
+    def get_simulation_grid_data(self) -> pd.DataFrame:
+        """
+        Live animals in the same layout as SimulationClient.get_animals_df (oid is the in-memory id)
+        :return:
+        """
+        animals = self.animals
+        rows = animals.live_rows()
+        coord_x, coord_y = np.divmod(animals.cell[rows], self.grid_size)
+        types = np.array([None] + [a for a in Animal], dtype=object)
+        return pd.DataFrame({'oid': animals.oid[rows], 'sim_id': self._sid,
+                             'animal_type': types[animals.animal_type[rows]],
+                             'spawn_turn': animals.spawn_turn[rows], 'breed_count': animals.breed_count[rows],
+                             'last_breed': animals.last_breed[rows], 'last_fed': animals.last_fed[rows],
+                             'alive': animals.alive[rows], 'coord_x': coord_x, 'coord_y': coord_y})
+
+    def turn_changes(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Cells changed during the last turn played, with their content at its end (see update_simple_grid)
+        :return: coord_x, coord_y and type code (0: empty, otherwise Animal value) of each cell
+        """
+        coord_x, coord_y = np.divmod(self._changed_cells, self.grid_size)
+        return coord_x, coord_y, np.asarray(self.grid[self._changed_cells])
+
+    def get_type_grid(self) -> np.ndarray:
+        """
+        Grid of animal types (0: empty, 1: Fish, 2: Shark), indexed [x, y]
+        :return:
+        """
+        grid = self.grid.to_dense() if isinstance(self.grid, SlotTypes) else self.grid
+        return grid.reshape(self.grid_size, self.grid_size)
+
+    @property
+    def population(self) -> pd.Series:
+        return pd.Series({Animal.Fish: self.counters.fish, Animal.Shark: self.counters.shark})
+
+    def persist_to_file(self, filename):
+        persist_population(filename, turn=self._sim_turn, counters=self.counters)
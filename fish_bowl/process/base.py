@@ -1,13 +1,17 @@
 from collections import namedtuple
-import random
 import logging
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 
+import numpy as np
 import pandas as pd
 
+from fish_bowl.dataio.checkpoint import save_checkpoint, load_checkpoint, checkpoint_records
 from fish_bowl.dataio.persistence import SimulationClient
+from fish_bowl.dataio.turn_stats import TurnStatsRecorder, persist_population
 from fish_bowl.process.utils import Animal, ImpossibleAction, EndOfSimulatioError
-from fish_bowl.process.topology import SquareGridCoordinate, square_grid_neighbours
+from fish_bowl.process.tiles import TiledOccupancy
+from fish_bowl.process.topology import SquareGridCoordinate, NEIGH_PERMUTATIONS, DENSE_TABLE_MAX_CELLS, \
+    square_grid_neighbours
 
 _logger = logging.getLogger(__name__)
 
@@ -24,24 +28,85 @@ class DictionaryWithAttributes(dict):
 
 class SimulationGrid:
 
-    def __init__(self, persistence: SimulationClient, simulation_parameters: Dict):
+    def __init__(self, persistence: SimulationClient, simulation_parameters: Dict, seed: Optional[int] = None,
+                 spawn: bool = True):
         """
         Create a simulation and link to its persistence
         :param persistence:
         :param simulation_parameters:
+        :param seed: seed of the random generator of the simulation (runs with the same seed are identical)
+        :param spawn: spawn the initial animals (a simulation restored from a checkpoint starts empty)
         """
-        # TODO: create a new simulation from existing parameters by providing an existing sid
         self._persistence = persistence
+        # all the randomness of the simulation, drawn in one call per phase
+        self._rng = np.random.default_rng(seed)
 
         # initialize simulation
         self.simulation_params = DictionaryWithAttributes(simulation_parameters) # add attribute in the beginning
         self._sid = self._persistence.init_simulation(**simulation_parameters)
         self._sim_turn = 0
-        self._spawn()
+        if spawn:
+            self._spawn()
         # get occupied coordinates at initialization
+        self._load_occupied_coord()
+        # content at the end of the turn of the cells changed during the turn (0: empty, otherwise Animal value)
+        self._changed_cells = dict()
+        # stats record of each played turn (see fish_bowl.dataio.turn_stats), also written to the sinks
+        self.turn_stats = []
+        self._stats_sinks = []
+        self._stats_recorder = TurnStatsRecorder(query_stats=self._persistence.query_stats)
+
+    @classmethod
+    def from_checkpoint(cls, persistence: SimulationClient, path: str) -> 'SimulationGrid':
+        """
+        Restore a simulation saved with save_checkpoint, as a new simulation of persistence:
+        animals are written in one bulk insert, the turn and the random generator resume where they were
+        :param persistence:
+        :param path: .npz checkpoint
+        :return:
+        """
+        checkpoint = load_checkpoint(path)
+        grid = cls(persistence=persistence, simulation_parameters=checkpoint['simulation_parameters'], spawn=False)
+        grid._sim_turn = checkpoint['turn']
+        grid._rng.bit_generator.state = checkpoint['rng_state']
+        persistence.write_animals(sim_id=grid._sid, new_animals=checkpoint_records(checkpoint['animals']),
+                                  updated_animals=[])
+        grid._load_occupied_coord()
+        _logger.info('Simulation {} restored at turn {} from {}'.format(grid._sid, grid._sim_turn, path))
+        return grid
+
+    def save_checkpoint(self, path: str):
+        """
+        Save the state of the simulation (live animals, turn and random generator) to a .npz checkpoint
+        :param path:
+        :return:
+        """
+        save_checkpoint(path, simulation_parameters=self.simulation_params, turn=self._sim_turn,
+                        rng_state=self._rng.bit_generator.state, animals=self.get_simulation_grid_data(),
+                        sim_id=self._sid)
+
+    def _load_occupied_coord(self):
         self.animals = self.get_simulation_grid_data()
-        self.occupied_coord = set(zip(self.animals.coord_x, self.animals.coord_y))
+        coordinates = zip(self.animals.coord_x, self.animals.coord_y)
+        if self.simulation_params.grid_size ** 2 > DENSE_TABLE_MAX_CELLS:
+            # very large grids: memory must follow the population, not the area
+            self.occupied_coord = TiledOccupancy(self.simulation_params.grid_size, coordinates)
+        else:
+            self.occupied_coord = set(coordinates)
+
+    def add_stats_sink(self, sink):
+        """
+        Write the stats record of every turn to sink (see fish_bowl.dataio.turn_stats)
+        :param sink: object with a write(record) method
+        :return:
+        """
+        self._stats_sinks.append(sink)
 
+    def _record_turn_stats(self):
+        record = self._stats_recorder.stop(counters=self.counters.to_dict())
+        self.turn_stats.append(record)
+        for sink in self._stats_sinks:
+            sink.write(record)
 
     def display_grid(self):
         """
@@ -59,18 +124,19 @@ class SimulationGrid:
         return self._persistence.get_animals_df(sim_id=self._sid)
 
     @property
-    def population(self):
-        grid = self.get_simulation_grid_data()
-        population = grid[grid['alive']].animal_type.value_counts()
-        return population
+    def counters(self):
+        """
+        Population counters of the simulation, maintained by the persistence layer
+        """
+        return self._persistence.population_counters(self._sid)
+
+    @property
+    def population(self) -> pd.Series:
+        counters = self.counters
+        return pd.Series({Animal.Fish: counters.fish, Animal.Shark: counters.shark})
 
     def persist_to_file(self, filename):
-        population = self.population
-        nb = '{},{},{}'.format(self._sim_turn, population[Animal.Fish], population[Animal.Shark])
-        with open(filename, 'a') as fp:
-            if self._sim_turn == 1:
-                fp.write('Turn, Fish, Sharks\n')
-            fp.write(nb + '\n')
+        persist_population(filename, turn=self._sim_turn, counters=self.counters)
 
     def _spawn(self):
         """
@@ -80,29 +146,45 @@ class SimulationGrid:
         # get simulation elements
         simulation_params = self.simulation_params
         grid_size = simulation_params.grid_size
-        coord_array = [(x, y) for x in range(grid_size) for y in range(grid_size)]
-        random.shuffle(coord_array)
-        # spawn fish and Sharks
-        fishes = 0
-        sharks = 0
-        for coord in coord_array:
-            if fishes < simulation_params.init_nb_fish:
-                # since animal at start can be able to breed, last breed can be negative
-                spawn_turn = -random.randint(0, simulation_params.fish_breed_maturity)
-                self._persistence.init_animal(sim_id=self._sid, current_turn=spawn_turn, animal_type=Animal.Fish,
-                                              coordinate=SquareGridCoordinate(*coord),
-                                              last_breed=spawn_turn)
-                fishes += 1
-            elif sharks < simulation_params.init_nb_shark:
-                spawn_turn = -random.randint(0, simulation_params.shark_breed_maturity)
-                self._persistence.init_animal(sim_id=self._sid, current_turn=spawn_turn, animal_type=Animal.Shark,
-                                              coordinate=SquareGridCoordinate(*coord),
-                                              last_breed=spawn_turn)
-                sharks += 1
-            else:
-                break
+        nb_fish = simulation_params.init_nb_fish
+        nb_shark = simulation_params.init_nb_shark
+        # random distinct cells, without building the full list of coordinates
+        coord_x, coord_y = np.divmod(self._rng.choice(grid_size ** 2, size=nb_fish + nb_shark, replace=False),
+                                     grid_size)
+        # since animal at start can be able to breed, last breed can be negative
+        maturity = np.repeat([simulation_params.fish_breed_maturity, simulation_params.shark_breed_maturity],
+                             [nb_fish, nb_shark])
+        spawn_turn = (-self._rng.integers(0, maturity, endpoint=True)).tolist()
+        animal_types = [Animal.Fish] * nb_fish + [Animal.Shark] * nb_shark
+        self._persistence.init_animals(sim_id=self._sid, animal_types=animal_types, coord_x=coord_x, coord_y=coord_y,
+                                       spawn_turn=spawn_turn, last_breed=spawn_turn)
         return
 
+    def _shuffled(self, animals: pd.DataFrame) -> pd.DataFrame:
+        """
+        Animals in a random order
+        :param animals:
+        :return:
+        """
+        return animals.iloc[self._rng.permutation(len(animals))]
+
+    def _neighbour_orders(self, nb: int) -> List[int]:
+        """
+        Random visiting orders of the neighbours (rows of NEIGH_PERMUTATIONS) of nb animals
+        :param nb:
+        :return:
+        """
+        return self._rng.integers(len(NEIGH_PERMUTATIONS), size=nb).tolist()
+
+    def _breed_trials(self, nb: int, probability: int) -> List[bool]:
+        """
+        Breeding draws of nb animals
+        :param nb:
+        :param probability: breed probability, in %
+        :return:
+        """
+        return (self._rng.integers(0, 100, size=nb, endpoint=True) <= probability).tolist()
+
     def _check_deads(self):
         """
         sharks that did not eat since 'shark_starve' nb of turns, dies
@@ -134,20 +216,25 @@ class SimulationGrid:
         _debug = 'Turn: {:<3} - Eat - '.format(self._sim_turn)
         simulation_params = self.simulation_params
         # get a randomized df of all sharks
-        sharks = self._persistence.get_animals_by_type(sim_id=self._sid, animal_type=Animal.Shark).sample(frac=1)
+        sharks = self._shuffled(self._persistence.get_animals_by_type(sim_id=self._sid, animal_type=Animal.Shark))
         sharks_eating = dict()
         shark_update = dict()
-        for idx, shark in sharks.iterrows():
-            # get shark neighbour square
-            shark_position = SquareGridCoordinate(shark.coord_x, shark.coord_y)
-            shark_neighbour = square_grid_neighbours(simulation_params.grid_size, shark_position) # coordinates
-            # try to find fish
-            has_fish = self._persistence.has_fish_in_square(sim_id=self._sid, coordinates=shark_neighbour)
+        # fish position index for the turn, fish are removed from it as they are eaten
+        fish_positions = self._persistence.get_fish_positions(sim_id=self._sid)
+        shark_positions = [SquareGridCoordinate(x, y)
+                           for x, y in zip(sharks.coord_x.tolist(), sharks.coord_y.tolist())]
+        shark_neighbours = [square_grid_neighbours(simulation_params.grid_size, p, permutation=order)
+                            for p, order in zip(shark_positions, self._neighbour_orders(len(sharks)))]
+        fish_in_reach = self._persistence.has_fish_in_squares(sim_id=self._sid, coordinates=shark_neighbours,
+                                                              fish_positions=fish_positions)
+        for (idx, shark), shark_position, in_reach in zip(sharks.iterrows(), shark_positions, fish_in_reach):
+            # try to find fish (not eaten by a previous shark)
+            has_fish = [c for c in in_reach if (c.x, c.y) in fish_positions]
             if len(has_fish) > 0:
-                # Shark is eating
-                random.shuffle(has_fish)
+                # Shark is eating, neighbours are already in random order
                 eating_coord = has_fish[0]
                 if self._persistence.eat_animal_in_square(sim_id=self._sid, coordinate=eating_coord):
+                    fish_positions.discard((eating_coord.x, eating_coord.y))
                     _logger.debug('{}Shark {} {} eat Fish {} and move'.format(_debug, shark.oid, shark_position,
                                                                               eating_coord))
                     # keep shark ref and position
@@ -157,7 +244,7 @@ class SimulationGrid:
                                                   new_position=eating_coord)
                     # AM: add update to occupied coord
                     self.update_occupied_coord(old_coord=(shark_position.x, shark_position.y),
-                                               new_coord=(eating_coord.x, eating_coord.y))
+                                               new_coord=(eating_coord.x, eating_coord.y), animal_type=Animal.Shark)
                     # add to update dictionary
                     shark_update[shark.oid] = {'last_fed': self._sim_turn}
                 else:
@@ -182,13 +269,15 @@ class SimulationGrid:
         moved = []
         to_update = {}
         # First for sharks
-        sharks = self._persistence.get_animals_by_type(sim_id=self._sid, animal_type=Animal.Shark).sample(frac=1)
-        for idx, shark in sharks.iterrows():
+        sharks = self._shuffled(self._persistence.get_animals_by_type(sim_id=self._sid, animal_type=Animal.Shark))
+        trials = self._breed_trials(len(sharks), simulation_params.shark_breed_probability)
+        orders = self._neighbour_orders(len(sharks))
+        for (idx, shark), breed_trial, order in zip(sharks.iterrows(), trials, orders):
             # can shark breed?
             if (((self._sim_turn - shark.spawn_turn) >= simulation_params.shark_breed_maturity) and
                     ((self._sim_turn - shark.last_breed) >= simulation_params.shark_breed_maturity)):
                 # shark can breed
-                if random.randint(0, 100) <= simulation_params.shark_breed_probability:
+                if breed_trial:
                     # shark is possibly breeding...
                     breed_coord = None
                     if shark.oid in fed_sharks:
@@ -209,7 +298,7 @@ class SimulationGrid:
                         # ... or if free space is available
                         neighbors = square_grid_neighbours(simulation_params.grid_size,
                                                            SquareGridCoordinate(shark.coord_x,
-                                                                                shark.coord_y))
+                                                                                shark.coord_y), permutation=order)
                         for neigh in neighbors:
                             if not self.check_if_occupied(neigh):
                                 breed_coord = SquareGridCoordinate(int(shark.coord_x), int(shark.coord_y))
@@ -220,7 +309,7 @@ class SimulationGrid:
                                                               new_position=neigh, occupied=occupation_flag) # hereinafter: tuple (x,y)
                                 # AM: add update to occupied coord
                                 self.update_occupied_coord(old_coord=coord_to_remove,
-                                                           new_coord=(neigh.x, neigh.y))
+                                                           new_coord=(neigh.x, neigh.y), animal_type=Animal.Shark)
 
                                 # set occupation flag back to None
                                 occupation_flag = None
@@ -238,22 +327,25 @@ class SimulationGrid:
                                                                 animal_type=Animal.Shark, coordinate=breed_coord,
                                                                 last_fed=self._sim_turn)
                         # update the occupied coord
-                        self.update_occupied_coord(new_coord=(breed_coord.x, breed_coord.y))
+                        self.update_occupied_coord(new_coord=(breed_coord.x, breed_coord.y),
+                                                   animal_type=Animal.Shark)
                         _logger.debug('{}Spawning new shark {} {}'.format(_debug, new_oid, breed_coord))
         # Last Fishes, randomize
-        fishes = self._persistence.get_animals_by_type(sim_id=self._sid, animal_type=Animal.Fish).sample(frac=1)
-        for idx, fish in fishes.iterrows():
+        fishes = self._shuffled(self._persistence.get_animals_by_type(sim_id=self._sid, animal_type=Animal.Fish))
+        trials = self._breed_trials(len(fishes), simulation_params.fish_breed_probability)
+        orders = self._neighbour_orders(len(fishes))
+        for (idx, fish), breed_trial, order in zip(fishes.iterrows(), trials, orders):
             # can fish breed?
             if (((self._sim_turn - fish.spawn_turn) >= simulation_params.fish_breed_maturity) and
                     ((self._sim_turn - fish.last_breed) >= simulation_params.fish_breed_maturity)):
                 # fish can breed
-                if random.randint(0, 100) <= simulation_params.fish_breed_probability:
+                if breed_trial:
                     # fish is possibly breeding if free space is available
                     breed_coord = SquareGridCoordinate(int(fish.coord_x), int(fish.coord_y))
                     _logger.debug('{}Fish breeding in {} if space is available'.format(_debug, breed_coord))
                     neighbors = square_grid_neighbours(simulation_params.grid_size,
                                                        SquareGridCoordinate(fish.coord_x,
-                                                                            fish.coord_y))
+                                                                            fish.coord_y), permutation=order)
                     for neigh in neighbors:
                         if not self.check_if_occupied(neigh):
                             _logger.debug('{}Space found in {}, fish breed and move'.format(_debug, neigh))
@@ -265,7 +357,8 @@ class SimulationGrid:
                             coord_to_remove = self._persistence.move_animal(sim_id=self._sid, animal_id=fish.oid,
                                                           new_position=neigh, occupied=occupation_flag)
 
-                            self.update_occupied_coord(new_coord=(neigh.x, neigh.y)) # this only adds new (breed_coord keeps occupied)
+                            # this only adds new (breed_coord keeps occupied)
+                            self.update_occupied_coord(new_coord=(neigh.x, neigh.y), animal_type=Animal.Fish)
                             # set back to None
                             occupation_flag = None
                             moved.append(fish.oid)
@@ -311,8 +404,9 @@ class SimulationGrid:
         """
         _debug = 'Turn: {:<3} - Move - '.format(self._sim_turn)
         simulation_params = self.simulation_params
-        animals = self._persistence.get_animals_by_type(sim_id=self._sid, animal_type=animal_type).sample(frac=1)
-        for _, animal in animals.iterrows():
+        animals = self._shuffled(self._persistence.get_animals_by_type(sim_id=self._sid, animal_type=animal_type))
+        orders = self._neighbour_orders(len(animals))
+        for (_, animal), order in zip(animals.iterrows(), orders):
             if animal.oid in already_moved:
                 # this one has already moved so not moving
                 _logger.debug('{}{} already moved'.format(_debug, animal.oid))
@@ -323,7 +417,8 @@ class SimulationGrid:
                 continue
             else:
                 neighbors = square_grid_neighbours(simulation_params.grid_size, SquareGridCoordinate(animal.coord_x,
-                                                                                                     animal.coord_y))
+                                                                                                     animal.coord_y),
+                                                   permutation=order)
                 for neigh in neighbors:
                     if not self.check_if_occupied(neigh):
                         # move animal to this slot
@@ -333,7 +428,8 @@ class SimulationGrid:
                         coord_to_remove = self._persistence.move_animal(sim_id=self._sid, animal_id=animal.oid,
                                                       new_position=neigh, occupied=occupation_flag)
 
-                        self.update_occupied_coord(old_coord=coord_to_remove, new_coord=(neigh.x, neigh.y))
+                        self.update_occupied_coord(old_coord=coord_to_remove, new_coord=(neigh.x, neigh.y),
+                                                   animal_type=animal_type)
 
                         # set back to None
                         occupation_flag = None
@@ -357,22 +453,34 @@ class SimulationGrid:
         out = (coordinate.x, coordinate.y) in self.occupied_coord
         return out
 
-    def update_occupied_coord(self, old_coord=None, new_coord=None):
+    def update_occupied_coord(self, old_coord=None, new_coord=None, animal_type: Optional[Animal] = None):
         """
         Function to update the set of currently occupied coordinates on the grid.
 
         :param old_coord: tuple of coord-s to remove
         :param new_coord: tuple of coord-s to add
+        :param animal_type: type of the animal taking new_coord, required with new_coord
         :return: void
 
         """
-
+        if new_coord is not None and animal_type is None:
+            raise ValueError('The type of the animal taking {} is required'.format(new_coord))
         if old_coord is not None:
             self.occupied_coord.discard(old_coord) # instead of remove (to pass tests); not greatest approach. Should be remove for proper exception handling
+            self._changed_cells[old_coord] = 0
         if new_coord is not None:
             self.occupied_coord.add(new_coord)
+            self._changed_cells[new_coord] = animal_type.value
         return
 
+    def turn_changes(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Cells changed during the last turn played, with their content at its end (see update_simple_grid)
+        :return: coord_x, coord_y and type code (0: empty, otherwise Animal value) of each cell
+        """
+        changes = np.array([(x, y, code) for (x, y), code in self._changed_cells.items()], dtype=np.int64)
+        return tuple(changes.reshape(-1, 3).T)
+
     def play_turn(self):
         """
         Create a new turn,
@@ -386,10 +494,26 @@ class SimulationGrid:
         :return:
         """
         _logger.debug('********************TURN: {:<3}********************'.format(self._sim_turn))
-        self._check_deads()
-        fed_sharks = self._eat() # these are the coordinates of sharks before eating (after eating they are updated to the new positions)
-        moved_animals = self._breed_and_move(fed_sharks=fed_sharks) # the coordinates of animals before they moved
-        self._move(already_moved=moved_animals)
+        stats = self._stats_recorder
+        stats.start(sim_id=self._sid, turn=self._sim_turn)
+        self._changed_cells = dict()
+        try:
+            # all changes of the turn are committed at once, or rolled back if anything goes wrong
+            with self._persistence.turn_transaction(sim_id=self._sid, turn=self._sim_turn):
+                with stats.phase('_check_deads'):
+                    self._check_deads()
+                with stats.phase('_eat'):
+                    fed_sharks = self._eat() # these are the coordinates of sharks before eating (after eating they are updated to the new positions)
+                with stats.phase('_breed_and_move'):
+                    moved_animals = self._breed_and_move(fed_sharks=fed_sharks) # the coordinates of animals before they moved
+                with stats.phase('_move'):
+                    self._move(already_moved=moved_animals)
+        except Exception:
+            # any error rolls the database back to the previous turn, so must be the animals and occupied coordinates
+            self._load_occupied_coord()
+            self._changed_cells = dict()
+            raise
+        self._record_turn_stats()
         self._sim_turn += 1
         _logger.debug('********************END***************************'.format(self._sim_turn))
         self.check_simulation_ends()
@@ -0,0 +1,297 @@
+"""
+Many independent simulations of the same configuration played in lockstep
+
+The K members of the ensemble share (K, N * N) arrays (cell = x * grid_size + y, as in
+fish_bowl.process.array_engine), one row per member: animal type of each cell, and the attributes of the animal in the
+cell (spawn turn, last breed, last fed, and for the current turn the cell a shark ate from and whether it moved),
+which move with the animal. There is no animal table and no persistence, the ensemble only keeps population counts.
+
+The rules are those of SimulationGrid and stay sequential within a member: in each phase, every member visits its
+animals in its own random order. Step i plays the i-th animal of every member at once, with array operations along
+the ensemble axis, so the python overhead of a turn is paid once for the whole ensemble. Animals of a phase only move
+into free (or fish) cells, the cells of the animals still to visit do not change during the phase.
+
+Members draw from a single generator: member k of a seeded ensemble does not replay the ArraySimulationGrid of the
+same seed, ensembles with the same seed and size are identical.
+"""
+import logging
+from typing import Dict, Optional
+
+import numpy as np
+import pandas as pd
+
+from fish_bowl.process.array_engine import EMPTY, FISH, SHARK
+from fish_bowl.process.base import DictionaryWithAttributes
+from fish_bowl.process.topology import NEIGH_PERMUTATIONS, square_grid_neighbour_rows
+from fish_bowl.process.utils import EndOfSimulatioError
+
+_logger = logging.getLogger(__name__)
+
+# attributes of the animal of each cell, moved along with it: name, dtype, value in empty cells
+CELL_COLUMNS = [('spawn_turn', np.int32, 0), ('last_breed', np.int32, 0), ('last_fed', np.int32, 0),
+                ('fed_from', np.int64, -1), ('moved', np.bool_, False)]
+
+
+class EnsembleSimulationGrid:
+
+    def __init__(self, simulation_parameters: Dict, nb_members: int, seed: Optional[int] = None):
+        """
+        Spawn nb_members independent simulations of the same configuration
+        :param simulation_parameters:
+        :param nb_members: number of simulations of the ensemble
+        :param seed: seed of the random generator shared by all members
+        """
+        self.simulation_params = DictionaryWithAttributes(simulation_parameters)
+        params = self.simulation_params
+        nb_cells = params.grid_size ** 2
+        if nb_cells < params.init_nb_fish + params.init_nb_shark:
+            raise ValueError('initial number of animals bigger than grid size....')
+        if nb_members < 1:
+            raise ValueError('An ensemble needs at least one member, got {}'.format(nb_members))
+        self.nb_members = nb_members
+        self._rng = np.random.default_rng(seed)
+        self._members = np.arange(nb_members)
+        self._sim_turn = 0
+        self.grid = np.zeros((nb_members, nb_cells), dtype=np.int8)
+        for name, dtype, empty in CELL_COLUMNS:
+            setattr(self, name, np.full((nb_members, nb_cells), empty, dtype=dtype))
+        # turn at which the sharks of each member died out (-1 while they live)
+        self.extinction_turn = np.full(nb_members, -1, dtype=np.int64)
+        self.meals = np.zeros(nb_members, dtype=np.int64)
+        self._history = []
+        self._spawn()
+        self._record_population()
+
+    @property
+    def grid_size(self) -> int:
+        return self.simulation_params.grid_size
+
+    @property
+    def active(self) -> np.ndarray:
+        """
+        Members whose simulation has not ended
+        """
+        return self.extinction_turn < 0
+
+    def _spawn(self):
+        """
+        Spawn fishes and sharks on random free cells of every member (at start only)
+        :return:
+        """
+        params = self.simulation_params
+        nb_fish, nb_shark = params.init_nb_fish, params.init_nb_shark
+        nb_cells = self.grid_size ** 2
+        cells = np.argpartition(self._rng.random((self.nb_members, nb_cells)), nb_fish + nb_shark - 1,
+                                axis=1)[:, :nb_fish + nb_shark] if nb_fish + nb_shark > 0 else \
+            np.zeros((self.nb_members, 0), dtype=np.int64)
+        members = self._members[:, None]
+        for animal_type, cells, maturity in ((FISH, cells[:, :nb_fish], params.fish_breed_maturity),
+                                             (SHARK, cells[:, nb_fish:], params.shark_breed_maturity)):
+            # since animal at start can be able to breed, spawn turn (and last breed) can be negative
+            spawn_turn = -self._rng.integers(0, maturity, size=cells.shape, endpoint=True)
+            self.grid[members, cells] = animal_type
+            self.spawn_turn[members, cells] = spawn_turn
+            self.last_breed[members, cells] = spawn_turn
+
+    def _visiting_order(self, mask: np.ndarray) -> np.ndarray:
+        """
+        Cells of mask in a random order per member
+        :param mask: (K, N * N) boolean mask of the animals to visit
+        :return: (K, M) cells, padded with -1, M being the largest number of animals of a member
+        """
+        nb = mask.sum(axis=1)
+        width = int(nb.max()) if len(nb) > 0 else 0
+        if width == 0:
+            return np.zeros((self.nb_members, 0), dtype=np.int64)
+        keys = self._rng.random(mask.shape)
+        keys[~mask] = 2.
+        cells = np.argpartition(keys, width - 1, axis=1)[:, :width] if width < mask.shape[1] else \
+            np.tile(np.arange(mask.shape[1]), (self.nb_members, 1))
+        cells = np.take_along_axis(cells, np.argsort(np.take_along_axis(keys, cells, axis=1), axis=1), axis=1)
+        cells[np.arange(width)[None, :] >= nb[:, None]] = -1
+        return cells
+
+    def _neighbour_candidates(self, cells: np.ndarray) -> np.ndarray:
+        """
+        Neighbour cells of each visited cell, in a random visiting order
+        :param cells: (K, M) cells
+        :return: (K, M, 8) array of cells
+        """
+        permutations = NEIGH_PERMUTATIONS[self._rng.integers(0, len(NEIGH_PERMUTATIONS), size=cells.shape)]
+        neighbours = square_grid_neighbour_rows(self.grid_size, np.maximum(cells, 0).ravel())
+        return np.take_along_axis(neighbours.reshape(cells.shape + (8,)), permutations.astype(np.intp), axis=2)
+
+    def _first(self, members: np.ndarray, candidates: np.ndarray, animal_type: int):
+        """
+        First candidate cell holding animal_type, per member
+        :return: members that found one and the cell found
+        """
+        match = self.grid[members[:, None], candidates] == animal_type
+        found = match.any(axis=1)
+        cells = candidates[np.arange(len(members)), match.argmax(axis=1)]
+        return members[found], cells[found]
+
+    def _move(self, members: np.ndarray, old_cells: np.ndarray, new_cells: np.ndarray):
+        """
+        Move the animals of old_cells to new_cells (one animal per member)
+        """
+        self.grid[members, new_cells] = self.grid[members, old_cells]
+        self.grid[members, old_cells] = EMPTY
+        for name, _, empty in CELL_COLUMNS:
+            column = getattr(self, name)
+            column[members, new_cells] = column[members, old_cells]
+            column[members, old_cells] = empty
+
+    def _spawn_children(self, members: np.ndarray, cells: np.ndarray, animal_type: int):
+        self.grid[members, cells] = animal_type
+        self.spawn_turn[members, cells] = self._sim_turn
+        self.last_breed[members, cells] = 0
+        self.last_fed[members, cells] = self._sim_turn
+        self.fed_from[members, cells] = -1
+        self.moved[members, cells] = False
+
+    def _phase_mask(self, animal_type: int) -> np.ndarray:
+        return (self.grid == animal_type) & self.active[:, None]
+
+    def _check_deads(self):
+        """
+        sharks that did not eat since 'shark_starve' nb of turns, dies
+        :return:
+        """
+        starving = self._phase_mask(SHARK) & ((self._sim_turn - self.last_fed) > self.simulation_params.shark_starving)
+        self.grid[starving] = EMPTY
+        return
+
+    def _eat(self):
+        """
+        Sharks that are adjacent to a Fish square eat and move into fish square (and do not move after)
+        :return:
+        """
+        self.fed_from[:] = -1
+        self.moved[:] = False
+        order = self._visiting_order(self._phase_mask(SHARK))
+        candidates = self._neighbour_candidates(order)
+        for i in range(order.shape[1]):
+            members = np.flatnonzero(order[:, i] >= 0)
+            members, fish_cells = self._first(members, candidates[members, i], FISH)
+            shark_cells = order[members, i]
+            self._move(members, shark_cells, fish_cells)
+            self.last_fed[members, fish_cells] = self._sim_turn
+            self.fed_from[members, fish_cells] = shark_cells
+            self.moved[members, fish_cells] = True
+            self.meals[members] += 1
+        return
+
+    def _breed_and_move(self):
+        """
+        Sharks or Fish that can breed, do so in same square (and Move), others moves if free space
+        - Shark Breed first
+        - Then Fish
+        :return:
+        """
+        params = self.simulation_params
+        turn = self._sim_turn
+        for animal_type, maturity, probability in ((SHARK, params.shark_breed_maturity,
+                                                    params.shark_breed_probability),
+                                                   (FISH, params.fish_breed_maturity, params.fish_breed_probability)):
+            mature = ((turn - self.spawn_turn) >= maturity) & ((turn - self.last_breed) >= maturity)
+            draw = self._rng.integers(0, 100, size=self.grid.shape, endpoint=True) <= probability
+            order = self._visiting_order(self._phase_mask(animal_type) & mature & draw)
+            candidates = self._neighbour_candidates(order)
+            for i in range(order.shape[1]):
+                members = np.flatnonzero(order[:, i] >= 0)
+                cells = order[members, i]
+                fed_from = self.fed_from[members, cells]
+                # shark that ate breeds in its previous cell if nobody took it in the meantime
+                ate = fed_from >= 0
+                breeding = ate & (self.grid[members, fed_from] == EMPTY)
+                self.last_breed[members[breeding], cells[breeding]] = turn
+                self._spawn_children(members[breeding], fed_from[breeding], animal_type)
+                # others move and leave the child in their previous cell
+                moving, new_cells = self._first(members[~ate], candidates[members[~ate], i], EMPTY)
+                old_cells = order[moving, i]
+                self._move(moving, old_cells, new_cells)
+                self.last_breed[moving, new_cells] = turn
+                self.moved[moving, new_cells] = True
+                self._spawn_children(moving, old_cells, animal_type)
+        return
+
+    def _move_animals(self):
+        """
+        Those who can move do so (Free space around), fishes first then sharks, animals that already moved or were
+        just spawn do not move
+        :return:
+        """
+        for animal_type in (FISH, SHARK):
+            mask = self._phase_mask(animal_type) & ~self.moved & (self.spawn_turn != self._sim_turn)
+            order = self._visiting_order(mask)
+            candidates = self._neighbour_candidates(order)
+            for i in range(order.shape[1]):
+                members = np.flatnonzero(order[:, i] >= 0)
+                members, new_cells = self._first(members, candidates[members, i], EMPTY)
+                self._move(members, order[members, i], new_cells)
+        return
+
+    def _record_population(self):
+        self._history.append(((self.grid == FISH).sum(axis=1), (self.grid == SHARK).sum(axis=1)))
+
+    def play_turn(self):
+        """
+        Play a turn on every member whose simulation has not ended, members whose sharks died out are frozen
+        :return:
+        """
+        if not self.active.any():
+            raise EndOfSimulatioError('Simulation ends because no more Sharks in any member')
+        self._check_deads()
+        self._eat()
+        self._breed_and_move()
+        self._move_animals()
+        self._sim_turn += 1
+        self._record_population()
+        fish, shark = self._history[-1]
+        ended = self.active & (shark == 0)
+        self.extinction_turn[ended] = self._sim_turn
+        if ended.any():
+            _logger.info('Turn: {:<3} - Sharks died out in {} members'.format(self._sim_turn, ended.sum()))
+        return
+
+    def run(self, max_turns: int) -> pd.DataFrame:
+        """
+        Play up to max_turns turns, until the sharks of every member died out
+        :param max_turns:
+        :return: population history (see population_history)
+        """
+        for _ in range(max_turns):
+            try:
+                self.play_turn()
+            except EndOfSimulatioError:
+                break
+        return self.population_history()
+
+    def get_type_grid(self) -> np.ndarray:
+        """
+        Grids of animal types (0: empty, 1: Fish, 2: Shark), indexed [member, x, y]
+        :return:
+        """
+        return self.grid.reshape(self.nb_members, self.grid_size, self.grid_size)
+
+    @property
+    def population(self) -> pd.DataFrame:
+        """
+        Current number of fishes and sharks of each member
+        """
+        fish, shark = self._history[-1]
+        return pd.DataFrame({'fish': fish, 'shark': shark})
+
+    def population_history(self) -> pd.DataFrame:
+        """
+        Number of fishes and sharks of each member after each turn (turn 0 being the initial spawn), frozen members
+        keep their last population
+        :return: DataFrame with columns member, turn, fish, shark
+        """
+        fish = np.stack([f for f, _ in self._history], axis=1)
+        shark = np.stack([s for _, s in self._history], axis=1)
+        turns = np.arange(len(self._history))
+        return pd.DataFrame({'member': np.repeat(self._members, len(turns)),
+                             'turn': np.tile(turns, self.nb_members),
+                             'fish': fish.ravel(), 'shark': shark.ravel()})
@@ -0,0 +1,228 @@
+"""
+Compiled loops of the array engine (see fish_bowl.process.array_engine)
+
+Eating, breeding and moving are sequential: every animal sees the cells left by the previous one, so these loops
+cannot be written as array operations. They are written here over flat numpy arrays (type grid, slot grid, animal
+columns, neighbour candidates) and compiled with numba when it is installed. Without numba the very same functions
+run as plain python, so the semantics do not depend on it. Random draws stay outside: the kernels get the visiting
+order and the neighbour candidates already drawn.
+
+The type and slot grids are either dense arrays indexed by cell or, on sparse grids, a single cell table: hash table
+of the occupied cells and their slot held in an int64 array (see fish_bowl.process.tiles.CellTable), passed as both
+grids, types being read through the slots. A cell table has a header row (number of cells, empty value) then one
+(cell, value) row per bucket, FREE cells for empty buckets. Collisions are resolved by linear probing and entries are
+removed by shifting back the rest of their run, so the table never fills up with deleted entries.
+"""
+try:
+    import numba
+except ImportError:  # kernels then run as plain python
+    numba = None
+
+NUMBA_AVAILABLE = numba is not None
+
+EMPTY = 0
+FISH = 1
+FREE = -1  # cell of an empty bucket of a cell table
+
+
+def _jit(function):
+    if numba is None:
+        return function
+    return numba.njit(cache=True, nogil=True)(function)
+
+
+@_jit
+def _bucket(cell, mask):
+    """
+    First bucket probed for cell (buckets are numbered from 0, row 0 of the table is the header). Only the low bits of
+    the product are kept, they only depend on the low bits of its factors: masking first avoids overflows
+    """
+    return (((cell ^ (cell >> 21) ^ (cell >> 42)) & mask) * 2654435761) & mask
+
+
+@_jit
+def _find(table, cell):
+    """
+    Row of cell in table, or of the free row where it would go
+    """
+    mask = table.shape[0] - 2
+    i = _bucket(cell, mask)
+    while table[i + 1, 0] != cell and table[i + 1, 0] != FREE:
+        i = (i + 1) & mask
+    return i + 1
+
+
+@_jit
+def table_get(table, cell):
+    row = _find(table, cell)
+    if table[row, 0] == FREE:
+        return table[0, 1]
+    return table[row, 1]
+
+
+@_jit
+def table_set(table, cell, value):
+    """
+    Set the value of cell, the empty value removes it (the table must have a free bucket, see CellTable.reserve)
+    """
+    row = _find(table, cell)
+    if table[row, 0] == FREE:
+        if value != table[0, 1]:
+            table[row, 0] = cell
+            table[row, 1] = value
+            table[0, 0] += 1
+    elif value != table[0, 1]:
+        table[row, 1] = value
+    else:
+        _remove(table, row - 1)
+
+
+@_jit
+def _remove(table, i):
+    """
+    Empty bucket i, moving back the entries of the run after it that would not be found anymore
+    """
+    mask = table.shape[0] - 2
+    table[0, 0] -= 1
+    j = i
+    while True:
+        j = (j + 1) & mask
+        cell = table[j + 1, 0]
+        if cell == FREE:
+            break
+        home = _bucket(cell, mask)
+        # the entry stays if its first bucket lies in (i, j], cyclically
+        if (i < home <= j) if i <= j else (home > i or home <= j):
+            continue
+        table[i + 1, 0] = cell
+        table[i + 1, 1] = table[j + 1, 1]
+        i = j
+    table[i + 1, 0] = FREE
+
+
+@_jit
+def table_get_many(table, cells, values):
+    for i in range(len(cells)):
+        values[i] = table_get(table, cells[i])
+
+
+@_jit
+def table_set_many(table, cells, values):
+    for i in range(len(cells)):
+        table_set(table, cells[i], values[i])
+
+
+@_jit
+def _slot_at(slot, cell):
+    if slot.ndim == 1:
+        return slot[cell]
+    return table_get(slot, cell)
+
+
+@_jit
+def _type_at(grid, slot, animal_type, cell):
+    if grid.ndim == 1:
+        return grid[cell]
+    row = table_get(slot, cell)
+    return EMPTY if row < 0 else animal_type[row]
+
+
+@_jit
+def _fill(grid, slot, cell, animal_type, row):
+    if grid.ndim == 1:
+        grid[cell] = animal_type
+        slot[cell] = row
+    else:
+        table_set(slot, cell, row)
+
+
+@_jit
+def _clear(grid, slot, cell):
+    if grid.ndim == 1:
+        grid[cell] = EMPTY
+        slot[cell] = -1
+    else:
+        table_set(slot, cell, -1)
+
+
+@_jit
+def _move_row(grid, slot, cell, animal_type, dirty, row, new_cell):
+    _clear(grid, slot, cell[row])
+    _fill(grid, slot, new_cell, animal_type[row], row)
+    cell[row] = new_cell
+    dirty[row] = True
+
+
+@_jit
+def eat_kernel(rows, candidates, grid, slot, cell, animal_type, alive, dirty, last_fed, fed_from, turn):
+    """
+    Sharks of rows, in this order, eat the first fish among their neighbour candidates and move into its cell
+    :return: number of fish eaten
+    """
+    meals = 0
+    for i in range(len(rows)):
+        row = rows[i]
+        shark_cell = cell[row]
+        for k in range(candidates.shape[1]):
+            neigh = candidates[i, k]
+            if _type_at(grid, slot, animal_type, neigh) == FISH:
+                fish = _slot_at(slot, neigh)
+                _clear(grid, slot, neigh)
+                alive[fish] = False
+                dirty[fish] = True
+                _move_row(grid, slot, cell, animal_type, dirty, row, neigh)
+                last_fed[row] = turn
+                fed_from[row] = shark_cell
+                meals += 1
+                break
+    return meals
+
+
+@_jit
+def breed_and_move_kernel(rows, candidates, fed_from, moved, grid, slot, cell, animal_type, dirty, last_breed,
+                          breed_count, turn, first_child_row, child_cells):
+    """
+    Animals of rows, in this order, breed: sharks that ate in the cell they ate from (if still free), others move to
+    their first free neighbour candidate and leave the child in their previous cell.
+    Children take rows first_child_row, first_child_row + 1... in the grid, their cells are written to child_cells
+    (the caller appends them to the animal columns)
+    :return: number of children
+    """
+    nb_children = 0
+    for i in range(len(rows)):
+        row = rows[i]
+        breed_cell = -1
+        if row < len(fed_from) and fed_from[row] >= 0:
+            if _slot_at(slot, fed_from[row]) < 0:
+                breed_cell = fed_from[row]
+        else:
+            for k in range(candidates.shape[1]):
+                neigh = candidates[i, k]
+                if _slot_at(slot, neigh) < 0:
+                    breed_cell = cell[row]
+                    _move_row(grid, slot, cell, animal_type, dirty, row, neigh)
+                    moved[row] = True
+                    break
+        if breed_cell >= 0:
+            last_breed[row] = turn
+            breed_count[row] += 1
+            dirty[row] = True
+            _fill(grid, slot, breed_cell, animal_type[row], first_child_row + nb_children)
+            child_cells[nb_children] = breed_cell
+            nb_children += 1
+    return nb_children
+
+
+@_jit
+def move_kernel(rows, candidates, grid, slot, cell, animal_type, dirty):
+    """
+    Animals of rows, in this order, move to their first free neighbour candidate
+    """
+    for i in range(len(rows)):
+        row = rows[i]
+        for k in range(candidates.shape[1]):
+            neigh = candidates[i, k]
+            if _slot_at(slot, neigh) < 0:
+                _move_row(grid, slot, cell, animal_type, dirty, row, neigh)
+                break
+
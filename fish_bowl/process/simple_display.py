@@ -1,12 +1,28 @@
 import numpy as np
 import pandas as pd
-from typing import List, Tuple
+from typing import List, Optional, Tuple
+
+from fish_bowl.process.utils import Animal
 
 
 """
 Display a grid 0-grid-1 x 0 -grid-1
 """
 
+_TYPE_CODES = {a: a.value for a in Animal}
+
+
+def animal_type_codes(animal_df: pd.DataFrame) -> np.ndarray:
+    """
+    Integer code of the animal_type column (Animal enum or already integer)
+    :param animal_df:
+    :return:
+    """
+    types = animal_df.animal_type
+    if pd.api.types.is_integer_dtype(types.dtype):
+        return types.to_numpy()
+    return types.map(_TYPE_CODES).to_numpy(dtype=np.int64)
+
 
 def convert_df_to_position(animal_df: pd.DataFrame) -> List[Tuple[int, Tuple[int, int]]]:
     """
@@ -14,20 +30,40 @@ def convert_df_to_position(animal_df: pd.DataFrame) -> List[Tuple[int, Tuple[int
     :param animal_df:
     :return:
     """
-    pos_list = []
-    for idx, row in animal_df.iterrows():
-        pos_list.append((row.animal_type.value, (row.coord_x, row.coord_y)))
-    return pos_list
+    return list(zip(animal_type_codes(animal_df).tolist(),
+                    zip(animal_df.coord_x.tolist(), animal_df.coord_y.tolist())))
 
 
-def display_simple_grid(animal_df: pd.DataFrame, grid_size):
+def display_simple_grid(animal_df: pd.DataFrame, grid_size, window: Optional[Tuple[int, int, int, int]] = None):
     """
-    set the list of tuple (animal, position) into a numpy 2d array
+    set the animals of the dataframe into a numpy 2d array (0: empty, 1: Fish, 2: Shark)
     :param animal_df:
     :param grid_size:
+    :param window: (x, y, width, height) part of the grid to display (whole grid if None), for grids too large
+    to be held in a dense array
     :return:
     """
-    grid = np.zeros(shape=(grid_size, grid_size), dtype=np.int)
-    for at, pos in convert_df_to_position(animal_df):
-        grid[pos[0], pos[1]] = at
+    x0, y0, width, height = (0, 0, grid_size, grid_size) if window is None else window
+    coord_x = animal_df.coord_x.to_numpy(dtype=np.int64) - x0
+    coord_y = animal_df.coord_y.to_numpy(dtype=np.int64) - y0
+    codes = animal_type_codes(animal_df)
+    if window is not None:
+        inside = (coord_x >= 0) & (coord_x < width) & (coord_y >= 0) & (coord_y < height)
+        coord_x, coord_y, codes = coord_x[inside], coord_y[inside], codes[inside]
+    grid = np.zeros(shape=(width, height), dtype=int)
+    grid[coord_x, coord_y] = codes
+    return grid
+
+
+def update_simple_grid(grid: np.ndarray, coord_x: np.ndarray, coord_y: np.ndarray, codes: np.ndarray) -> np.ndarray:
+    """
+    Update in place the grid of the previous frame (see display_simple_grid), touching only the cells changed during
+    the turn, as reported by the engine (turn_changes of SimulationGrid and ArraySimulationGrid)
+    :param grid: previous frame
+    :param coord_x:
+    :param coord_y:
+    :param codes: content of the cells at the end of the turn (0: empty, 1: Fish, 2: Shark)
+    :return: the updated grid
+    """
+    grid[coord_x, coord_y] = codes
     return grid
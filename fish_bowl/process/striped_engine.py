@@ -0,0 +1,264 @@
+"""
+Domain decomposition of a single simulation over worker processes
+
+The grid is cut along x in an even number of stripes (at least 2 rows wide), the torus wrapping stripe 0 next to the
+last one. Every phase of the turn (eat, shark breeding, fish breeding, fish moves, shark moves) is played in two
+passes: even stripes together, then odd ones. In a pass, a worker gets the animals of its stripe and of the halo rows
+on both sides (the last row of the previous stripe and the first row of the next one), plays the phase for the
+animals of its stripe with the kernels of the array engine on arrays of the window cells, and sends back the changes
+of the whole window. An animal reaches at most one row away from its own, so the windows of a pass never overlap and
+cross-boundary moves, meals and births cannot conflict; an animal that crossed into a stripe of the next pass is
+flagged as having acted and is not played twice.
+
+The result only depends on the seed and the number of stripes, not on the number of workers: each stripe draws from
+its own generator, seeded by the simulation seed, the turn, the pass and the stripe.
+"""
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from fish_bowl.dataio.persistence import SimulationClient
+from fish_bowl.process.array_engine import ArraySimulationGrid, EMPTY, FISH, SHARK
+from fish_bowl.process.kernels import eat_kernel, breed_and_move_kernel, move_kernel
+from fish_bowl.process.tiles import CellTable
+from fish_bowl.process.topology import NEIGH_PERMUTATIONS, DENSE_TABLE_MAX_CELLS, square_grid_neighbour_rows
+from fish_bowl.process.utils import Animal
+
+_logger = logging.getLogger(__name__)
+
+# columns sent to the workers, changed ones are sent back
+WINDOW_COLUMNS = ['cell', 'animal_type', 'spawn_turn', 'breed_count', 'last_breed', 'last_fed', 'alive']
+TURN_COLUMNS = ['fed_from', 'moved', 'acted']
+PHASE_PASSES = [('eat', SHARK), ('breed', SHARK), ('breed', FISH), ('move', FISH), ('move', SHARK)]
+
+
+def _window_grids(grid_size: int, nb_rows: int, cells: np.ndarray, animal_type: np.ndarray):
+    """
+    Type and slot grids of a window over its local cells, as the kernels take them (see
+    ArraySimulationGrid._kernel_grids): dense arrays, or a cell table for both on windows of more than
+    DENSE_TABLE_MAX_CELLS cells. There is room for a child per animal
+    """
+    nb_cells = nb_rows * grid_size
+    rows = np.arange(len(cells), dtype=np.int64)
+    if nb_cells > DENSE_TABLE_MAX_CELLS:
+        slot = CellTable(grid_size, empty=-1, dtype=np.int64, capacity=2 * len(cells))
+        slot[cells] = rows
+        return slot.table, slot.table
+    grid = np.zeros(nb_cells, dtype=np.int8)
+    slot = np.full(nb_cells, -1, dtype=np.int64)
+    grid[cells] = animal_type
+    slot[cells] = rows
+    return grid, slot
+
+
+def play_stripe(task: Dict) -> Dict:
+    """
+    Play a phase for the animals of a stripe (run by the workers), with the kernels of the array engine (see
+    fish_bowl.process.kernels) over the cells of the window, numbered from its first row
+    :param task: phase, phase_type (animals playing), turn, grid_size, params (breeding maturity and probability),
+    seed, window (first row and number of rows), own (animals of the stripe among the window ones) and window animal
+    columns
+    :return: window columns after the phase, children (type and cell) and number of meals
+    """
+    rng = np.random.default_rng(task['seed'])
+    grid_size, turn, phase = task['grid_size'], task['turn'], task['phase']
+    first_row, nb_rows = task['window']
+    columns = {name: task[name].copy() for name in WINDOW_COLUMNS + TURN_COLUMNS}
+    animal_type, fed_from, acted = columns['animal_type'], columns['fed_from'], columns['acted']
+
+    def to_local(cells: np.ndarray) -> np.ndarray:
+        x, y = np.divmod(cells, grid_size)
+        return (x - first_row) % grid_size * grid_size + y
+
+    def to_global(cells: np.ndarray) -> np.ndarray:
+        x, y = np.divmod(cells, grid_size)
+        return (x + first_row) % grid_size * grid_size + y
+
+    # window animals are all alive, each in its own cell
+    cell = to_local(columns['cell'])
+    fed = fed_from >= 0
+    fed_from[fed] = to_local(fed_from[fed])
+    grid, slot = _window_grids(grid_size, nb_rows, cell, animal_type)
+    dirty = np.zeros(len(cell), dtype=np.bool_)
+    children_cell = np.zeros(0, dtype=np.int64)
+    meals = 0
+
+    candidates = task['own'] & (animal_type == task['phase_type']) & ~acted
+    if phase == 'move':
+        candidates &= ~columns['moved'] & (columns['spawn_turn'] != turn)
+    rows = rng.permutation(np.flatnonzero(candidates))
+    acted[rows] = True
+    if phase == 'breed':
+        maturity, probability = task['params']
+        mature = ((turn - columns['spawn_turn'][rows]) >= maturity) & ((turn - columns['last_breed'][rows]) >= maturity)
+        rows = rows[mature & (rng.integers(0, 100, size=len(rows), endpoint=True) <= probability)]
+    permutations = NEIGH_PERMUTATIONS[rng.integers(0, len(NEIGH_PERMUTATIONS), size=len(rows))]
+    neighbours = np.take_along_axis(square_grid_neighbour_rows(grid_size, columns['cell'][rows]),
+                                    permutations.astype(np.intp), axis=1)
+    neighbours = to_local(neighbours)
+    if phase == 'eat':
+        meals = int(eat_kernel(rows, neighbours, grid, slot, cell, animal_type, columns['alive'], dirty,
+                               columns['last_fed'], fed_from, turn))
+        columns['moved'] |= fed_from >= 0
+    elif phase == 'breed':
+        children_cell = np.zeros(len(rows), dtype=np.int64)
+        nb_children = breed_and_move_kernel(rows, neighbours, fed_from, columns['moved'], grid, slot, cell,
+                                            animal_type, dirty, columns['last_breed'], columns['breed_count'], turn,
+                                            len(cell), children_cell)
+        children_cell = to_global(children_cell[:nb_children])
+    elif phase == 'move':
+        move_kernel(rows, neighbours, grid, slot, cell, animal_type, dirty)
+    else:
+        raise ValueError('Unknown phase {}'.format(phase))
+    columns['cell'] = to_global(cell)
+    fed = fed_from >= 0
+    fed_from[fed] = to_global(fed_from[fed])
+    children_type = np.full(len(children_cell), task['phase_type'], dtype=np.int8)
+    return dict(columns, rows=task['rows'], children_type=children_type, children_cell=children_cell, meals=meals)
+
+
+class StripedSimulationGrid(ArraySimulationGrid):
+    """
+    ArraySimulationGrid whose phases are played stripe by stripe over a pool of worker processes
+    (see the module docstring for the decomposition)
+    """
+
+    def __init__(self, simulation_parameters: Dict, persistence: Optional[SimulationClient] = None,
+                 seed: Optional[int] = None, workers: Optional[int] = None, stripes: Optional[int] = None,
+                 sparse: Optional[bool] = None):
+        """
+        :param simulation_parameters:
+        :param persistence: see ArraySimulationGrid
+        :param seed:
+        :param workers: number of worker processes (number of cores if None, phases are played in this process if 1)
+        :param stripes: number of stripes, even and at most grid_size // 2 (twice the number of workers if None)
+        :param sparse: see ArraySimulationGrid
+        """
+        grid_size = simulation_parameters['grid_size']
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        if stripes is None:
+            stripes = min(2 * max(self.workers, 1), grid_size // 2 - (grid_size // 2) % 2)
+        if stripes < 2 or stripes % 2 == 1 or grid_size // stripes < 2:
+            raise ValueError('Number of stripes must be even, at least 2 and leave 2 rows per stripe, got {} for a '
+                             'grid of {}'.format(stripes, grid_size))
+        self.stripes = stripes
+        self._bounds = np.array([i * grid_size // stripes for i in range(stripes + 1)], dtype=np.int64)
+        super().__init__(simulation_parameters=simulation_parameters, persistence=persistence, seed=seed,
+                         sparse=sparse)
+        # seeds of the stripes' generators derive from this one
+        self._stripe_seed = int(self._rng.integers(2 ** 63))
+        self._pool = ProcessPoolExecutor(max_workers=self.workers) if self.workers > 1 else None
+        self._turn_columns = None
+
+    def close(self):
+        """
+        Stop the worker processes (and the write-behind writer)
+        """
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        super().close()
+
+    def _window_tasks(self, phase: str, animal_type: int, pass_index: int, colour: int) -> List[Dict]:
+        animals = self.animals
+        rows = animals.live_rows()
+        x = animals.cell[rows] // self.grid_size
+        stripe = np.searchsorted(self._bounds, x, side='right') - 1
+        params = self.simulation_params
+        breeding = {SHARK: (params.shark_breed_maturity, params.shark_breed_probability),
+                    FISH: (params.fish_breed_maturity, params.fish_breed_probability)}[animal_type]
+        tasks = []
+        for i in range(colour, self.stripes, 2):
+            start, end = self._bounds[i], self._bounds[i + 1]
+            own = stripe == i
+            window = own | (x == (start - 1) % self.grid_size) | (x == end % self.grid_size)
+            window_rows = rows[window]
+            task = {name: getattr(animals, name)[window_rows] for name in WINDOW_COLUMNS}
+            task.update({name: self._turn_columns[name][window_rows] for name in TURN_COLUMNS})
+            task.update(rows=window_rows, own=own[window], phase=phase, phase_type=animal_type,
+                        turn=self._sim_turn, grid_size=self.grid_size, params=breeding,
+                        seed=[self._stripe_seed, self._sim_turn, pass_index, i],
+                        window=((start - 1) % self.grid_size, end - start + 2))
+            tasks.append(task)
+        return tasks
+
+    def _merge(self, result: Dict):
+        """
+        Write back the window of a stripe: grid cells, animal columns, children and counters
+        """
+        animals = self.animals
+        rows = result['rows']
+        old_cell = animals.cell[rows]
+        dead = animals.alive[rows] & ~result['alive']
+        changed = dead | (old_cell != result['cell']) | (animals.breed_count[rows] != result['breed_count']) | \
+            (animals.last_fed[rows] != result['last_fed'])
+        # vacate first: animals of the window may have swapped cells
+        self.grid[old_cell] = EMPTY
+        self.slot[old_cell] = -1
+        for name in WINDOW_COLUMNS:
+            getattr(animals, name)[rows] = result[name]
+        for name in TURN_COLUMNS:
+            self._turn_columns[name][rows] = result[name]
+        animals.dirty[rows[changed]] = True
+        live = rows[result['alive']]
+        self.grid[animals.cell[live]] = animals.animal_type[live]
+        self.slot[animals.cell[live]] = live
+        for animal_type in (FISH, SHARK):
+            nb = int((animals.animal_type[rows[dead]] == animal_type).sum())
+            if nb > 0:
+                self.counters.died(Animal(animal_type), nb)
+        self.counters.meals += result['meals']
+        children = len(result['children_cell'])
+        if children > 0:
+            animals.reserve(children)
+            for animal_type in (FISH, SHARK):
+                cells = result['children_cell'][result['children_type'] == animal_type]
+                if len(cells) == 0:
+                    continue
+                child_rows = animals.extend(self._next_oid, animal_type, cells, spawn_turn=self._sim_turn,
+                                            last_breed=0, last_fed=self._sim_turn)
+                self._next_oid += len(cells)
+                self.counters.born(Animal(animal_type), len(cells))
+                self.grid[cells] = animal_type
+                self.slot[cells] = child_rows
+            self._grow_turn_columns()
+
+    def _grow_turn_columns(self):
+        extra = self.animals.size - len(self._turn_columns['moved'])
+        if extra > 0:
+            self._turn_columns['fed_from'] = np.r_[self._turn_columns['fed_from'], np.full(extra, -1, dtype=np.int64)]
+            self._turn_columns['moved'] = np.r_[self._turn_columns['moved'], np.zeros(extra, dtype=np.bool_)]
+            self._turn_columns['acted'] = np.r_[self._turn_columns['acted'], np.zeros(extra, dtype=np.bool_)]
+
+    def _play_phase(self, phase: str, animal_type: int):
+        pass_index = PHASE_PASSES.index((phase, animal_type))
+        self._turn_columns['acted'][:] = False
+        for colour in (0, 1):
+            tasks = self._window_tasks(phase, animal_type, pass_index, colour)
+            if self._pool is None:
+                results = map(play_stripe, tasks)
+            else:
+                results = self._pool.map(play_stripe, tasks)
+            # stripes of a pass touch disjoint windows, merged in stripe order for reproducible oids
+            for result in results:
+                self._merge(result)
+
+    def _eat(self) -> np.ndarray:
+        size = self.animals.size
+        self._turn_columns = {'fed_from': np.full(size, -1, dtype=np.int64), 'moved': np.zeros(size, dtype=np.bool_),
+                              'acted': np.zeros(size, dtype=np.bool_)}
+        self._play_phase('eat', SHARK)
+        return self._turn_columns['fed_from']
+
+    def _breed_and_move(self, fed_from: np.ndarray) -> np.ndarray:
+        self._play_phase('breed', SHARK)
+        self._play_phase('breed', FISH)
+        return self._turn_columns['moved']
+
+    def _move(self, already_moved: np.ndarray):
+        self._play_phase('move', FISH)
+        self._play_phase('move', SHARK)
+        return
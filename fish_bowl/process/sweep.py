@@ -0,0 +1,149 @@
+"""
+Parameter sweeps: many simulations run in parallel processes, population series gathered in one columnar file
+"""
+import itertools
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+from fish_bowl.dataio.persistence import SimulationClient
+from fish_bowl.process.array_engine import ArraySimulationGrid
+from fish_bowl.process.base import SimulationGrid
+from fish_bowl.process.utils import Animal, EndOfSimulatioError
+
+_logger = logging.getLogger(__name__)
+
+ENGINES = ['db', 'array']
+
+
+def parameter_grid(base_config: Dict, grid: Dict[str, List]) -> List[Dict]:
+    """
+    Every combination of the parameter values of grid, on top of base_config
+    :param base_config: simulation configuration
+    :param grid: parameter name -> list of values
+    :return: list of simulation configurations
+    """
+    unknown = set(grid) - set(base_config)
+    if len(unknown) > 0:
+        raise ValueError('Unknown simulation parameters: {}'.format(sorted(unknown)))
+    names = sorted(grid)
+    return [dict(base_config, **dict(zip(names, values))) for values in itertools.product(*[grid[n] for n in names])]
+
+
+def sweep_runs(configs: List[Dict], seeds: List[int]) -> List[Dict]:
+    """
+    One run per configuration and seed
+    :param configs:
+    :param seeds:
+    :return: list of runs (run_id, seed, config)
+    """
+    return [{'run_id': run_id, 'seed': seed, 'config': config}
+            for run_id, (config, seed) in enumerate(itertools.product(configs, seeds))]
+
+
+def run_simulation(run: Dict, max_turn: int, engine: str = 'db') -> pd.DataFrame:
+    """
+    Play a simulation in its own in-memory database (this is what a sweep worker does)
+    :param run: see sweep_runs
+    :param max_turn:
+    :param engine: 'db' (SimulationGrid) or 'array' (ArraySimulationGrid)
+    :return: population at start and after each turn, with the run parameters as columns
+    """
+    client = SimulationClient('sqlite:///:memory:')
+    if engine == 'array':
+        grid = ArraySimulationGrid(simulation_parameters=run['config'], persistence=client, seed=run['seed'])
+    else:
+        grid = SimulationGrid(persistence=client, simulation_parameters=run['config'], seed=run['seed'])
+    turns, fish, sharks = [], [], []
+
+    def count():
+        population = grid.population
+        turns.append(grid._sim_turn)
+        fish.append(int(population.get(Animal.Fish, 0)))
+        sharks.append(int(population.get(Animal.Shark, 0)))
+
+    count()
+    for _ in range(max_turn):
+        try:
+            grid.play_turn()
+        except EndOfSimulatioError:
+            count()
+            break
+        count()
+    client._engine.dispose()
+    series = pd.DataFrame({'turn': turns, 'fish': fish, 'shark': sharks})
+    for k, v in dict(run['config'], run_id=run['run_id'], seed=run['seed']).items():
+        series[k] = v
+    return series
+
+
+class SweepResultsWriter:
+    """
+    Append the population series of the runs to a columnar file as they complete:
+    parquet (one row group per run, needs pyarrow) or csv
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._parquet = os.path.splitext(path)[1].lower() == '.parquet'
+        self._writer = None
+        self._columns = None
+        if os.path.isfile(path):
+            os.remove(path)
+
+    def write(self, series: pd.DataFrame):
+        if self._columns is None:
+            self._columns = ['run_id', 'seed', 'turn', 'fish', 'shark'] + \
+                            sorted(c for c in series.columns if c not in ['run_id', 'seed', 'turn', 'fish', 'shark'])
+        series = series[self._columns]
+        if self._parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(series, preserve_index=False)
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(self.path, table.schema)
+            self._writer.write_table(table)
+        else:
+            series.to_csv(self.path, mode='a', header=not os.path.isfile(self.path), index=False)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+def read_sweep_results(path: str) -> pd.DataFrame:
+    if os.path.splitext(path)[1].lower() == '.parquet':
+        return pd.read_parquet(path)
+    return pd.read_csv(path)
+
+
+def run_sweep(runs: List[Dict], max_turn: int, output: str, engine: str = 'db',
+              max_workers: Optional[int] = None) -> int:
+    """
+    Fan the runs out over a process pool, each worker owning its in-memory SimulationClient,
+    and write their population series to output as they complete
+    :param runs: see sweep_runs
+    :param max_turn: maximum number of turns of each run
+    :param output: .parquet or .csv results file (overwritten)
+    :param engine: 'db' or 'array'
+    :param max_workers: number of processes (number of cores if None)
+    :return: number of runs written
+    """
+    if engine not in ENGINES:
+        raise ValueError('Unknown engine {}, must be one of {}'.format(engine, ENGINES))
+    writer = SweepResultsWriter(output)
+    done = 0
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            futures = {pool.submit(run_simulation, run, max_turn, engine): run['run_id'] for run in runs}
+            for future in as_completed(futures):
+                writer.write(future.result())
+                done += 1
+                _logger.info('Run {} done ({}/{})'.format(futures[future], done, len(runs)))
+    finally:
+        writer.close()
+    return done
@@ -0,0 +1,300 @@
+"""
+Sparse storage of per-cell values for very large grids
+
+Memory follows the population rather than the area. Cells are flat indices (cell = x * grid_size + y) as in
+fish_bowl.process.topology; neighbours of a cell are found with the usual modular arithmetic, wherever they lie.
+
+- TiledGrid cuts the grid in tile_size x tile_size tiles, a tile is only allocated when one of its cells gets a value
+and freed when all its cells are empty again. Smaller tiles waste less memory on scattered animals, larger ones spend
+less on dictionary entries for dense clusters.
+- CellTable keeps the non-empty cells in a hash table held in a single numpy array, which the compiled kernels of the
+array engine read and write directly (see fish_bowl.process.kernels).
+"""
+from typing import Iterable, Iterator, Tuple
+
+import numpy as np
+
+from fish_bowl.process.kernels import FREE, table_get, table_set, table_get_many, table_set_many
+
+DEFAULT_TILE_SIZE = 8
+FREE_TILES = 256  # freed tiles kept for reuse: animals crossing tile borders keep emptying and filling tiles
+MIN_BUCKETS = 64
+MAX_LOAD = 0.5  # cells per bucket of a cell table, probing runs get long above it
+
+
+class TiledGrid:
+    """
+    Value of every cell of the grid, indexed like a flat numpy array: grid[cell] and grid[cells] = values work with
+    int or integer arrays, cells never written hold the empty value
+    """
+
+    def __init__(self, grid_size: int, tile_size: int = DEFAULT_TILE_SIZE, empty: int = -1, dtype=np.int32):
+        """
+        :param grid_size:
+        :param tile_size: side of a tile, in cells
+        :param empty: value of empty cells
+        :param dtype: dtype of the values
+        """
+        self.grid_size = grid_size
+        self.tile_size = tile_size
+        self.empty = empty
+        self.dtype = np.dtype(dtype)
+        self._tiles_per_side = -(-grid_size // tile_size)
+        self._tiles = dict()
+        self._counts = dict()
+        self._free = []
+
+    def _locate(self, cells):
+        """
+        :return: tile key and offset in the tile of cells
+        """
+        x, y = np.divmod(cells, self.grid_size)
+        tx, ox = np.divmod(x, self.tile_size)
+        ty, oy = np.divmod(y, self.tile_size)
+        return tx * self._tiles_per_side + ty, ox * self.tile_size + oy
+
+    def _new_tile(self, key: int) -> np.ndarray:
+        if self._free:
+            tile = self._free.pop()
+        else:
+            tile = np.full(self.tile_size * self.tile_size, self.empty, dtype=self.dtype)
+        self._tiles[key] = tile
+        self._counts[key] = 0
+        return tile
+
+    def _locate_one(self, cell: int) -> Tuple[int, int]:
+        """
+        _locate of a single cell, in plain python (numpy is slow on scalars)
+        """
+        x, y = divmod(cell, self.grid_size)
+        tx, ox = divmod(x, self.tile_size)
+        ty, oy = divmod(y, self.tile_size)
+        return tx * self._tiles_per_side + ty, ox * self.tile_size + oy
+
+    def __getitem__(self, cells):
+        if isinstance(cells, (int, np.integer)):
+            key, offset = self._locate_one(int(cells))
+            tile = self._tiles.get(key)
+            return self.empty if tile is None else tile.item(offset)
+        cells = np.asarray(cells, dtype=np.int64)
+        values = np.full(cells.shape, self.empty, dtype=self.dtype)
+        for key, index, offsets in self._groups(cells):
+            tile = self._tiles.get(key)
+            if tile is not None:
+                values.flat[index] = tile[offsets]
+        return values
+
+    def __setitem__(self, cells, values):
+        if isinstance(cells, (int, np.integer)):
+            key, offset = self._locate_one(int(cells))
+            tile = self._tiles.get(key)
+            if tile is None:
+                if values == self.empty:
+                    return
+                tile = self._new_tile(key)
+            filled = (int(values) != self.empty) - (tile.item(offset) != self.empty)
+            tile[offset] = values
+            if filled:
+                self._update_count(key, self._counts[key] + filled)
+            return
+        cells = np.asarray(cells, dtype=np.int64)
+        values = np.broadcast_to(np.asarray(values, dtype=self.dtype), cells.shape)
+        for key, index, offsets in self._groups(cells):
+            tile = self._tiles.get(key)
+            if tile is None:
+                if (values.flat[index] == self.empty).all():
+                    continue
+                tile = self._new_tile(key)
+            tile[offsets] = values.flat[index]
+            self._update_count(key, int(np.count_nonzero(tile != self.empty)))
+
+    def _update_count(self, key: int, count: int):
+        if count == 0:
+            tile = self._tiles.pop(key)
+            del self._counts[key]
+            if len(self._free) < FREE_TILES:
+                # tiles only get empty cells back, a freed one is ready for reuse
+                self._free.append(tile)
+        else:
+            self._counts[key] = count
+
+    def _groups(self, cells: np.ndarray) -> Iterator[Tuple[int, np.ndarray, np.ndarray]]:
+        """
+        Cells grouped by tile
+        :return: tile key, positions in cells and offsets in the tile of each group
+        """
+        keys, offsets = self._locate(cells.ravel())
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        for start, end in zip(starts.tolist(), np.r_[starts[1:], len(keys)].tolist()):
+            index = order[start:end]
+            yield int(keys[start]), index, offsets[index]
+
+    def __len__(self) -> int:
+        """
+        Number of non-empty cells
+        """
+        return sum(self._counts.values())
+
+    @property
+    def nb_tiles(self) -> int:
+        return len(self._tiles)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Memory used by the allocated tiles
+        """
+        return sum(tile.nbytes for tile in self._tiles.values())
+
+    def items(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: non-empty cells (sorted) and their values
+        """
+        if len(self._tiles) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=self.dtype)
+        keys = np.fromiter(self._tiles.keys(), dtype=np.int64, count=len(self._tiles))
+        tiles = np.stack(list(self._tiles.values()))
+        tile_index, offsets = np.nonzero(tiles != self.empty)
+        tx, ty = np.divmod(keys[tile_index], self._tiles_per_side)
+        ox, oy = np.divmod(offsets, self.tile_size)
+        cells = (tx * self.tile_size + ox) * self.grid_size + ty * self.tile_size + oy
+        order = np.argsort(cells)
+        return cells[order], tiles[tile_index, offsets][order]
+
+    def to_dense(self) -> np.ndarray:
+        """
+        Flat dense copy of the grid (small grids only)
+        """
+        dense = np.full(self.grid_size * self.grid_size, self.empty, dtype=self.dtype)
+        cells, values = self.items()
+        dense[cells] = values
+        return dense
+
+
+class CellTable:
+    """
+    Value of every cell of the grid, indexed like a flat numpy array: grid[cell] and grid[cells] = values work with
+    int or integer arrays, cells never written hold the empty value.
+    The cells are kept in table (see fish_bowl.process.kernels), which kernels use in place of a dense array: call
+    reserve before a kernel adds cells, the table is re-allocated when it grows
+    """
+
+    def __init__(self, grid_size: int, empty: int = -1, dtype=np.int32, capacity: int = 0):
+        """
+        :param grid_size:
+        :param empty: value of empty cells
+        :param dtype: dtype of the values read
+        :param capacity: number of cells held without growing the table
+        """
+        self.grid_size = grid_size
+        self.empty = empty
+        self.dtype = np.dtype(dtype)
+        self.table = self._new_table(capacity)
+
+    def _new_table(self, capacity: int) -> np.ndarray:
+        buckets = MIN_BUCKETS
+        while buckets * MAX_LOAD < capacity:
+            buckets *= 2
+        table = np.full((buckets + 1, 2), FREE, dtype=np.int64)
+        table[0] = 0, self.empty
+        return table
+
+    def reserve(self, extra: int):
+        """
+        Make sure extra cells can be added without growing the table
+        :param extra:
+        :return:
+        """
+        needed = len(self) + int(extra)
+        if needed <= (self.table.shape[0] - 1) * MAX_LOAD:
+            return
+        cells, values = self.items()
+        self.table = self._new_table(max(needed, 2 * len(self)))
+        table_set_many(self.table, cells, values.astype(np.int64))
+
+    def __getitem__(self, cells):
+        if isinstance(cells, (int, np.integer)):
+            return self.dtype.type(table_get(self.table, int(cells)))
+        cells = np.asarray(cells, dtype=np.int64)
+        values = np.empty(cells.size, dtype=np.int64)
+        table_get_many(self.table, cells.ravel(), values)
+        return values.astype(self.dtype).reshape(cells.shape)
+
+    def __setitem__(self, cells, values):
+        if isinstance(cells, (int, np.integer)):
+            self.reserve(1)
+            table_set(self.table, int(cells), int(values))
+            return
+        cells = np.asarray(cells, dtype=np.int64).ravel()
+        self.reserve(len(cells))
+        table_set_many(self.table, cells, np.broadcast_to(np.asarray(values, dtype=np.int64), cells.shape).ravel())
+
+    def __len__(self) -> int:
+        """
+        Number of non-empty cells
+        """
+        return int(self.table[0, 0])
+
+    @property
+    def nbytes(self) -> int:
+        return self.table.nbytes
+
+    def items(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: non-empty cells (sorted) and their values
+        """
+        entries = self.table[1:]
+        entries = entries[entries[:, 0] != FREE]
+        order = np.argsort(entries[:, 0])
+        return entries[order, 0], entries[order, 1].astype(self.dtype)
+
+    def to_dense(self) -> np.ndarray:
+        """
+        Flat dense copy of the grid (small grids only)
+        """
+        dense = np.full(self.grid_size * self.grid_size, self.empty, dtype=self.dtype)
+        cells, values = self.items()
+        dense[cells] = values
+        return dense
+
+
+class TiledOccupancy:
+    """
+    Set of occupied (x, y) coordinates backed by a TiledGrid, a drop-in for a set of tuples on very large grids
+    """
+
+    def __init__(self, grid_size: int, coordinates: Iterable[Tuple[int, int]] = (),
+                 tile_size: int = DEFAULT_TILE_SIZE):
+        self.grid_size = grid_size
+        self._cells = TiledGrid(grid_size, tile_size=tile_size, empty=0, dtype=np.int8)
+        coordinates = list(coordinates)
+        if len(coordinates) > 0:
+            x, y = np.array(coordinates, dtype=np.int64).T
+            self._cells[x * grid_size + y] = 1
+
+    def __contains__(self, coordinate: Tuple[int, int]) -> bool:
+        return bool(self._cells[int(coordinate[0]) * self.grid_size + int(coordinate[1])])
+
+    def add(self, coordinate: Tuple[int, int]):
+        self._cells[int(coordinate[0]) * self.grid_size + int(coordinate[1])] = 1
+
+    def discard(self, coordinate: Tuple[int, int]):
+        self._cells[int(coordinate[0]) * self.grid_size + int(coordinate[1])] = 0
+
+    def __len__(self) -> int:
+        return len(self._cells)
+
+    def __iter__(self) -> Iterator[Tuple[int, int]]:
+        cells, _ = self._cells.items()
+        return iter(zip(*[c.tolist() for c in np.divmod(cells, self.grid_size)]))
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (TiledOccupancy, set, frozenset)):
+            return len(self) == len(other) and all(c in self for c in other)
+        return NotImplemented
+
+    @property
+    def nbytes(self) -> int:
+        return self._cells.nbytes
@@ -6,9 +6,13 @@ look for neighbours
 
 """
 from collections import namedtuple
-from typing import List
+from functools import lru_cache
+from itertools import permutations
+from typing import List, Optional, Tuple
 import random
 
+import numpy as np
+
 SQUARE_NEIGH = {
     'nw': (-1, -1),
     'n': (0, -1),
@@ -20,6 +24,15 @@ SQUARE_NEIGH = {
     'se': (1, 1)
 }
 
+_NEIGH_OFFSETS = list(SQUARE_NEIGH.values())
+
+# grids above this number of cells are too large for dense tables: neighbours are computed on the fly
+DENSE_TABLE_MAX_CELLS = 1 << 20
+
+# every visiting order of the 8 neighbours: shuffling a neighbour list is picking one of these rows
+NEIGH_PERMUTATIONS = np.array(list(permutations(range(len(SQUARE_NEIGH)))), dtype=np.int8)
+NEIGH_PERMUTATIONS.setflags(write=False)
+
 
 class NonEmptyCoordinate(Exception):
     pass
@@ -74,20 +87,85 @@ def square_grid_valid(grid_size: int, coordinates: SquareGridCoordinate, raise_e
     return True
 
 
+@lru_cache(maxsize=4)
+def square_grid_neighbour_table(grid_size: int) -> np.ndarray:
+    """
+    Neighbour cells of every cell of the grid, cells being flat indices (cell = x * grid_size + y)
+    :param grid_size:
+    :return: read only (grid_size ** 2, 8) int32 array, neighbours in SQUARE_NEIGH order
+    """
+    x, y = np.divmod(np.arange(grid_size ** 2, dtype=np.int64), grid_size)
+    offsets = np.array(list(SQUARE_NEIGH.values()), dtype=np.int64)
+    table = ((x[:, None] + offsets[:, 0]) % grid_size) * grid_size + (y[:, None] + offsets[:, 1]) % grid_size
+    table = table.astype(np.int32)
+    table.setflags(write=False)
+    return table
+
+
+def square_grid_neighbour_rows(grid_size: int, cells: np.ndarray) -> np.ndarray:
+    """
+    Neighbour cells of several cells, from the neighbour table on grids up to DENSE_TABLE_MAX_CELLS cells
+    :param grid_size:
+    :param cells: flat cell indices
+    :return: (len(cells), 8) array, neighbours in SQUARE_NEIGH order
+    """
+    if grid_size * grid_size <= DENSE_TABLE_MAX_CELLS:
+        return square_grid_neighbour_table(grid_size)[cells]
+    x, y = np.divmod(np.asarray(cells, dtype=np.int64), grid_size)
+    offsets = np.array(list(SQUARE_NEIGH.values()), dtype=np.int64)
+    return ((x[:, None] + offsets[:, 0]) % grid_size) * grid_size + (y[:, None] + offsets[:, 1]) % grid_size
+
+
+def square_grid_coordinates(grid_size: int) -> List[SquareGridCoordinate]:
+    """
+    Coordinates of the grid, indexed by flat cell index (built on every call, not kept)
+    :param grid_size:
+    :return:
+    """
+    x, y = np.divmod(np.arange(grid_size * grid_size, dtype=np.int64), grid_size)
+    return [SquareGridCoordinate(*c) for c in zip(x.tolist(), y.tolist())]
+
+
+def square_grid_cell(grid_size: int, coordinate: SquareGridCoordinate) -> int:
+    """
+    Flat cell index of a coordinate (wrapped on the grid)
+    """
+    return (int(coordinate.x) % grid_size) * grid_size + int(coordinate.y) % grid_size
+
+
+def _neighbour_offsets(permutation: Optional[int]) -> List[Tuple[int, int]]:
+    """
+    (x, y) offsets of the 8 neighbours in a visiting order, a row of NEIGH_PERMUTATIONS (SQUARE_NEIGH order if None)
+    """
+    if permutation is None:
+        return _NEIGH_OFFSETS
+    return [_NEIGH_OFFSETS[i] for i in NEIGH_PERMUTATIONS[permutation].tolist()]
+
+
+def square_grid_neighbour_cells(grid_size: int, cell: int, permutation: Optional[int] = None) -> List[int]:
+    """
+    for a given cell, return all 8 neighbour cells (plain python, see square_grid_neighbour_rows for many cells)
+    :param grid_size:
+    :param cell:
+    :param permutation: visiting order, as a row of NEIGH_PERMUTATIONS (SQUARE_NEIGH order if None)
+    :return:
+    """
+    x, y = divmod(int(cell), grid_size)
+    return [((x + dx) % grid_size) * grid_size + (y + dy) % grid_size for dx, dy in _neighbour_offsets(permutation)]
+
+
 def square_grid_neighbours(grid_size: int, coordinate: SquareGridCoordinate,
-                           shuffle: bool = True) -> List[SquareGridCoordinate]:
+                           shuffle: bool = True, permutation: Optional[int] = None) -> List[SquareGridCoordinate]:
     """
     for a given corrdinate, return all 8 neighbours
     :param grid_size:
     :param coordinate:
     :param shuffle:
+    :param permutation: visiting order, as a row of NEIGH_PERMUTATIONS (random one if None and shuffle is set)
     :return:
     """
-    neigh = []
-    for k, (x, y) in SQUARE_NEIGH.items():
-        new_coord = coordinate.move(x, y, grid_size)
-        if square_grid_valid(grid_size=grid_size, coordinates=new_coord, raise_err=False):
-            neigh.append(new_coord)
-    if shuffle:
-        random.shuffle(neigh)
-    return neigh
+    if shuffle and permutation is None:
+        permutation = random.randrange(len(NEIGH_PERMUTATIONS))
+    x, y = int(coordinate.x) % grid_size, int(coordinate.y) % grid_size
+    return [SquareGridCoordinate((x + dx) % grid_size, (y + dy) % grid_size)
+            for dx, dy in _neighbour_offsets(permutation)]
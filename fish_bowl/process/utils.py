@@ -15,6 +15,13 @@ class Animal(enum.Enum):
     Shark = 2
 
 
+class AnimalEvent(enum.Enum):
+    Birth = 1
+    Move = 2
+    Death = 3
+    Feed = 4
+
+
 def convert_str_enum_to_name(v):
     try:
         return v.split('.')[1]
@@ -0,0 +1,113 @@
+import logging
+import argparse
+import random
+import time
+
+import numpy as np
+from sqlalchemy import text
+
+from fish_bowl.dataio.persistence import SimulationClient, Animals
+from fish_bowl.process.topology import SquareGridCoordinate
+from fish_bowl.process.utils import Animal
+
+_logger = logging.getLogger(__name__)
+
+sim_config = {
+    'grid_size': 200,
+    'init_nb_fish': 0,
+    'fish_breed_maturity': 3,
+    'fish_breed_probability': 80,
+    'fish_speed': 2,
+    'init_nb_shark': 0,
+    'shark_breed_maturity': 10,
+    'shark_breed_probability': 100,
+    'shark_speed': 4,
+    'shark_starving': 3
+}
+
+
+def fill_animals_table(client: SimulationClient, nb_rows: int, nb_sim: int, alive_ratio: float):
+    """
+    Create nb_sim simulations sharing nb_rows animals, only alive_ratio of them being alive
+    (dead rows are never removed, so long simulations look like this)
+    :return: list of simulation ids
+    """
+    grid_size = sim_config['grid_size']
+    rows_per_sim = nb_rows // nb_sim
+    nb_alive = min(int(rows_per_sim * alive_ratio), grid_size ** 2)
+    sids = [client.init_simulation(**sim_config) for _ in range(nb_sim)]
+    with client.session_scope() as s:
+        for sid in sids:
+            cells = np.random.choice(grid_size ** 2, size=rows_per_sim)
+            # live animals need their own cell
+            cells[:nb_alive] = np.random.choice(grid_size ** 2, size=nb_alive, replace=False)
+            coord_x, coord_y = np.divmod(cells, grid_size)
+            rows = [{'sim_id': sid, 'animal_type': Animal.Fish if i % 10 else Animal.Shark, 'spawn_turn': 0,
+                     'breed_count': 0, 'last_breed': 0, 'last_fed': 0, 'alive': i < nb_alive, 'coord_x': x,
+                     'coord_y': y}
+                    for i, (x, y) in enumerate(zip(coord_x.tolist(), coord_y.tolist()))]
+            s.execute(Animals.__table__.insert(), rows)
+    return sids
+
+
+def time_queries(client: SimulationClient, sids, repeat: int):
+    """
+    Time the queries filtering animals on (sim_id, alive, animal_type) or (sim_id, coord_x, coord_y, alive)
+    :return: dictionary query name -> list of durations in seconds
+    """
+    grid_size = sim_config['grid_size']
+    queries = {
+        'get_animals_by_type': lambda sid, coord: client.get_animals_by_type(sim_id=sid, animal_type=Animal.Shark),
+        'coordinate_is_occupied': lambda sid, coord: client.coordinate_is_occupied(sim_id=sid, coordinate=coord),
+        'get_animal_in_position': lambda sid, coord: client.get_animal_in_position(sim_id=sid, coordinate=coord),
+        'eat_animal_in_square': lambda sid, coord: client.eat_animal_in_square(sim_id=sid, coordinate=coord),
+    }
+    timings = {name: [] for name in queries}
+    rnd = random.Random(0)
+    for _ in range(repeat):
+        sid = rnd.choice(sids)
+        coord = SquareGridCoordinate(rnd.randrange(grid_size), rnd.randrange(grid_size))
+        for name, query in queries.items():
+            timer = time.perf_counter()
+            query(sid, coord)
+            timings[name].append(time.perf_counter() - timer)
+    return timings
+
+
+def query_plans(client: SimulationClient):
+    """
+    sqlite query plans of the indexed lookups
+    """
+    plans = {
+        'by type': 'SELECT oid FROM ANIMALS WHERE sim_id = 1 AND alive = 1 AND animal_type = \'Fish\'',
+        'by coordinate': 'SELECT oid FROM ANIMALS WHERE sim_id = 1 AND coord_x = 1 AND coord_y = 1 AND alive = 1',
+    }
+    with client.session_scope() as s:
+        return {name: [r[-1] for r in s.execute(text('EXPLAIN QUERY PLAN ' + sql))] for name, sql in plans.items()}
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(filename)s:%(lineno)d:%(message)s")
+    cmd_parser = argparse.ArgumentParser(description='Latency of the hot ANIMALS queries with and without indexes')
+    cmd_parser.add_argument('--rows', default=100000, type=int, help='Number of rows in the ANIMALS table')
+    cmd_parser.add_argument('--nb_sim', default=10, type=int, help='Number of simulations sharing the rows')
+    cmd_parser.add_argument('--alive_ratio', default=0.1, type=float, help='Share of animals still alive')
+    cmd_parser.add_argument('--repeat', default=200, type=int, help='Number of times each query is run')
+    args = cmd_parser.parse_args()
+    np.random.seed(0)
+    client = SimulationClient('sqlite:///:memory:')
+    sids = fill_animals_table(client, nb_rows=args.rows, nb_sim=args.nb_sim, alive_ratio=args.alive_ratio)
+    # eat_animal_in_square logs a warning for each empty square
+    logging.getLogger('fish_bowl').setLevel(logging.ERROR)
+    for name, plan in query_plans(client).items():
+        print('Plan {:<15}: {}'.format(name, ' / '.join(plan)))
+    with_index = time_queries(client, sids, args.repeat)
+    for index in Animals.__table__.indexes:
+        index.drop(bind=client._engine)
+    without_index = time_queries(client, sids, args.repeat)
+    print()
+    print('{} rows, {:.0%} alive, median latency over {} runs'.format(args.rows, args.alive_ratio, args.repeat))
+    print('{:<25}{:>15}{:>15}{:>10}'.format('query', 'indexed (ms)', 'no index (ms)', 'speedup'))
+    for name in with_index:
+        fast, slow = np.median(with_index[name]) * 1000, np.median(without_index[name]) * 1000
+        print('{:<25}{:>15.3f}{:>15.3f}{:>9.1f}x'.format(name, fast, slow, slow / fast))
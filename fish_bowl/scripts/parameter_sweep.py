@@ -0,0 +1,28 @@
+import argparse
+import json
+import logging
+
+from fish_bowl.common.config_reader import read_simulation_config
+from fish_bowl.process.sweep import parameter_grid, sweep_runs, run_sweep
+
+_logger = logging.getLogger(__name__)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(filename)s:%(lineno)d:%(message)s")
+    cmd_parser = argparse.ArgumentParser(description='Run simulations over a parameter grid in parallel processes')
+    cmd_parser.add_argument('--configs', default=['simulation_config_AM'], nargs='+',
+                            help='Simulation configuration file names (base configurations of the grid)')
+    cmd_parser.add_argument('--grid', default='{}', type=str,
+                            help='Parameter grid as json, e.g. \'{"shark_starving": [3, 4], "fish_speed": [2]}\'')
+    cmd_parser.add_argument('--seeds', default=[0], type=int, nargs='+', help='Random seeds, one run per seed')
+    cmd_parser.add_argument('--max_turn', default=100, type=int, help='Maximum number of turns per simulation')
+    cmd_parser.add_argument('--engine', default='db', help='db (SimulationGrid) or array (ArraySimulationGrid)')
+    cmd_parser.add_argument('--workers', default=None, type=int, help='Number of processes (default: all cores)')
+    cmd_parser.add_argument('--output', default='sweep.parquet', help='Results file, .parquet or .csv')
+    args = cmd_parser.parse_args()
+    grid = json.loads(args.grid)
+    configs = [config for name in args.configs for config in parameter_grid(read_simulation_config(name), grid)]
+    runs = sweep_runs(configs, seeds=args.seeds)
+    _logger.info('{} runs ({} configurations x {} seeds)'.format(len(runs), len(configs), len(args.seeds)))
+    run_sweep(runs, max_turn=args.max_turn, output=args.output, engine=args.engine, max_workers=args.workers)
+    _logger.info('Results written to {}'.format(args.output))
@@ -3,9 +3,10 @@ import argparse
 import time
 
 from fish_bowl.dataio.persistence import SimulationClient, get_database_string
+from fish_bowl.dataio.turn_stats import stats_sink
 from fish_bowl.process.base import SimulationGrid
 from fish_bowl.common.config_reader import read_simulation_config
-from fish_bowl.process.simple_display import display_simple_grid
+from fish_bowl.process.simple_display import display_simple_grid, update_simple_grid
 
 _logger = logging.getLogger(__name__)
 # Let's store all actions and stats into a log file
@@ -21,6 +22,13 @@ if __name__ == '__main__':
                             help="""
                             Configuration file path. If specified, configuration file will be loaded from this path
                             """)
+    cmd_parser.add_argument('--seed', default=None, type=int, help='Random seed, to replay a simulation')
+    cmd_parser.add_argument('--checkpoint', default=None, type=str,
+                            help='.npz checkpoint file, written every --checkpoint_every turns')
+    cmd_parser.add_argument('--checkpoint_every', default=10, type=int, help='Turns between two checkpoints')
+    cmd_parser.add_argument('--resume', action='store_true', help='Restart the simulation from --checkpoint')
+    cmd_parser.add_argument('--stats_file', default=None, type=str,
+                            help='Append the stats of each turn to this .csv or .jsonl file')
     args = cmd_parser.parse_args()
     if args.config_path is not None:
         raise NotImplementedError('Code for directing to an alternative configuration'
@@ -31,18 +39,29 @@ if __name__ == '__main__':
     # client = SimulationClient(get_database_string())
     client = SimulationClient('sqlite:///:memory:') # use RAM, grids so far do not seem to be large; for extremely large need to change architecture as well
     # display initial grid
-    grid = SimulationGrid(persistence=client, simulation_parameters=sim_config)
-    print(display_simple_grid(client.get_animals_df(grid._sid), grid_size=sim_config['grid_size']))
+    if args.resume:
+        grid = SimulationGrid.from_checkpoint(persistence=client, path=args.checkpoint)
+        sim_config = grid.simulation_params
+    else:
+        grid = SimulationGrid(persistence=client, simulation_parameters=sim_config, seed=args.seed)
+    if args.stats_file is not None:
+        grid.add_stats_sink(stats_sink(args.stats_file))
+    animals = client.get_animals_df(grid._sid)
+    frame = display_simple_grid(animals, grid_size=sim_config['grid_size'])
+    print(frame)
     for turn in range(args.max_turn):
         timer = time.time()
-        # get occupied coord-s for quicker occupation-checks
-        grid.animals = grid.get_simulation_grid_data()
-        grid.occupied_coord = set(zip(grid.animals.coord_x, grid.animals.coord_y))
         grid.play_turn()
         print(''.join(['*'] * sim_config['grid_size'] * 2))
         print('Turn: {turn: ^{size}}'.format(turn=grid._sim_turn, size=sim_config['grid_size']))
         print()
-        print(display_simple_grid(grid.get_simulation_grid_data(), sim_config['grid_size']))
+        # only redraw the cells changed during the turn
+        frame = update_simple_grid(frame, *grid.turn_changes())
+        print(frame)
         print()
-        print('Turn duration: {:<3}s'.format(int(time.time()-timer)))
+        stats = grid.turn_stats[-1]
+        if args.checkpoint is not None and grid._sim_turn % args.checkpoint_every == 0:
+            grid.save_checkpoint(args.checkpoint)
+        print('Turn duration: {:.3f}s ({} SQL statements, {:.3f}s in driver)'.format(
+            time.time() - timer, stats['sql_statements'], stats['sql_driver_time']))
         print()
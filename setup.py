@@ -4,7 +4,7 @@ setup(
     name='FishBowl',
     version='0.1.0',
     packages=['tests', 'fish_bowl', 'fish_bowl.common', 'fish_bowl.dataio', 'fish_bowl.process', 'fish_bowl.scripts',
-              'fish_bowl.flask_app', 'fish_bowl.configuration'],
+              'fish_bowl.flask_app', 'fish_bowl.configuration', 'fish_bowl.benchmark'],
     url='',
     license='',
     author='Pierre Carotti',
@@ -0,0 +1,209 @@
+import copy
+
+import numpy as np
+import pytest
+
+from fish_bowl.dataio.persistence import SimulationClient
+from fish_bowl.dataio.turn_stats import read_stats, stats_sink
+from fish_bowl.process.array_engine import ArraySimulationGrid
+from fish_bowl.process.topology import SquareGridCoordinate, NonEmptyCoordinate, TopologyError
+from fish_bowl.process.utils import Animal, EndOfSimulatioError
+
+sim_config = {
+    'grid_size': 10,
+    'init_nb_fish': 50,
+    'fish_breed_maturity': 3,
+    'fish_breed_probability': 80,
+    'fish_speed': 2,
+    'init_nb_shark': 5,
+    'shark_breed_maturity': 5,
+    'shark_breed_probability': 100,
+    'shark_speed': 4,
+    'shark_starving': 4}
+
+sim_config_empty = {
+    'grid_size': 10,
+    'init_nb_fish': 0,
+    'fish_breed_maturity': 3,
+    'fish_breed_probability': 100,
+    'fish_speed': 2,
+    'init_nb_shark': 0,
+    'shark_breed_maturity': 3,
+    'shark_breed_probability': 100,
+    'shark_speed': 4,
+    'shark_starving': 4}
+
+a_list = [
+    (Animal.Fish, SquareGridCoordinate(x=1, y=1)),
+    (Animal.Fish, SquareGridCoordinate(x=2, y=1)),
+    (Animal.Fish, SquareGridCoordinate(x=3, y=1)),
+    (Animal.Fish, SquareGridCoordinate(x=1, y=3)),
+    (Animal.Fish, SquareGridCoordinate(x=3, y=2)),
+    (Animal.Shark, SquareGridCoordinate(x=2, y=2))
+]
+
+
+class TestArrayEngine:
+
+    def test_simulation_init(self):
+        grid = ArraySimulationGrid(simulation_parameters=sim_config)
+        animals = grid.get_simulation_grid_data()
+        assert len(animals) == sim_config['init_nb_fish'] + sim_config['init_nb_shark'], 'Missing some animals!'
+        assert grid.population[Animal.Shark] == sim_config['init_nb_shark']
+        # one animal per cell and grid consistent with animals
+        assert len(set(zip(animals.coord_x, animals.coord_y))) == len(animals)
+        assert (grid.get_type_grid() > 0).sum() == len(animals)
+
+    def test_add_animal(self):
+        grid = ArraySimulationGrid(simulation_parameters=sim_config_empty)
+        grid.add_animal(Animal.Fish, SquareGridCoordinate(0, 1))
+        assert grid.check_if_occupied(SquareGridCoordinate(0, 1))
+        with pytest.raises(NonEmptyCoordinate):
+            grid.add_animal(Animal.Fish, SquareGridCoordinate(0, 1))
+        with pytest.raises(TopologyError):
+            grid.add_animal(Animal.Fish, SquareGridCoordinate(10, 1))
+
+    def test_starving(self):
+        grid = ArraySimulationGrid(simulation_parameters=sim_config)
+        grid._sim_turn = sim_config['shark_starving'] + 1
+        grid._check_deads()
+        assert grid.population[Animal.Shark] == 0
+        with pytest.raises(EndOfSimulatioError):
+            grid.check_simulation_ends()
+        with pytest.raises(EndOfSimulatioError):
+            grid.play_turn()
+
+    def test_empty(self):
+        grid = ArraySimulationGrid(simulation_parameters=sim_config_empty)
+        with pytest.raises(EndOfSimulatioError):
+            grid.play_turn()
+
+    def test_eating(self):
+        grid = ArraySimulationGrid(simulation_parameters=sim_config_empty)
+        for t, c in a_list:
+            grid.add_animal(t, c)
+        grid._sim_turn = 4
+        fed_from = grid._eat()
+        assert (fed_from >= 0).sum() == 1, 'Shark should have fed'
+        animals = grid.get_simulation_grid_data()
+        shark = animals[animals.animal_type == Animal.Shark].iloc[0]
+        assert shark.last_fed == 4, 'Shark last fed value should have updated'
+        assert grid.to_coordinate(fed_from.max()) == SquareGridCoordinate(x=2, y=2)
+        assert grid.population[Animal.Fish] == 4
+
+    def test_breed(self):
+        grid = ArraySimulationGrid(simulation_parameters=sim_config_empty)
+        for t, c in a_list:
+            grid.add_animal(t, c)
+        grid._sim_turn = 4
+        fed_from = grid._eat()
+        moved = grid._breed_and_move(fed_from=fed_from)
+        assert moved.sum() == 5, '4 fishes and one shark should have moved due to breeding'
+        assert grid.population[Animal.Shark] == 2, 'Should be 2 Sharks'
+        assert grid.population[Animal.Fish] == 8, 'Should be 8 fishes'
+
+    def test_topology_agnostic_eating(self):
+        sim_config_local = copy.deepcopy(sim_config_empty)
+        sim_config_local['fish_breed_probability'] = 0
+        grid = ArraySimulationGrid(simulation_parameters=sim_config_local)
+        grid.add_animal(Animal.Fish, SquareGridCoordinate(x=0, y=0))
+        grid.add_animal(Animal.Shark, SquareGridCoordinate(x=9, y=9))
+        grid._sim_turn = 6
+        fed_from = grid._eat()
+        assert grid.to_coordinate(fed_from.max()) == SquareGridCoordinate(x=9, y=9)
+        assert grid.check_if_occupied(SquareGridCoordinate(x=0, y=0))
+        assert grid.population[Animal.Fish] == 0
+
+    def test_seeded_runs(self):
+        grids = [ArraySimulationGrid(simulation_parameters=sim_config, seed=12) for _ in range(2)]
+        for _ in range(5):
+            for grid in grids:
+                grid.play_turn()
+        assert (grids[0].get_type_grid() == grids[1].get_type_grid()).all()
+
+    def test_stats_without_persistence(self, tmp_path):
+        grid = ArraySimulationGrid(simulation_parameters=sim_config, seed=3)
+        sink = stats_sink(str(tmp_path / 'stats.csv'))
+        grid.add_stats_sink(sink)
+        for _ in range(3):
+            grid.play_turn()
+        sink.close()
+        from_csv = read_stats(str(tmp_path / 'stats.csv'))
+        assert [r['sim_id'] for r in from_csv] == [None] * 3
+        assert [r['turn'] for r in from_csv] == [r['turn'] for r in grid.turn_stats]
+        assert [r['fish'] for r in from_csv] == [r['fish'] for r in grid.turn_stats]
+
+    def test_persistence_sink(self):
+        client = SimulationClient('sqlite:///:memory:')
+        grid = ArraySimulationGrid(simulation_parameters=sim_config, persistence=client, seed=3)
+        for _ in range(3):
+            grid.play_turn()
+        in_memory = grid.get_simulation_grid_data().sort_values(['coord_x', 'coord_y'])
+        in_db = client.get_animals_df(sim_id=grid._sid).sort_values(['coord_x', 'coord_y'])
+        assert len(in_memory) == len(in_db)
+        for col in ['animal_type', 'coord_x', 'coord_y', 'spawn_turn', 'breed_count', 'last_breed', 'last_fed']:
+            assert np.array_equal(in_memory[col].values, in_db[col].values), col
+
+    def test_population_counters(self):
+        client = SimulationClient('sqlite:///:memory:')
+        grid = ArraySimulationGrid(simulation_parameters=sim_config, persistence=client, seed=5)
+        for _ in range(5):
+            try:
+                grid.play_turn()
+            except EndOfSimulatioError:
+                break
+            alive = grid.animals.alive[:grid.animals.size]
+            types = grid.animals.animal_type[:grid.animals.size][alive]
+            assert grid.population[Animal.Fish] == (types == Animal.Fish.value).sum()
+            assert grid.population[Animal.Shark] == (types == Animal.Shark.value).sum()
+            # the database counters see the same population through write_animals
+            assert client.population_counters(grid._sid).to_dict()['fish'] == grid.counters.fish
+            assert client.population_counters(grid._sid).to_dict()['shark'] == grid.counters.shark
+
+    def test_event_log(self):
+        client = SimulationClient('sqlite:///:memory:', record_events=True)
+        grid = ArraySimulationGrid(simulation_parameters=sim_config, persistence=client, seed=4)
+        states = {0: client.get_animals_df(sim_id=grid._sid)}
+        for turn in range(1, 3):
+            grid.play_turn()
+            states[turn] = client.get_animals_df(sim_id=grid._sid)
+        for turn, state in states.items():
+            rebuilt = client.rebuild_animals(sim_id=grid._sid, turn=turn)
+            assert rebuilt.equals(state[['oid', 'animal_type', 'coord_x', 'coord_y']]), turn
+
+    def test_kernels(self):
+        '''
+        Kernels play the same simulation as the python loops
+        '''
+        config = dict(sim_config, grid_size=30, init_nb_fish=300, init_nb_shark=40)
+        for sparse in [False, True]:
+            loops = ArraySimulationGrid(simulation_parameters=config, seed=8, kernels=False, sparse=sparse)
+            kernels = ArraySimulationGrid(simulation_parameters=config, seed=8, kernels=True, sparse=sparse)
+            for _ in range(10):
+                try:
+                    loops.play_turn()
+                except EndOfSimulatioError:
+                    break
+                kernels.play_turn()
+                assert np.array_equal(kernels.get_type_grid(), loops.get_type_grid())
+                assert kernels.get_simulation_grid_data().equals(loops.get_simulation_grid_data())
+                assert kernels.counters.to_dict() == loops.counters.to_dict()
+
+    def test_write_behind(self):
+        '''
+        Changes written by the background writer end up as the ones written at the end of each turn
+        '''
+        clients = [SimulationClient('sqlite:///:memory:', record_events=True) for _ in range(2)]
+        grids = [ArraySimulationGrid(simulation_parameters=sim_config, persistence=client, seed=9,
+                                     write_behind=write_behind) for client, write_behind in zip(clients, [0, 2])]
+        with grids[1]:
+            for _ in range(6):
+                for grid in grids:
+                    grid.play_turn()
+            grids[1].flush()
+            assert clients[1].get_animals_df(grids[1]._sid).equals(clients[0].get_animals_df(grids[0]._sid))
+        assert grids[1]._writer.batches <= 7
+        events = [client.get_events(sim_id=grid._sid) for client, grid in zip(clients, grids)]
+        assert events[1].drop(columns='eid').equals(events[0].drop(columns='eid'))
+        with pytest.raises(ValueError):
+            grids[1].play_turn()
@@ -1,11 +1,14 @@
+import threading
 import pytest
 import copy
 
 from fish_bowl.dataio.persistence import SimulationClient
+from fish_bowl.dataio.write_behind import WriteBehindWriter
+from fish_bowl.dataio.turn_stats import PHASES, TURN_STATS_FIELDS, BufferedStatsWriter, read_stats, stats_sink
 from fish_bowl.process.base import SimulationGrid
 from fish_bowl.process.topology import SquareGridCoordinate
 from fish_bowl.process.utils import Animal
-from fish_bowl.process.utils import EndOfSimulatioError
+from fish_bowl.process.utils import EndOfSimulatioError, ImpossibleAction
 
 sim_config = {
     'grid_size': 10,
@@ -206,6 +209,172 @@ class TestBase:
         grid = SimulationGrid(persistence=client, simulation_parameters=sim_config_empty_local)
         assert grid.check_if_occupied(SquareGridCoordinate(x=0, y=0)) == True, 'should be occupied'
 
+    def test_update_occupied_coord(self):
+        '''
+        Cells taken need the type of the animal taking them, to record the turn changes
+        '''
+        client = SimulationClient('sqlite:///:memory:')
+        grid = SimulationGrid(persistence=client, simulation_parameters=sim_config_empty)
+        grid.update_occupied_coord(new_coord=(1, 1), animal_type=Animal.Fish)
+        grid.update_occupied_coord(old_coord=(1, 1), new_coord=(1, 2), animal_type=Animal.Fish)
+        with pytest.raises(ValueError):
+            grid.update_occupied_coord(old_coord=(1, 2), new_coord=(2, 2))
+        assert grid.occupied_coord == {(1, 2)}
+        assert [c.tolist() for c in grid.turn_changes()] == [[1, 1], [1, 2], [0, Animal.Fish.value]]
+
+    def test_turn_rollback(self):
+        '''
+        A turn failing with ImpossibleAction leaves the database at the previous turn
+        '''
+        client = SimulationClient('sqlite:///:memory:')
+        grid = SimulationGrid(persistence=client, simulation_parameters=sim_config)
+        before = grid.get_simulation_grid_data()
+
+        def failing_move(already_moved):
+            raise ImpossibleAction('failing on purpose')
+        grid._move = failing_move
+        with pytest.raises(ImpossibleAction):
+            grid.play_turn()
+        after = grid.get_simulation_grid_data()
+        assert grid._sim_turn == 0
+        assert before.equals(after), 'Database should be back to previous turn'
+        assert grid.occupied_coord == set(zip(after.coord_x, after.coord_y))
+
+    def test_turn_rollback_any_error(self):
+        '''
+        A turn failing with any error, after animals moved, reloads the occupied coordinates of the previous turn
+        '''
+        client = SimulationClient('sqlite:///:memory:')
+        grid = SimulationGrid(persistence=client, simulation_parameters=sim_config)
+        before = grid.get_simulation_grid_data()
+        move = grid._move
+
+        def failing_move(already_moved):
+            move(already_moved=already_moved)
+            raise RuntimeError('failing on purpose')
+        grid._move = failing_move
+        with pytest.raises(RuntimeError):
+            grid.play_turn()
+        after = grid.get_simulation_grid_data()
+        assert before.equals(after), 'Database should be back to previous turn'
+        assert grid.occupied_coord == set(zip(after.coord_x, after.coord_y))
+        assert grid.animals.equals(after)
+
+    def test_turn_stats(self, tmp_path):
+        '''
+        Each turn records phase times and SQL figures, in memory and in the file sinks
+        '''
+        client = SimulationClient('sqlite:///:memory:')
+        grid = SimulationGrid(persistence=client, simulation_parameters=sim_config)
+        csv_sink = stats_sink(str(tmp_path / 'stats.csv'))
+        jsonl_sink = stats_sink(str(tmp_path / 'stats.jsonl'))
+        grid.add_stats_sink(csv_sink)
+        grid.add_stats_sink(jsonl_sink)
+        for _ in range(2):
+            try:
+                grid.play_turn()
+            except EndOfSimulatioError:
+                break
+        csv_sink.close()
+        jsonl_sink.close()
+        assert [r['turn'] for r in grid.turn_stats] == list(range(len(grid.turn_stats)))
+        for record in grid.turn_stats:
+            assert set(record) == set(TURN_STATS_FIELDS)
+            phases = sum(record['{}_time'.format(p.lstrip('_'))] for p in PHASES)
+            assert 0 < phases <= record['turn_time']
+            assert record['sql_statements'] > 0 and record['sql_rows_read'] > 0 and record['sql_rows_written'] > 0
+            assert 0 < record['sql_driver_time'] < record['turn_time']
+        assert read_stats(str(tmp_path / 'stats.jsonl')) == grid.turn_stats
+        from_csv = read_stats(str(tmp_path / 'stats.csv'))
+        assert [r['sql_statements'] for r in from_csv] == [r['sql_statements'] for r in grid.turn_stats]
+
+    def test_population_counters(self):
+        '''
+        Counters follow the animals table through turns and rolled back turns
+        '''
+        client = SimulationClient('sqlite:///:memory:')
+        grid = SimulationGrid(persistence=client, simulation_parameters=sim_config, seed=3)
+
+        def check():
+            in_db = client.get_animals_df(sim_id=grid._sid).animal_type.value_counts()
+            assert grid.counters.fish == in_db.get(Animal.Fish, 0)
+            assert grid.counters.shark == in_db.get(Animal.Shark, 0)
+
+        check()
+        for _ in range(5):
+            try:
+                grid.play_turn()
+            except EndOfSimulatioError:
+                break
+            check()
+            assert grid.turn_stats[-1]['fish'] == grid.counters.fish
+        counters = grid.counters.to_dict()
+        assert counters['births'] - counters['deaths'] == counters['fish'] + counters['shark']
+        with pytest.raises(ImpossibleAction):
+            with client.turn_transaction(sim_id=grid._sid):
+                oid = int(client.get_animals_df(sim_id=grid._sid).oid.iloc[0])
+                client.kill_animal(sim_id=grid._sid, animal_ids=[oid])
+                raise ImpossibleAction('rollback')
+        assert grid.counters.to_dict() == counters
+        # counters are reloaded from the database once dropped
+        client.invalidate_snapshot()
+        assert grid.counters.fish == counters['fish'] and grid.counters.shark == counters['shark']
+
+    def test_buffered_stats_writer(self, tmp_path):
+        path = str(tmp_path / 'stats.csv')
+        writer = BufferedStatsWriter(path, fields=['turn', 'fish'], flush_every=3)
+        for turn in range(4):
+            writer.write({'turn': turn, 'fish': 10 * turn})
+        assert [r['turn'] for r in read_stats(path)] == [0, 1, 2]
+        writer.close()
+        writer.close()
+        assert read_stats(path) == [{'turn': t, 'fish': 10 * t} for t in range(4)]
+        parquet = str(tmp_path / 'stats.parquet')
+        writer = stats_sink(parquet)
+        client = SimulationClient('sqlite:///:memory:')
+        grid = SimulationGrid(persistence=client, simulation_parameters=sim_config, seed=1)
+        grid.add_stats_sink(writer)
+        grid.play_turn()
+        writer.close()
+        assert read_stats(parquet) == grid.turn_stats
+
+    def test_seeded_runs(self):
+        '''
+        Simulations with the same seed play the same turns
+        '''
+        grids = [SimulationGrid(persistence=SimulationClient('sqlite:///:memory:'), simulation_parameters=sim_config,
+                                seed=7) for _ in range(2)]
+        for grid in grids:
+            for _ in range(3):
+                try:
+                    grid.play_turn()
+                except EndOfSimulatioError:
+                    break
+        animals = [grid.get_simulation_grid_data() for grid in grids]
+        assert grids[0]._sim_turn == grids[1]._sim_turn
+        assert animals[0].equals(animals[1])
+
+    def test_checkpoint(self, tmp_path):
+        '''
+        A simulation restored from a checkpoint plays the same turns as the original one
+        '''
+        grid = SimulationGrid(persistence=SimulationClient('sqlite:///:memory:'), simulation_parameters=sim_config,
+                              seed=5)
+        grid.play_turn()
+        path = str(tmp_path / 'checkpoint.npz')
+        grid.save_checkpoint(path)
+        restored = SimulationGrid.from_checkpoint(persistence=SimulationClient('sqlite:///:memory:'), path=path)
+        assert restored._sim_turn == grid._sim_turn
+        assert restored.occupied_coord == grid.occupied_coord
+        columns = ['animal_type', 'spawn_turn', 'breed_count', 'last_breed', 'last_fed', 'coord_x', 'coord_y']
+        for _ in range(2):
+            for g in [grid, restored]:
+                try:
+                    g.play_turn()
+                except EndOfSimulatioError:
+                    pass
+            assert grid.get_simulation_grid_data()[columns].equals(restored.get_simulation_grid_data()[columns])
+
     # AM: test idea: add another test for max_turns (for this need to add additional config parameter)
     def test_shark_only_max_turn(self):
         '''
@@ -253,3 +422,38 @@ class TestBase:
         fish = grid._persistence.get_animals_by_type(sim_id=grid._sid, animal_type=Animal.Fish)
         assert len(fish) == 0, 'there should be no fish alive' # there is no fish (since we put 0 breeding probability)
 
+    def test_write_behind_writer(self):
+        started, release = threading.Event(), threading.Event()
+        written = []
+
+        def write(job):
+            started.set()
+            release.wait()
+            if job == 'boom':
+                raise IOError('disk full')
+            written.append(job)
+
+        writer = WriteBehindWriter(write, max_pending=2)
+        try:
+            writer.submit(0)
+            started.wait()
+            writer.submit(1)
+            writer.submit(2)
+            # the writer is busy and the queue full: next submit blocks until it catches up
+            blocked = threading.Thread(target=writer.submit, args=(3,))
+            blocked.start()
+            blocked.join(timeout=0.2)
+            assert blocked.is_alive() and writer.pending == 2
+        finally:
+            release.set()
+        blocked.join()
+        writer.flush()
+        assert written == [0, 1, 2, 3] and writer.batches < 4
+        writer.submit('boom')
+        with pytest.raises(RuntimeError):
+            writer.flush()
+        with pytest.raises(RuntimeError):
+            writer.submit(4)
+        with pytest.raises(RuntimeError):
+            writer.close()
+        assert written == [0, 1, 2, 3]
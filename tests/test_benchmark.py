@@ -0,0 +1,43 @@
+import copy
+
+import pytest
+
+from fish_bowl.benchmark.turn_benchmark import benchmark_cases, run_benchmark, compare_reports, compare_engines, \
+    PHASES
+
+
+class TestBenchmark:
+
+    def test_cases(self):
+        cases = benchmark_cases(grid_sizes=[10, 20], densities=[0.1, 0.3], shark_ratios=[0.1], databases=['memory'],
+                                engines=['db', 'array'])
+        assert len(cases) == 8
+        with pytest.raises(ValueError):
+            benchmark_cases(grid_sizes=[10], densities=[0.1], shark_ratios=[0.1], databases=['postgres'],
+                            engines=['db'])
+
+    def test_run_and_compare(self):
+        cases = benchmark_cases(grid_sizes=[10], densities=[0.3], shark_ratios=[0.1], databases=['memory', 'file'],
+                                engines=['db'])
+        report = run_benchmark(cases, nb_turns=2, isolate=False)
+        for result in report['results']:
+            assert 0 < result['turns_played'] <= 2
+            assert result['sql_statements_per_turn'] > 0
+            assert set(result['phase_median_s']) == set(PHASES)
+            assert sum(result['phase_median_s'].values()) <= max(result['turn_s'])
+        slower = copy.deepcopy(report)
+        slower['results'][0]['turn_median_s'] *= 2
+        comparison = compare_reports(report, slower, threshold=0.2)
+        assert [line['regression'] for line in comparison] == [True, False]
+
+    def test_compare_engines(self):
+        '''
+        The striped engine is timed against the array engine on the same cases
+        '''
+        cases = benchmark_cases(grid_sizes=[20], densities=[0.3], shark_ratios=[0.1], databases=['memory'],
+                                engines=['array', 'striped'])
+        report = run_benchmark(cases, nb_turns=2, isolate=False)
+        assert all(result['turns_played'] > 0 for result in report['results'])
+        comparison = compare_engines(report, engine='striped', baseline_engine='array')
+        assert len(comparison) == 1 and comparison[0]['case'] == 'striped-memory-20-d0.3-s0.1'
+        assert comparison[0]['turn_median_s'] > 0
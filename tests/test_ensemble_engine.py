@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+from fish_bowl.process.array_engine import FISH, SHARK
+from fish_bowl.process.ensemble_engine import EnsembleSimulationGrid
+from fish_bowl.process.utils import EndOfSimulatioError
+
+sim_config = {
+    'grid_size': 10,
+    'init_nb_fish': 50,
+    'fish_breed_maturity': 3,
+    'fish_breed_probability': 80,
+    'fish_speed': 2,
+    'init_nb_shark': 5,
+    'shark_breed_maturity': 5,
+    'shark_breed_probability': 100,
+    'shark_speed': 4,
+    'shark_starving': 4}
+
+
+class TestEnsembleEngine:
+
+    def test_ensemble_init(self):
+        ensemble = EnsembleSimulationGrid(sim_config, nb_members=4, seed=1)
+        assert ensemble.get_type_grid().shape == (4, 10, 10)
+        assert ensemble.population.fish.tolist() == [50] * 4 and ensemble.population.shark.tolist() == [5] * 4
+        # members are spawned independently
+        assert not np.array_equal(ensemble.grid[0], ensemble.grid[1])
+        with pytest.raises(ValueError):
+            EnsembleSimulationGrid(sim_config, nb_members=0)
+
+    def test_population_history(self):
+        histories = [EnsembleSimulationGrid(sim_config, nb_members=8, seed=5).run(15) for _ in range(2)]
+        assert histories[0].equals(histories[1])
+        history = histories[0]
+        assert list(history.columns) == ['member', 'turn', 'fish', 'shark']
+        assert len(history) == 8 * history.turn.nunique()
+        ensemble = EnsembleSimulationGrid(sim_config, nb_members=8, seed=5)
+        ensemble.run(15)
+        last = history[history.turn == history.turn.max()]
+        assert last.fish.tolist() == (ensemble.grid == FISH).sum(axis=1).tolist()
+        assert last.shark.tolist() == (ensemble.grid == SHARK).sum(axis=1).tolist()
+
+    def test_eating(self):
+        '''
+        Shark of member 0 eats, the one of member 1 has no fish around
+        '''
+        ensemble = EnsembleSimulationGrid(dict(sim_config, init_nb_fish=0, init_nb_shark=0), nb_members=2, seed=1)
+        ensemble.grid[0, [0, 1]] = [SHARK, FISH]
+        ensemble.grid[1, 55] = SHARK
+        ensemble._sim_turn = 2
+        ensemble._eat()
+        assert ensemble.grid[0, 1] == SHARK and ensemble.grid[0, 0] == 0
+        assert ensemble.fed_from[0, 1] == 0 and ensemble.last_fed[0, 1] == 2 and ensemble.moved[0, 1]
+        assert ensemble.grid[1, 55] == SHARK and ensemble.fed_from[1, 55] == -1
+        assert ensemble.meals.tolist() == [1, 0]
+
+    def test_extinction(self):
+        '''
+        Members whose sharks starve are frozen, the ensemble ends with the last one
+        '''
+        ensemble = EnsembleSimulationGrid(dict(sim_config, init_nb_fish=0, init_nb_shark=1, shark_breed_maturity=50),
+                                          nb_members=3, seed=2)
+        ensemble.grid[2, ensemble.grid[2] == 0] = FISH
+        for _ in range(10):
+            ensemble.play_turn()
+        assert ensemble.extinction_turn.tolist() == [6, 6, -1]
+        history = ensemble.population_history()
+        assert history[history.member == 0].shark.tolist() == [1] * 6 + [0] * 5
+        assert history[history.member == 0].fish.sum() == 0
+        ensemble.grid[2, ensemble.grid[2] == SHARK] = 0
+        ensemble.play_turn()
+        with pytest.raises(EndOfSimulatioError):
+            ensemble.play_turn()
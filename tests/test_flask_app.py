@@ -0,0 +1,124 @@
+import json
+
+import numpy as np
+import pytest
+
+from fish_bowl.dataio.frames import decode_cell_lists, decode_varints, encode_varints, unpack_grid
+from fish_bowl.dataio.persistence import SimulationClient
+from fish_bowl.dataio.streaming import SimulationStream, apply_delta
+from fish_bowl.flask_app.main import create_app
+from fish_bowl.process.base import SimulationGrid
+from fish_bowl.process.simple_display import display_simple_grid
+from fish_bowl.process.utils import Animal
+
+sim_config = {
+    'grid_size': 10,
+    'init_nb_fish': 50,
+    'fish_breed_maturity': 3,
+    'fish_breed_probability': 80,
+    'fish_speed': 2,
+    'init_nb_shark': 5,
+    'shark_breed_maturity': 5,
+    'shark_breed_probability': 100,
+    'shark_speed': 4,
+    'shark_starving': 4}
+
+
+@pytest.fixture
+def simulation():
+    client = SimulationClient('sqlite:///:memory:', record_events=True)
+    grid = SimulationGrid(persistence=client, simulation_parameters=sim_config, seed=4)
+    start = client.get_animals_df(sim_id=grid._sid)
+    for _ in range(3):
+        grid.play_turn()
+    return client, grid, start
+
+
+class TestFlaskApp:
+
+    def test_varints(self):
+        values = [0, 1, 127, 128, 300, 2 ** 35]
+        data = encode_varints(values)
+        assert data[:4] == bytes([0, 1, 127, 0x80]) and len(data) == 1 + 1 + 1 + 2 + 2 + 6
+        assert decode_varints(data) == (values, len(data))
+
+    def test_simulations(self, simulation):
+        client, grid, _ = simulation
+        api = create_app(client).test_client()
+        listed = api.get('/simulations').get_json()
+        assert [s['sid'] for s in listed] == [grid._sid] and listed[0]['last_turn'] == 2
+        details = api.get('/simulations/{}'.format(grid._sid)).get_json()
+        assert details['grid_size'] == 10
+        assert (details['fish'], details['shark']) == (grid.counters.fish, grid.counters.shark)
+        assert api.get('/simulations/99').status_code == 404
+        population = api.get('/simulations/{}/population'.format(grid._sid))
+        assert [p['turn'] for p in population.get_json()] == [0, 1, 2, 3]
+        assert population.get_json()[-1] == {'turn': 3, 'fish': grid.counters.fish, 'shark': grid.counters.shark}
+        again = api.get('/simulations/{}/population'.format(grid._sid),
+                        headers={'If-None-Match': population.headers['ETag']})
+        assert again.status_code == 304
+
+    def test_grid(self, simulation):
+        client, grid, start = simulation
+        api = create_app(client).test_client()
+        url = '/simulations/{}/grid'.format(grid._sid)
+        current = client.get_animals_df(sim_id=grid._sid)
+        frame = api.get(url)
+        assert frame.get_json()['simulation'] == {'sim_id': grid._sid, 'sim_turn': 3}
+        assert sorted(map(tuple, frame.get_json()['grid'])) == \
+            sorted(zip([a.value for a in current.animal_type], current.coord_x, current.coord_y))
+        packed = api.get(url, query_string={'format': 'packed'})
+        assert packed.headers['X-Grid-Size'] == '10' and len(packed.data) == 25
+        assert np.array_equal(unpack_grid(packed.data, 10), display_simple_grid(current, 10))
+        # past turns are rebuilt from the event log
+        first = api.get(url, query_string={'format': 'varint', 'turn': 0})
+        cells = decode_cell_lists(first.data, 10)
+        for animal in Animal:
+            animals = start[start.animal_type == animal]
+            assert sorted(cells[animal]) == sorted(zip(animals.coord_x, animals.coord_y))
+        # unchanged turn: no body
+        polled = api.get(url, headers={'If-None-Match': frame.headers['ETag']})
+        assert polled.status_code == 304 and polled.data == b''
+        grid.play_turn()
+        assert api.get(url, headers={'If-None-Match': frame.headers['ETag']}).status_code == 200
+        assert api.get(url, query_string={'turn': 10}).status_code == 404
+        assert api.get(url, query_string={'format': 'xml'}).status_code == 400
+
+    def test_stream(self, simulation):
+        client, grid, _ = simulation
+        api = create_app(client, poll_interval=0.).test_client()
+        response = api.get('/simulations/{}/stream'.format(grid._sid), buffered=False)
+        assert response.mimetype == 'text/event-stream'
+        messages = iter(response.response)
+
+        def read():
+            message = next(messages)
+            message = message.decode() if isinstance(message, bytes) else message
+            lines = dict(line.split(': ', 1) for line in message.strip().split('\n'))
+            return lines['event'], json.loads(lines['data'])
+
+        event, keyframe = read()
+        assert event == 'keyframe' and keyframe['turn'] == 3
+        cells = {(x, y): t for t, x, y in keyframe['grid']}
+        for turn in [4, 5]:
+            grid.play_turn()
+            event, delta = read()
+            assert event == 'delta' and delta['turn'] == turn
+            cells = apply_delta(cells, delta)
+            current = client.get_animals_df(sim_id=grid._sid)
+            assert cells == {(x, y): t.value for t, x, y in zip(current.animal_type, current.coord_x,
+                                                                 current.coord_y)}
+        response.close()
+
+    def test_stream_frame_skipping(self, simulation):
+        client, grid, _ = simulation
+        stream = SimulationStream(client, sim_id=grid._sid, max_pending=2)
+        slow = stream.subscribe()
+        for _ in range(3):
+            grid.play_turn()
+            stream.poll(force=True)
+        # first keyframe and delta were dropped for a keyframe of turn 5, the next delta follows
+        assert slow.skipped == 2
+        assert slow.get(timeout=0).startswith('event: keyframe\nid: 5\n')
+        assert slow.get(timeout=0).startswith('event: delta\nid: 6\n')
+        stream.unsubscribe(slow)
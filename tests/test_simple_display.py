@@ -0,0 +1,53 @@
+import numpy as np
+
+from fish_bowl.dataio.persistence import SimulationClient
+from fish_bowl.process.array_engine import ArraySimulationGrid
+from fish_bowl.process.base import SimulationGrid
+from fish_bowl.process.simple_display import display_simple_grid, convert_df_to_position, update_simple_grid
+from fish_bowl.process.utils import Animal, EndOfSimulatioError
+
+sim_config = {
+    'grid_size': 20,
+    'init_nb_fish': 150,
+    'fish_breed_maturity': 3,
+    'fish_breed_probability': 80,
+    'fish_speed': 2,
+    'init_nb_shark': 10,
+    'shark_breed_maturity': 5,
+    'shark_breed_probability': 100,
+    'shark_speed': 4,
+    'shark_starving': 4}
+
+
+class TestSimpleDisplay:
+
+    def test_display_simple_grid(self):
+        grid = ArraySimulationGrid(simulation_parameters=sim_config, seed=1)
+        animals = grid.get_simulation_grid_data()
+        frame = display_simple_grid(animals, sim_config['grid_size'])
+        assert np.array_equal(frame, grid.get_type_grid())
+        assert (frame == Animal.Shark.value).sum() == sim_config['init_nb_shark']
+        positions = convert_df_to_position(animals)
+        assert len(positions) == len(animals)
+        assert all(frame[x, y] == at for at, (x, y) in positions)
+
+    def test_incremental_rendering(self):
+        '''
+        Frames updated with the cells changed by the engines are the frames drawn from scratch
+        '''
+        grids = [ArraySimulationGrid(simulation_parameters=sim_config, seed=2),
+                 ArraySimulationGrid(simulation_parameters=sim_config, seed=2, sparse=True),
+                 SimulationGrid(persistence=SimulationClient('sqlite:///:memory:'), simulation_parameters=sim_config,
+                                seed=2)]
+        for grid in grids:
+            frame = display_simple_grid(grid.get_simulation_grid_data(), sim_config['grid_size'])
+            for _ in range(5):
+                try:
+                    grid.play_turn()
+                except EndOfSimulatioError:
+                    break
+                coord_x, coord_y, codes = grid.turn_changes()
+                assert 0 < len(codes) < sim_config['grid_size'] ** 2
+                frame = update_simple_grid(frame, coord_x, coord_y, codes)
+                assert np.array_equal(frame, display_simple_grid(grid.get_simulation_grid_data(),
+                                                                 sim_config['grid_size']))
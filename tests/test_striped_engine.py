@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+from fish_bowl.dataio.persistence import SimulationClient
+from fish_bowl.process.striped_engine import StripedSimulationGrid, play_stripe
+from fish_bowl.process.array_engine import FISH, SHARK
+from fish_bowl.process.utils import EndOfSimulatioError
+
+sim_config = {
+    'grid_size': 20,
+    'init_nb_fish': 150,
+    'fish_breed_maturity': 3,
+    'fish_breed_probability': 80,
+    'fish_speed': 2,
+    'init_nb_shark': 20,
+    'shark_breed_maturity': 5,
+    'shark_breed_probability': 100,
+    'shark_speed': 4,
+    'shark_starving': 4}
+
+
+def check_consistency(grid: StripedSimulationGrid):
+    rows = grid.animals.live_rows()
+    cells = grid.animals.cell[rows]
+    assert len(np.unique(cells)) == len(rows), 'one animal per cell'
+    assert np.array_equal(grid.slot[cells], rows)
+    assert (grid.slot >= 0).sum() == len(rows)
+    assert len(rows) == grid.counters.fish + grid.counters.shark
+
+
+class TestStripedEngine:
+
+    def test_stripes(self):
+        assert StripedSimulationGrid(sim_config, seed=1, workers=3).stripes == 6
+        for stripes in [0, 3, 12]:
+            with pytest.raises(ValueError):
+                StripedSimulationGrid(sim_config, seed=1, workers=1, stripes=stripes)
+
+    def test_workers_do_not_change_the_simulation(self):
+        single = StripedSimulationGrid(sim_config, seed=7, workers=1, stripes=4)
+        with StripedSimulationGrid(sim_config, seed=7, workers=2, stripes=4) as pooled:
+            for _ in range(10):
+                try:
+                    single.play_turn()
+                except EndOfSimulatioError:
+                    break
+                pooled.play_turn()
+                check_consistency(single)
+                assert np.array_equal(single.get_type_grid(), pooled.get_type_grid())
+                assert single.counters.to_dict() == pooled.counters.to_dict()
+
+    def test_cross_boundary_eat(self):
+        '''
+        A shark eats across the wrap of the torus, from stripe 0 into the halo row of the last stripe
+        '''
+        window = {'cell': np.array([0 * 20 + 5, 19 * 20 + 5]), 'animal_type': np.array([SHARK, FISH], dtype=np.int8),
+                  'spawn_turn': np.zeros(2, dtype=np.int32), 'breed_count': np.zeros(2, dtype=np.int32),
+                  'last_breed': np.zeros(2, dtype=np.int32), 'last_fed': np.zeros(2, dtype=np.int32),
+                  'alive': np.ones(2, dtype=np.bool_), 'fed_from': np.full(2, -1), 'moved': np.zeros(2, dtype=bool),
+                  'acted': np.zeros(2, dtype=bool)}
+        result = play_stripe(dict(window, rows=np.array([10, 11]), own=np.array([True, False]), phase='eat',
+                                  phase_type=SHARK, turn=3, grid_size=20, params=None, seed=[1],
+                                  window=(19, 12)))
+        assert result['meals'] == 1 and result['alive'].tolist() == [True, False]
+        assert result['cell'][0] == 19 * 20 + 5 and result['fed_from'][0] == 5 and result['last_fed'][0] == 3
+        assert result['acted'].tolist() == [True, False]
+
+    def test_persistence(self):
+        client = SimulationClient('sqlite:///:memory:')
+        grid = StripedSimulationGrid(sim_config, persistence=client, seed=2, workers=1, stripes=2)
+        for _ in range(5):
+            try:
+                grid.play_turn()
+            except EndOfSimulatioError:
+                break
+            check_consistency(grid)
+        in_db = client.get_animals_df(sim_id=grid._sid)
+        in_memory = grid.get_simulation_grid_data()
+        assert sorted(zip(in_db.coord_x, in_db.coord_y)) == sorted(zip(in_memory.coord_x, in_memory.coord_y))
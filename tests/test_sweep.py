@@ -0,0 +1,50 @@
+import pytest
+
+from fish_bowl.process.sweep import parameter_grid, sweep_runs, run_simulation, run_sweep, read_sweep_results
+
+sim_config = {
+    'grid_size': 10,
+    'init_nb_fish': 50,
+    'fish_breed_maturity': 3,
+    'fish_breed_probability': 80,
+    'fish_speed': 2,
+    'init_nb_shark': 5,
+    'shark_breed_maturity': 5,
+    'shark_breed_probability': 100,
+    'shark_speed': 4,
+    'shark_starving': 4}
+
+
+class TestSweep:
+
+    def test_parameter_grid(self):
+        configs = parameter_grid(sim_config, {'shark_starving': [2, 3], 'fish_breed_maturity': [1, 2, 3]})
+        assert len(configs) == 6
+        assert {(c['shark_starving'], c['fish_breed_maturity']) for c in configs} == \
+            {(s, f) for s in [2, 3] for f in [1, 2, 3]}
+        with pytest.raises(ValueError):
+            parameter_grid(sim_config, {'shark_speeed': [1]})
+        runs = sweep_runs(configs, seeds=[0, 1])
+        assert [r['run_id'] for r in runs] == list(range(12))
+
+    def test_run_simulation(self):
+        run = sweep_runs([sim_config], seeds=[3])[0]
+        series = run_simulation(run, max_turn=3)
+        assert series.turn.tolist() == list(range(len(series)))
+        assert series.loc[0, 'fish'] == sim_config['init_nb_fish']
+        assert series.loc[0, 'shark'] == sim_config['init_nb_shark']
+        assert (series.shark_starving == sim_config['shark_starving']).all()
+        assert series.equals(run_simulation(run, max_turn=3)), 'Seeded runs should be identical'
+
+    @pytest.mark.parametrize('extension', ['csv', 'parquet'])
+    def test_run_sweep(self, tmp_path, extension):
+        if extension == 'parquet':
+            pytest.importorskip('pyarrow')
+        runs = sweep_runs(parameter_grid(sim_config, {'shark_starving': [2, 4]}), seeds=[0, 1])
+        output = str(tmp_path / 'sweep.{}'.format(extension))
+        assert run_sweep(runs, max_turn=2, output=output, max_workers=2) == len(runs)
+        results = read_sweep_results(output)
+        assert sorted(results.run_id.unique()) == list(range(len(runs)))
+        by_run = results[results.run_id == 1].reset_index(drop=True)
+        expected = run_simulation(runs[1], max_turn=2)
+        assert by_run.fish.tolist() == expected.fish.tolist()
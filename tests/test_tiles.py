@@ -0,0 +1,135 @@
+import numpy as np
+
+from fish_bowl.dataio.persistence import SimulationClient
+from fish_bowl.process.array_engine import ArraySimulationGrid
+from fish_bowl.process.base import SimulationGrid
+from fish_bowl.process.simple_display import display_simple_grid
+from fish_bowl.process.tiles import CellTable, TiledGrid, TiledOccupancy
+from fish_bowl.process.topology import DENSE_TABLE_MAX_CELLS, SquareGridCoordinate, square_grid_neighbour_rows, \
+    square_grid_neighbour_table, square_grid_neighbours
+from fish_bowl.process.utils import EndOfSimulatioError
+
+sim_config = {
+    'grid_size': 10,
+    'init_nb_fish': 50,
+    'fish_breed_maturity': 3,
+    'fish_breed_probability': 80,
+    'fish_speed': 2,
+    'init_nb_shark': 5,
+    'shark_breed_maturity': 5,
+    'shark_breed_probability': 100,
+    'shark_speed': 4,
+    'shark_starving': 4}
+
+
+class TestTiles:
+
+    def test_tiled_grid(self):
+        grid = TiledGrid(grid_size=100, tile_size=8)
+        assert grid[0] == -1 and grid.nb_tiles == 0
+        grid[99 * 100 + 99] = 7
+        grid[np.array([5, 6, 5000])] = np.array([1, 2, 3])
+        assert grid[9999] == 7 and grid.nb_tiles == 3 and len(grid) == 4
+        assert grid[np.array([[5, 6], [7, 5000]])].tolist() == [[1, 2], [-1, 3]]
+        cells, values = grid.items()
+        assert cells.tolist() == [5, 6, 5000, 9999] and values.tolist() == [1, 2, 3, 7]
+        dense = np.full(100 * 100, -1)
+        dense[cells] = values
+        assert np.array_equal(grid.to_dense(), dense)
+        # emptied tiles are freed
+        grid[np.array([5, 6])] = -1
+        grid[9999] = -1
+        assert grid.nb_tiles == 1 and len(grid) == 1
+
+    def test_cell_table(self):
+        grid = CellTable(grid_size=100000, empty=-1)
+        assert grid[0] == -1 and len(grid) == 0
+        big = 100000 * 100000 - 1
+        grid[big] = 7
+        grid[np.array([5, 6, 5000])] = np.array([1, 2, 3])
+        assert grid[big] == 7 and len(grid) == 4
+        assert grid[np.array([[5, 6], [7, 5000]])].tolist() == [[1, 2], [-1, 3]]
+        cells, values = grid.items()
+        assert cells.tolist() == [5, 6, 5000, big] and values.tolist() == [1, 2, 3, 7]
+        # growing keeps the values, emptied cells are removed
+        rng = np.random.default_rng(0)
+        expected = dict(zip(cells.tolist(), values.tolist()))
+        for cell, value in zip(rng.integers(0, 500, size=3000).tolist(), rng.integers(-1, 3, size=3000).tolist()):
+            grid[cell] = value
+            if value == -1:
+                expected.pop(cell, None)
+            else:
+                expected[cell] = value
+        cells, values = grid.items()
+        assert dict(zip(cells.tolist(), values.tolist())) == expected and len(grid) == len(expected)
+
+    def test_occupancy(self):
+        occupied = TiledOccupancy(grid_size=100000, coordinates=[(0, 0), (99999, 99999)])
+        occupied.add((50000, 7))
+        occupied.discard((0, 0))
+        assert (50000, 7) in occupied and (0, 0) not in occupied
+        assert occupied == {(50000, 7), (99999, 99999)}
+        assert occupied.nbytes < 1000
+
+    def test_neighbours_across_tiles(self):
+        table = square_grid_neighbour_table(10)
+        cells = np.arange(100)
+        # computed neighbours match the table, wrapping around the grid
+        assert np.array_equal(square_grid_neighbour_rows(10, cells), table[cells])
+        big = 100000
+        corner = square_grid_neighbours(big, SquareGridCoordinate(0, big - 1), shuffle=False)
+        assert {tuple(c) for c in corner} == {(big - 1, big - 2), (big - 1, big - 1), (big - 1, 0), (0, big - 2),
+                                              (0, 0), (1, big - 2), (1, big - 1), (1, 0)}
+
+    def test_sparse_engine(self):
+        '''
+        Sparse and dense storage play the same simulation
+        '''
+        dense = ArraySimulationGrid(simulation_parameters=sim_config, seed=11, sparse=False)
+        sparse = ArraySimulationGrid(simulation_parameters=sim_config, seed=11, sparse=True)
+        for _ in range(10):
+            try:
+                dense.play_turn()
+            except EndOfSimulatioError:
+                break
+            sparse.play_turn()
+            assert np.array_equal(sparse.get_type_grid(), dense.get_type_grid())
+            assert sparse.get_simulation_grid_data().equals(dense.get_simulation_grid_data())
+
+    def test_large_world(self):
+        '''
+        Memory follows the population on a 100k x 100k grid
+        '''
+        config = dict(sim_config, grid_size=100000, init_nb_fish=2000, init_nb_shark=200)
+        grid = ArraySimulationGrid(simulation_parameters=config, seed=3)
+        grid.play_turn()
+        assert len(grid.slot) == grid.counters.fish + grid.counters.shark
+        assert grid.slot.nbytes < 2 ** 20
+        animals = grid.get_simulation_grid_data()
+        x, y = int(animals.coord_x.iloc[0]), int(animals.coord_y.iloc[0])
+        window = display_simple_grid(animals, grid_size=100000, window=(x, y, 3, 3))
+        assert window.shape == (3, 3) and window[0, 0] == animals.animal_type.iloc[0].value
+        # database engine
+        client = SimulationClient('sqlite:///:memory:')
+        db_grid = SimulationGrid(persistence=client, simulation_parameters=dict(config, init_nb_fish=100,
+                                                                               init_nb_shark=10), seed=3)
+        db_grid.play_turn()
+        assert isinstance(db_grid.occupied_coord, TiledOccupancy)
+        after = client.get_animals_df(sim_id=db_grid._sid)
+        assert db_grid.occupied_coord == set(zip(after.coord_x, after.coord_y))
+
+    def test_tiled_occupancy_across_turns(self):
+        '''
+        Turns played on a grid above DENSE_TABLE_MAX_CELLS keep updating the tiled occupied coordinates in place
+        '''
+        grid_size = int(DENSE_TABLE_MAX_CELLS ** 0.5) + 1
+        client = SimulationClient('sqlite:///:memory:')
+        grid = SimulationGrid(persistence=client, simulation_parameters=dict(sim_config, grid_size=grid_size,
+                                                                            init_nb_fish=60, init_nb_shark=6), seed=5)
+        occupied = grid.occupied_coord
+        assert isinstance(occupied, TiledOccupancy)
+        for _ in range(3):
+            grid.play_turn()
+            assert grid.occupied_coord is occupied
+            animals = client.get_animals_df(sim_id=grid._sid)
+            assert occupied == set(zip(animals.coord_x, animals.coord_y))
@@ -1,6 +1,8 @@
 import pytest
 
-from fish_bowl.process.topology import SquareGridCoordinate, TopologyError, square_grid_valid, square_grid_neighbours
+from fish_bowl.process.topology import SquareGridCoordinate, TopologyError, square_grid_valid, square_grid_neighbours, \
+    square_grid_neighbour_table, square_grid_neighbour_cells, square_grid_cell, square_grid_coordinates, \
+    NEIGH_PERMUTATIONS
 
 
 class TestTopology:
@@ -38,3 +40,29 @@ class TestTopology:
         # line
         neigh_list = square_grid_neighbours(10, SquareGridCoordinate(0, 5))
         assert len(neigh_list) == 8 # Used to work fine. Changed from 5, since now we have 'infinite' grid
+
+    def test_neighbour_table(self):
+        table = square_grid_neighbour_table(10)
+        assert table.shape == (100, 8)
+        assert square_grid_neighbour_table(10) is table, 'table is cached per grid size'
+        for coord in [SquareGridCoordinate(1, 1), SquareGridCoordinate(9, 9), SquareGridCoordinate(0, 5)]:
+            expected = {tuple(coord.move(x, y, grid_size=10)) for x in (-1, 0, 1) for y in (-1, 0, 1) if x or y}
+            cells = square_grid_neighbour_cells(10, square_grid_cell(10, coord))
+            assert {divmod(int(c), 10) for c in cells} == expected
+            assert {tuple(c) for c in square_grid_neighbours(10, coord)} == expected
+
+    def test_neighbour_permutation(self):
+        assert NEIGH_PERMUTATIONS.shape == (40320, 8)
+        coord = SquareGridCoordinate(4, 4)
+        ordered = square_grid_neighbours(10, coord, shuffle=False)
+        # same permutation, same order
+        perm = 1234
+        assert square_grid_neighbours(10, coord, permutation=perm) == square_grid_neighbours(10, coord,
+                                                                                             permutation=perm)
+        assert square_grid_neighbours(10, coord, permutation=perm) == [ordered[i] for i in NEIGH_PERMUTATIONS[perm]]
+        # single cells are looked up in plain python, many at once in the table
+        cell = square_grid_cell(10, coord)
+        table_row = square_grid_neighbour_table(10)[cell]
+        assert square_grid_neighbour_cells(10, cell, permutation=perm) == table_row[NEIGH_PERMUTATIONS[perm]].tolist()
+        assert square_grid_coordinates(10)[cell] == coord
+